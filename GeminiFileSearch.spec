@@ -6,7 +6,7 @@ a = Analysis(
     pathex=[],
     binaries=[],
     datas=[('templates', 'templates'), ('static', 'static'), ('.env.example', '.')],
-    hiddenimports=['google', 'google.genai', 'flask', 'werkzeug', 'jinja2'],
+    hiddenimports=['google', 'google.genai', 'flask', 'werkzeug', 'jinja2', 'waitress', 'pypdf'],
     hookspath=[],
     hooksconfig={},
     runtime_hooks=[],
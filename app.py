@@ -1,21 +1,50 @@
-import os
 import time
+STARTUP_STARTED = time.perf_counter() # Origin of the --profile-startup timeline
+import io
+import os
 import json
-from flask import Flask, request, jsonify, render_template
+import base64
+import bisect
+import html
+import hashlib
+import sqlite3
+import tempfile
+import mimetypes
+import unicodedata
+import re
+import zipfile
+from xml.etree import ElementTree
+from flask import Flask, Request, request, jsonify, render_template, Response, stream_with_context, g
 from werkzeug.utils import secure_filename
-from google import genai
-from google.genai import types
 from dotenv import load_dotenv
 
 import sys
-import webbrowser
+import uuid
+import heapq
+import queue
+import random
 import threading
+import multiprocessing
 from threading import Timer
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+# Startup timeline for --profile-startup: (step, perf_counter when it finished)
+startup_marks = []
+
+def mark_startup(step):
+    startup_marks.append((step, time.perf_counter()))
 
+mark_startup("imports")
 load_dotenv()
+mark_startup("load_dotenv")
 
 def shutdown_server():
+    """The one way the app exits (Exit button, last tab gone)."""
     print("Shutting down server...")
+    stop_preprocess_pool()
     os._exit(0)
 
 
@@ -37,87 +66,1063 @@ else:
     app = Flask(__name__)
 app.config['UPLOAD_FOLDER'] = 'uploads'
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+mark_startup("flask app")
 
 # Global store persistence
+# Settings and per-store metadata live in a SQLite database (WAL mode) so concurrent
+# ingestion workers can update counters transactionally. store_config.json from older
+# versions is imported once and renamed to store_config.json.bak.
 STORE_CONFIG_FILE = 'store_config.json'
+STORE_DB_FILE = 'store_meta.db'
 CURRENT_STORE_ID = None
 client = None
+genai = None # google.genai, imported on first use (see load_sdk)
+sdk_import_lock = threading.Lock()
 
-def load_config():
-    if os.path.exists(STORE_CONFIG_FILE):
-        try:
-            with open(STORE_CONFIG_FILE, 'r') as f:
-                return json.load(f)
-        except:
-            return {}
-    return {}
+def load_sdk():
+    """Imports google-genai on first use. It is most of the app's import time, and the
+    index page, settings and local search don't need it."""
+    global genai
+    if genai is None:
+        with sdk_import_lock:
+            if genai is None:
+                with stage('sdk_import'):
+                    from google import genai as sdk
+                genai = sdk
+    return genai
+
+meta_local = threading.local()
+meta_init_lock = threading.Lock()
+meta_initialized = False
+
+META_SCHEMA = """
+CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS stores (
+    store_id TEXT PRIMARY KEY,
+    file_count INTEGER NOT NULL DEFAULT 0,
+    version INTEGER NOT NULL DEFAULT 0,
+    suggestions TEXT,
+    remote_count INTEGER,
+    verified_at REAL,
+    verified_local_count INTEGER
+);
+CREATE TABLE IF NOT EXISTS store_hashes (
+    store_id TEXT NOT NULL,
+    display_name TEXT NOT NULL,
+    document TEXT,
+    sha256 TEXT,
+    PRIMARY KEY (store_id, display_name)
+);
+CREATE TABLE IF NOT EXISTS sync_files (
+    store_id TEXT NOT NULL,
+    display_name TEXT NOT NULL,
+    root TEXT NOT NULL,
+    size INTEGER,
+    mtime_ns INTEGER,
+    sha256 TEXT,
+    synced_at REAL,
+    PRIMARY KEY (store_id, display_name)
+);
+CREATE TABLE IF NOT EXISTS catalog_cache (
+    key TEXT PRIMARY KEY,
+    value TEXT,
+    loaded_at REAL
+);
+"""
+
+# Columns added after the first release of store_meta.db: table -> [(name, declaration)]
+META_COLUMNS = {
+    "stores": [("remote_count", "INTEGER"), ("verified_at", "REAL"), ("verified_local_count", "INTEGER")],
+}
+
+# Local full-text index (see "Local Full-Text Index"); FTS5 is missing from some SQLite builds
+SEARCH_SCHEMA = """
+CREATE TABLE IF NOT EXISTS search_docs (
+    id INTEGER PRIMARY KEY,
+    store_id TEXT NOT NULL,
+    display_name TEXT NOT NULL,
+    sha256 TEXT,
+    size_bytes INTEGER,
+    indexed_at REAL,
+    UNIQUE (store_id, display_name)
+);
+CREATE VIRTUAL TABLE IF NOT EXISTS search_text USING fts5(
+    display_name, body, tokenize = 'unicode61 remove_diacritics 2'
+);
+"""
+search_available = False
+
+def init_search_schema(db):
+    global search_available
+    try:
+        db.executescript(SEARCH_SCHEMA)
+        search_available = True
+    except sqlite3.OperationalError as e:
+        print(f"Local search disabled (SQLite without FTS5?): {e}")
+
+def upgrade_meta_schema(db):
+    for table, columns in META_COLUMNS.items():
+        existing = {row[1] for row in db.execute(f"PRAGMA table_info({table})")}
+        for name, declaration in columns:
+            if name not in existing:
+                db.execute(f"ALTER TABLE {table} ADD COLUMN {name} {declaration}")
+
+def meta_db():
+    """Per-thread connection to the metadata database (autocommit; see meta_transaction)."""
+    global meta_initialized
+    db = getattr(meta_local, 'db', None)
+    if db is None:
+        db = sqlite3.connect(STORE_DB_FILE, timeout=30, isolation_level=None)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        meta_local.db = db
+        with meta_init_lock:
+            if not meta_initialized:
+                db.executescript(META_SCHEMA)
+                upgrade_meta_schema(db)
+                init_search_schema(db)
+                migrate_json_config(db)
+                meta_initialized = True
+    return db
+
+class meta_transaction:
+    """BEGIN IMMEDIATE ... COMMIT on this thread's connection, rolled back on error."""
+
+    def __enter__(self):
+        self.db = meta_db()
+        self.db.execute("BEGIN IMMEDIATE")
+        return self.db
 
-def save_config(new_data):
-    data = load_config()
-    data.update(new_data)
-    with open(STORE_CONFIG_FILE, 'w') as f:
-        json.dump(data, f)
+    def __exit__(self, exc_type, exc, tb):
+        self.db.execute("ROLLBACK" if exc_type else "COMMIT")
+        return False
+
+def migrate_json_config(db):
+    """One-time import of the legacy store_config.json."""
+    if not os.path.exists(STORE_CONFIG_FILE):
+        return
+    try:
+        with open(STORE_CONFIG_FILE, 'r') as f:
+            data = json.load(f)
+    except Exception as e:
+        print(f"Warning: could not migrate {STORE_CONFIG_FILE}: {e}")
+        return
+
+    db.execute("BEGIN IMMEDIATE")
+    try:
+        for key in ('last_active_store_id', 'api_key'):
+            if key in data:
+                db.execute("INSERT OR REPLACE INTO settings VALUES (?, ?)", (key, json.dumps(data[key])))
+        for store_id, meta in data.get('stores_meta', {}).items():
+            suggestions = meta.get('suggestions')
+            db.execute("INSERT OR REPLACE INTO stores (store_id, file_count, version, suggestions) VALUES (?, ?, ?, ?)",
+                       (store_id, meta.get('file_count', 0), meta.get('version', 0),
+                        json.dumps(suggestions) if suggestions else None))
+            for name, known in meta.get('hashes', {}).items():
+                db.execute("INSERT OR REPLACE INTO store_hashes VALUES (?, ?, ?, ?)",
+                           (store_id, name, known.get('document'), known.get('sha256')))
+        db.execute("COMMIT")
+    except Exception:
+        db.execute("ROLLBACK")
+        raise
+    os.replace(STORE_CONFIG_FILE, STORE_CONFIG_FILE + '.bak')
+    print(f"Migrated {STORE_CONFIG_FILE} to {STORE_DB_FILE}")
+
+def load_setting(key):
+    row = meta_db().execute("SELECT value FROM settings WHERE key = ?", (key,)).fetchone()
+    return json.loads(row[0]) if row else None
+
+def save_setting(key, value):
+    meta_db().execute("INSERT OR REPLACE INTO settings VALUES (?, ?)", (key, json.dumps(value)))
 
 def load_active_store_id():
-    return load_config().get('last_active_store_id')
+    return load_setting('last_active_store_id')
 
 def save_active_store_id(store_id):
-    save_config({'last_active_store_id': store_id})
+    save_setting('last_active_store_id', store_id)
 
 def load_api_key():
-    return load_config().get('api_key')
+    return load_setting('api_key')
 
 def save_api_key(key):
-    save_config({'api_key': key})
+    save_setting('api_key', key)
 
 def get_store_file_count_local(store_id):
-    config = load_config()
-    stores_meta = config.get('stores_meta', {})
-    return stores_meta.get(store_id, {}).get('file_count', 0)
+    row = meta_db().execute("SELECT file_count FROM stores WHERE store_id = ?", (store_id,)).fetchone()
+    return row[0] if row else 0
+
+def get_all_store_meta_local():
+    """{store_id: {...}} for every store in a single query, for listings."""
+    rows = meta_db().execute("""
+        SELECT store_id, file_count, version, remote_count, verified_at, verified_local_count FROM stores
+    """).fetchall()
+    return {row[0]: {"file_count": row[1], "version": row[2], "remote_count": row[3],
+                     "verified_at": row[4], "verified_local_count": row[5]} for row in rows}
+
+def get_store_meta_local(store_id):
+    return get_all_store_meta_local().get(store_id) if store_id else None
+
+def save_store_remote_count_local(store_id, remote_count):
+    """Records a verified remote document count, with the local counter at that moment."""
+    meta_db().execute("""
+        INSERT INTO stores (store_id, remote_count, verified_at, verified_local_count) VALUES (?, ?, ?, 0)
+        ON CONFLICT (store_id) DO UPDATE SET
+            remote_count = excluded.remote_count,
+            verified_at = excluded.verified_at,
+            verified_local_count = file_count
+    """, (store_id, remote_count, time.time()))
 
 def update_store_file_count_local(store_id, delta):
-    config = load_config()
-    stores_meta = config.get('stores_meta', {})
-    if store_id not in stores_meta:
-        stores_meta[store_id] = {'file_count': 0}
-    
-    current = stores_meta[store_id].get('file_count', 0)
-    # Ensure not negative? Maybe useful for sync issues.
-    new_count = max(0, current + delta)
-    stores_meta[store_id]['file_count'] = new_count
-    
-    config['stores_meta'] = stores_meta
-    with open(STORE_CONFIG_FILE, 'w') as f:
-        json.dump(config, f)
+    # Single atomic upsert; clamp at 0 in case we drift from the remote store
+    meta_db().execute("""
+        INSERT INTO stores (store_id, file_count) VALUES (?, MAX(0, ?))
+        ON CONFLICT (store_id) DO UPDATE SET file_count = MAX(0, file_count + ?)
+    """, (store_id, delta, delta))
 
 def init_store_meta_local(store_id):
-    config = load_config()
-    stores_meta = config.get('stores_meta', {})
-    stores_meta[store_id] = {'file_count': 0}
-    config['stores_meta'] = stores_meta
-    with open(STORE_CONFIG_FILE, 'w') as f:
-        json.dump(config, f)
+    with meta_transaction() as db:
+        db.execute("INSERT OR REPLACE INTO stores (store_id, file_count) VALUES (?, 0)", (store_id,))
+        db.execute("DELETE FROM store_hashes WHERE store_id = ?", (store_id,))
+        db.execute("DELETE FROM sync_files WHERE store_id = ?", (store_id,))
 
 def delete_store_meta_local(store_id):
-    config = load_config()
-    stores_meta = config.get('stores_meta', {})
-    if store_id in stores_meta:
-        del stores_meta[store_id]
-        config['stores_meta'] = stores_meta
-        with open(STORE_CONFIG_FILE, 'w') as f:
-            json.dump(config, f)
+    with meta_transaction() as db:
+        db.execute("DELETE FROM stores WHERE store_id = ?", (store_id,))
+        db.execute("DELETE FROM store_hashes WHERE store_id = ?", (store_id,))
+        db.execute("DELETE FROM sync_files WHERE store_id = ?", (store_id,))
+        if search_available:
+            db.execute("DELETE FROM search_text WHERE rowid IN (SELECT id FROM search_docs WHERE store_id = ?)", (store_id,))
+            db.execute("DELETE FROM search_docs WHERE store_id = ?", (store_id,))
+
+def load_store_hashes_local(store_id):
+    """{display_name: {"document", "sha256"}} for files uploaded through this app."""
+    rows = meta_db().execute("SELECT display_name, document, sha256 FROM store_hashes WHERE store_id = ?",
+                             (store_id,)).fetchall()
+    return {row[0]: {"document": row[1], "sha256": row[2]} for row in rows}
+
+def save_store_hash_local(store_id, display_name, document, sha256):
+    if sha256:
+        meta_db().execute("INSERT OR REPLACE INTO store_hashes VALUES (?, ?, ?, ?)",
+                          (store_id, display_name, document, sha256))
+    else:
+        meta_db().execute("DELETE FROM store_hashes WHERE store_id = ? AND display_name = ?",
+                          (store_id, display_name))
+
+def get_store_version_local(store_id):
+    """Bumped every time the store's documents change; derived data is keyed on it."""
+    row = meta_db().execute("SELECT version FROM stores WHERE store_id = ?", (store_id,)).fetchone()
+    return row[0] if row else 0
+
+def bump_store_version_local(store_id):
+    with meta_transaction() as db:
+        db.execute("""
+            INSERT INTO stores (store_id, version) VALUES (?, 1)
+            ON CONFLICT (store_id) DO UPDATE SET version = version + 1
+        """, (store_id,))
+        return db.execute("SELECT version FROM stores WHERE store_id = ?", (store_id,)).fetchone()[0]
+
+def load_store_suggestions_local(store_id):
+    """{"version", "questions", "generated_at"} or None."""
+    row = meta_db().execute("SELECT suggestions FROM stores WHERE store_id = ?", (store_id,)).fetchone()
+    return json.loads(row[0]) if row and row[0] else None
+
+def save_store_suggestions_local(store_id, version, questions):
+    value = json.dumps({'version': version, 'questions': questions, 'generated_at': time.time()})
+    meta_db().execute("""
+        INSERT INTO stores (store_id, suggestions) VALUES (?, ?)
+        ON CONFLICT (store_id) DO UPDATE SET suggestions = excluded.suggestions
+    """, (store_id, value))
 
 CURRENT_STORE_ID = load_active_store_id()
+mark_startup("metadata db")
+
+# --- Metrics / Tracing ---
+# Counters, gauges and latency histograms for every stage of upload and chat, exposed at
+# /api/metrics in Prometheus text format. With TRACE_LOG set, every timed stage is also
+# written as a JSON line carrying the id of the request that started it.
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "1").lower() not in ('0', 'false', 'no')
+TRACE_LOG = os.getenv("TRACE_LOG") # e.g. traces.jsonl, unset = no trace log
+METRICS_PREFIX = "filesearch_"
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+trace_context = threading.local()
+
+def current_request_id():
+    return getattr(trace_context, 'request_id', None)
+
+def set_request_id(request_id):
+    trace_context.request_id = request_id
+
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {} # (name, labels) -> value
+        self.gauges = {}
+        self.histograms = {} # (name, labels) -> [bucket counts..., sum, count]
+        self.help = {}
+        self.trace_file = open(TRACE_LOG, 'a', buffering=1, encoding='utf-8') if TRACE_LOG else None
+
+    def inc(self, name, value=1, **labels):
+        if not METRICS_ENABLED:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def gauge_add(self, name, delta, **labels):
+        if not METRICS_ENABLED:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.gauges[key] = self.gauges.get(key, 0) + delta
+
+    def observe(self, name, seconds, **labels):
+        if not METRICS_ENABLED:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            hist = self.histograms.get(key)
+            if hist is None:
+                hist = self.histograms[key] = [0] * (len(LATENCY_BUCKETS) + 2)
+            hist[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+            hist[-2] += seconds
+            hist[-1] += 1
+
+    def trace(self, stage_name, seconds, error=None, **labels):
+        if self.trace_file is None:
+            return
+        record = {"ts": round(time.time(), 3), "request_id": current_request_id(), "stage": stage_name,
+                  "duration_ms": round(seconds * 1000, 2), **labels}
+        if error:
+            record['error'] = error
+        line = json.dumps(record) + "\n"
+        with self.lock:
+            self.trace_file.write(line)
+
+    def render(self, extra_gauges=()):
+        """Prometheus text exposition format."""
+        def fmt_labels(labels, extra=()):
+            pairs = list(labels) + list(extra)
+            if not pairs:
+                return ""
+            return "{" + ",".join(f'{k}="{str(v).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"' for k, v in pairs) + "}"
+
+        lines = []
+        with self.lock:
+            counters = dict(self.counters)
+            gauges = dict(self.gauges)
+            histograms = {k: list(v) for k, v in self.histograms.items()}
+        for name, labels, value in extra_gauges:
+            gauges[(name, tuple(sorted(labels.items())))] = value
+
+        for kind, series in (("counter", counters), ("gauge", gauges)):
+            for name in sorted({k[0] for k in series}):
+                lines.append(f"# TYPE {METRICS_PREFIX}{name} {kind}")
+                for (n, labels), value in sorted(series.items()):
+                    if n == name:
+                        lines.append(f"{METRICS_PREFIX}{name}{fmt_labels(labels)} {value}")
+        for name in sorted({k[0] for k in histograms}):
+            lines.append(f"# TYPE {METRICS_PREFIX}{name} histogram")
+            for (n, labels), hist in sorted(histograms.items()):
+                if n != name:
+                    continue
+                cumulative = 0
+                for bound, count in zip(LATENCY_BUCKETS + ('+Inf',), hist[:-2]):
+                    cumulative += count
+                    lines.append(f"{METRICS_PREFIX}{name}_bucket{fmt_labels(labels, [('le', bound)])} {cumulative}")
+                lines.append(f"{METRICS_PREFIX}{name}_sum{fmt_labels(labels)} {hist[-2]}")
+                lines.append(f"{METRICS_PREFIX}{name}_count{fmt_labels(labels)} {hist[-1]}")
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+
+@contextmanager
+def stage(name, **labels):
+    """Times a block as stage_seconds{stage=name}, tracks it as in flight and traces it."""
+    if not METRICS_ENABLED and metrics.trace_file is None:
+        yield
+        return
+    metrics.gauge_add('stage_in_flight', 1, stage=name)
+    started = time.perf_counter()
+    error = None
+    try:
+        yield
+    except Exception as e:
+        error = str(e)
+        metrics.inc('stage_errors_total', stage=name)
+        raise
+    finally:
+        elapsed = time.perf_counter() - started
+        metrics.gauge_add('stage_in_flight', -1, stage=name)
+        metrics.observe('stage_seconds', elapsed, stage=name, **labels)
+        metrics.trace(name, elapsed, error, **labels)
+
+@app.before_request
+def start_request_trace():
+    g.request_started = time.perf_counter()
+    set_request_id(request.headers.get('X-Request-ID') or uuid.uuid4().hex[:16])
+    metrics.gauge_add('http_requests_in_flight', 1)
+
+@app.after_request
+def finish_request_trace(response):
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    elapsed = time.perf_counter() - g.request_started
+    metrics.observe('http_request_seconds', elapsed, route=route, method=request.method)
+    metrics.inc('http_requests_total', route=route, method=request.method, status=response.status_code)
+    metrics.trace('http_request', elapsed, route=route, method=request.method, status=response.status_code)
+    response.headers['X-Request-ID'] = current_request_id() or ''
+    return response
+
+@app.teardown_request
+def end_request_trace(exc):
+    # Runs even when the request raised (unlike after_request), so the gauge can't leak
+    if 'request_started' in g:
+        metrics.gauge_add('http_requests_in_flight', -1)
+
+# --- Gemini Call Scheduler ---
+# Every client call goes through one scheduler: a token bucket per API family, priority
+# lanes (interactive calls are served before background ingestion waiting on the same
+# bucket), jittered exponential backoff on retryable errors and a deadline per call.
+# Mutating calls are only retried when the server surely didn't act on them (429, no connection).
+INTERACTIVE = 0
+BACKGROUND = 1
+
+RATE_LIMITS = { # family -> calls per second (bursts up to 2x)
+    "files": float(os.getenv("RATE_LIMIT_FILES", "5")),
+    "file_search_stores": float(os.getenv("RATE_LIMIT_FILE_SEARCH_STORES", "5")),
+    "models": float(os.getenv("RATE_LIMIT_MODELS", "5")),
+    "operations": float(os.getenv("RATE_LIMIT_OPERATIONS", "10")),
+}
+CALL_DEADLINE = float(os.getenv("CALL_DEADLINE", "120")) # Seconds per call, including waits and retries
+CALL_MAX_RETRIES = int(os.getenv("CALL_MAX_RETRIES", "5"))
+RETRY_BASE_DELAY = 1.0
+RETRY_MAX_DELAY = 30.0
+RETRYABLE_CODES = (429, 500, 502, 503, 504)
+# Calls that are safe to repeat. A 5xx or a timeout on anything else (upload, import_file,
+# create, delete_file) may have succeeded server-side, and repeating it would create a
+# second document or store, so those are only retried when the request surely wasn't acted on.
+IDEMPOTENT_METHODS = ('list', 'get', 'generate_content', 'count_tokens', 'embed_content') # Name prefixes
+
+call_context = threading.local()
+
+class CallDeadlineExceeded(Exception):
+    pass
+
+def set_call_priority(priority):
+    """Priority of client calls made by the current thread (default INTERACTIVE)."""
+    call_context.priority = priority
+
+def background_thread():
+    """ThreadPoolExecutor initializer for pools that do background work."""
+    set_call_priority(BACKGROUND)
+
+def never_sent(e):
+    """The request failed before reaching the server (connection refused / not established)."""
+    if isinstance(e, ConnectionRefusedError):
+        return True
+    return type(e).__module__.startswith('httpx') and type(e).__name__ in ('ConnectError', 'ConnectTimeout')
+
+def is_retryable(e, idempotent=True):
+    if not idempotent:
+        return getattr(e, 'code', None) == 429 or never_sent(e) # Rejected before it was processed
+    return (getattr(e, 'code', None) in RETRYABLE_CODES or never_sent(e)
+            or isinstance(e, (ConnectionError, TimeoutError)))
+
+class TokenBucket:
+    def __init__(self, rate):
+        self.rate = rate
+        self.capacity = max(1.0, rate * 2)
+        self.tokens = self.capacity
+        self.updated = time.time()
+        self.paused_until = 0
+
+    def take(self):
+        """Takes a token and returns 0, or returns the seconds until one is available."""
+        now = time.time()
+        if now < self.paused_until:
+            return self.paused_until - now
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def pause(self, seconds):
+        """After a 429 nobody in this family calls again until the backoff has passed."""
+        self.paused_until = max(self.paused_until, time.time() + seconds)
+        self.tokens = 0
+
+class CallScheduler:
+    def __init__(self, rate_limits):
+        self.cond = threading.Condition()
+        self.seq = 0
+        self.buckets = {family: TokenBucket(rate) for family, rate in rate_limits.items()}
+        self.waiting = {family: [] for family in rate_limits} # heap of (priority, seq)
+        self.counters = {family: {"calls": 0, "throttled": 0, "retries": 0, "failures": 0, "deadline_exceeded": 0}
+                         for family in rate_limits}
+
+    def acquire(self, family, priority, deadline):
+        bucket = self.buckets[family]
+        heap = self.waiting[family]
+        started = time.perf_counter()
+        with self.cond:
+            self.seq += 1
+            ticket = (priority, self.seq)
+            heapq.heappush(heap, ticket)
+            throttled = False
+            try:
+                while True:
+                    wait = bucket.take() if heap[0] == ticket else None
+                    if wait == 0:
+                        if throttled:
+                            metrics.observe('scheduler_wait_seconds', time.perf_counter() - started, family=family)
+                        return
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        self.counters[family]['deadline_exceeded'] += 1
+                        raise CallDeadlineExceeded(f"Deadline exceeded waiting for {family} quota")
+                    if not throttled:
+                        throttled = True
+                        self.counters[family]['throttled'] += 1
+                        metrics.inc('scheduler_throttled_total', family=family,
+                                    lane='interactive' if priority == INTERACTIVE else 'background')
+                    self.cond.wait(min(wait, remaining) if wait is not None else remaining)
+            finally:
+                heap.remove(ticket)
+                heapq.heapify(heap)
+                self.cond.notify_all()
+
+    def call(self, family, fn, idempotent=True):
+        return self.call_as(getattr(call_context, 'priority', INTERACTIVE), family, fn, idempotent)
+
+    def call_as(self, priority, family, fn, idempotent=True):
+        deadline = time.time() + CALL_DEADLINE
+        attempt = 0
+        while True:
+            self.acquire(family, priority, deadline)
+            with self.cond:
+                self.counters[family]['calls'] += 1
+            try:
+                return fn()
+            except Exception as e:
+                delay = min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt) * random.uniform(0.5, 1.0)
+                if not is_retryable(e, idempotent) or attempt >= CALL_MAX_RETRIES or time.time() + delay > deadline:
+                    with self.cond:
+                        self.counters[family]['failures'] += 1
+                    raise
+                print(f"Retrying {family} call in {delay:.1f}s after: {e}")
+                metrics.inc('scheduler_retries_total', family=family, code=getattr(e, 'code', None) or type(e).__name__)
+                with self.cond:
+                    self.counters[family]['retries'] += 1
+                    if getattr(e, 'code', None) == 429:
+                        self.buckets[family].pause(delay)
+                time.sleep(delay)
+                attempt += 1
+
+    def stats(self):
+        with self.cond:
+            return {family: dict(self.counters[family], queue_depth=len(self.waiting[family]),
+                                 rate=self.buckets[family].rate)
+                    for family in self.buckets}
+
+scheduler = CallScheduler(RATE_LIMITS)
+
+class ScheduledNamespace:
+    """Wraps e.g. client.models so each method call goes through the scheduler."""
+
+    def __init__(self, raw, family):
+        self.raw = raw
+        self.family = family
+
+    def __getattr__(self, name):
+        attr = getattr(self.raw, name)
+        if not callable(attr):
+            return attr
+        if name.endswith('_stream'):
+            # Streams are lazy; schedule (and retry) the request that produces the first chunk
+            def call_stream(*args, **kwargs):
+                def start():
+                    with stage(f"{self.family}.{name}.first_chunk"):
+                        stream = iter(attr(*args, **kwargs))
+                        return stream, next(stream, None)
+                stream, first = scheduler.call(self.family, start)
+                return prepend_chunk(first, stream)
+            return call_stream
+
+        def call(*args, **kwargs):
+            # Streams handed to the SDK (uploads) have to start from the same offset on every retry
+            streams = [(a, a.tell()) for a in (*args, *kwargs.values()) if isinstance(a, io.IOBase) and a.seekable()]
+
+            def timed():
+                for stream, offset in streams:
+                    stream.seek(offset)
+                with stage(f"{self.family}.{name}"):
+                    return attr(*args, **kwargs)
+            result = scheduler.call(self.family, timed, idempotent=name.startswith(IDEMPOTENT_METHODS))
+            if hasattr(result, 'next_page') and hasattr(result, 'page'):
+                return scheduled_pages(self.family, name, result)
+            return result
+        return call
+
+def scheduled_pages(family, name, pager):
+    """Iterates a list() pager, fetching each further page through the scheduler at the
+    caller's priority, so a long listing is rate limited and a 429 on page 40 retries
+    that page instead of failing the whole listing."""
+    priority = getattr(call_context, 'priority', INTERACTIVE)
+
+    def next_page():
+        with stage(f"{family}.{name}.page"):
+            pager.next_page()
+
+    while True:
+        yield from pager.page
+        if not pager.config.get('page_token'):
+            return
+        # A failed request leaves the pager's page token as it was, so a retry asks for the same page
+        scheduler.call_as(priority, family, next_page)
+
+def prepend_chunk(first, stream):
+    if first is not None:
+        yield first
+    yield from stream
+
+class ScheduledClient:
+    """Drop-in wrapper for genai.Client."""
+
+    def __init__(self, raw):
+        self.raw = raw
+
+    def __getattr__(self, name):
+        attr = getattr(self.raw, name)
+        if name in RATE_LIMITS:
+            return ScheduledNamespace(attr, name)
+        return attr
+
+scheduled_client = None
 
 def get_client():
-    global client
+    global client, scheduled_client
     if client is None:
         # Try env first, then config
         api_key = os.getenv("GEMINI_API_KEY") or load_api_key()
         if not api_key:
             raise ValueError("GEMINI_API_KEY not set.")
-        client = genai.Client(api_key=api_key)
-    return client
+        client = load_sdk().Client(api_key=api_key)
+    if scheduled_client is None or scheduled_client.raw is not client:
+        scheduled_client = ScheduledClient(client)
+    return scheduled_client
+
+# --- SDK Call Executor ---
+# Request handlers run their blocking Gemini SDK calls on a bounded executor instead of
+# doing them inline. At most SDK_MAX_CONCURRENCY calls run at once and at most
+# SDK_MAX_PENDING more may wait; beyond that requests fail fast with 503. The defaults admit
+# 64 blocking calls (e.g. 50 concurrent chats plus uploads) and SERVER_THREADS keeps 16
+# threads on top of those for heartbeats, event streams and UI requests.
+SDK_MAX_CONCURRENCY = int(os.getenv("SDK_MAX_CONCURRENCY", "16"))
+SDK_MAX_PENDING = int(os.getenv("SDK_MAX_PENDING", "48"))
+SDK_CALL_TIMEOUT = float(os.getenv("SDK_CALL_TIMEOUT", "300")) # Seconds a handler waits for a result
+SERVER_THREADS = int(os.getenv("SERVER_THREADS", "80"))
+
+sdk_executor = ThreadPoolExecutor(max_workers=SDK_MAX_CONCURRENCY, thread_name_prefix="sdk")
+sdk_admission = threading.BoundedSemaphore(SDK_MAX_CONCURRENCY + SDK_MAX_PENDING)
+
+class ServerBusyError(Exception):
+    pass
+
+def admit_sdk_call():
+    if not sdk_admission.acquire(blocking=False):
+        raise ServerBusyError("Server is busy, please try again shortly.")
+
+def run_sdk(fn, *args, **kwargs):
+    """Runs fn on the SDK executor and waits for its result."""
+    admit_sdk_call()
+    future = sdk_executor.submit(fn, *args, **kwargs)
+    # The slot is held until the call really finishes, even if we stop waiting for it
+    future.add_done_callback(lambda f: sdk_admission.release())
+    return future.result(timeout=SDK_CALL_TIMEOUT)
+
+def run_sdk_stream(fn, *args, **kwargs):
+    """Like run_sdk for streaming calls: the stream is consumed on the SDK executor and the
+    returned generator hands the chunks over. Closing the generator stops the stream."""
+    admit_sdk_call()
+    chunks = queue.Queue()
+    cancelled = threading.Event()
+    end = object()
+
+    def produce():
+        try:
+            for chunk in fn(*args, **kwargs):
+                if cancelled.is_set():
+                    break
+                chunks.put(chunk)
+            chunks.put(end)
+        except Exception as e:
+            chunks.put(e)
+
+    future = sdk_executor.submit(produce)
+    future.add_done_callback(lambda f: sdk_admission.release())
+
+    def consume():
+        try:
+            while True:
+                item = chunks.get(timeout=SDK_CALL_TIMEOUT)
+                if item is end:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            cancelled.set()
+
+    return consume()
+
+
+# --- Store Manifest Cache ---
+# Per-store map of display_name -> {document, uri, size_bytes, sha256}.
+# Kept current by uploads/deletes so duplicate checks are a dict lookup instead of a
+# full list_files scan, and reconciled against the remote listing when it expires.
+MANIFEST_TTL = float(os.getenv("MANIFEST_TTL", "300"))
+STORES_TTL = float(os.getenv("STORES_TTL", "60"))
+MODELS_TTL = float(os.getenv("MODELS_TTL", "3600"))
+
+store_manifests = {} # store_id -> {"entries": {...}, "by_hash": {sha256: name}, "loaded_at": ts, "removed": {name: ts}, "generation": n}
+sorted_views = {} # (store_id, sort) -> (generation, keys, files), rebuilt when the manifest changes
+manifest_lock = threading.RLock()
+manifest_load_locks = {} # store_id -> Lock, so concurrent first reads share one listing
+reconciling = set()
+warming = set()
+
+def doc_display_name(f):
+    return f.config.display_name if (getattr(f, 'config', None) and f.config.display_name) else f.name
+
+def doc_entry(f):
+    return {
+        "document": f.name,
+        "uri": getattr(f, 'uri', None),
+        "size_bytes": getattr(f, 'size_bytes', None),
+        "sha256": None,
+        "updated_at": time.time(),
+    }
+
+def reconcile_manifest(store_id):
+    """Rebuilds a store manifest from the remote listing, keeping local-only data (hashes)
+    and any upload/delete that happened while the listing was running."""
+    started = time.time()
+    remote = {}
+    with stage('manifest_reconcile'):
+        for f in get_client().file_search_stores.list_files(file_search_store_name=store_id):
+            remote[doc_display_name(f)] = doc_entry(f)
+
+    # Hashes only exist locally; re-attach them where the document is unchanged
+    for name, known in load_store_hashes_local(store_id).items():
+        if name in remote and remote[name]['document'] == known.get('document'):
+            remote[name]['sha256'] = known.get('sha256')
+
+    with manifest_lock:
+        current = store_manifests.get(store_id, {"entries": {}, "removed": {}, "generation": 0})
+        for name, entry in current['entries'].items():
+            if entry['updated_at'] >= started:
+                remote[name] = entry # Written locally during the listing
+            elif name in remote and remote[name]['document'] == entry['document'] and entry['sha256']:
+                remote[name]['sha256'] = entry['sha256']
+        for name, removed_at in current['removed'].items():
+            if removed_at >= started and name in remote and name not in current['entries']:
+                del remote[name]
+        by_hash = {entry['sha256']: name for name, entry in remote.items() if entry['sha256']}
+        store_manifests[store_id] = {"entries": remote, "by_hash": by_hash, "loaded_at": time.time(), "removed": {},
+                                     "generation": current['generation'] + 1}
+        names = set(remote)
+
+    # Documents removed outside this app drop out of the local search index too
+    try:
+        search_prune_store(store_id, names, started)
+    except Exception as e:
+        print(f"Warning pruning search index for {store_id}: {e}")
+    return dict(remote)
+
+def refresh_manifest_async(store_id):
+    with manifest_lock:
+        if store_id in reconciling:
+            return
+        reconciling.add(store_id)
+
+    def run():
+        set_call_priority(BACKGROUND)
+        try:
+            reconcile_manifest(store_id)
+        except Exception as e:
+            print(f"Warning reconciling manifest for {store_id}: {e}")
+        finally:
+            with manifest_lock:
+                reconciling.discard(store_id)
+
+    threading.Thread(target=run, daemon=True).start()
+
+def get_store_manifest(store_id, refresh=False):
+    """Returns {display_name: entry}. Loads synchronously on first use or refresh,
+    serves the cached copy (and reconciles in the background) once it expires."""
+    with manifest_lock:
+        manifest = store_manifests.get(store_id)
+        if manifest and not refresh:
+            if time.time() - manifest['loaded_at'] > MANIFEST_TTL:
+                refresh_manifest_async(store_id)
+            return dict(manifest['entries'])
+        load_lock = manifest_load_locks.setdefault(store_id, threading.Lock())
+
+    with load_lock:
+        with manifest_lock:
+            manifest = store_manifests.get(store_id)
+            if manifest and not refresh:
+                return dict(manifest['entries']) # Loaded by another thread while we waited
+        return reconcile_manifest(store_id)
+
+def manifest_loaded(store_id):
+    with manifest_lock:
+        return store_id in store_manifests
+
+def warm_manifest_async(store_id):
+    """Starts the first load of a store manifest in the background. Readers arriving
+    meanwhile wait for that same listing (see get_store_manifest)."""
+    with manifest_lock:
+        if store_id in store_manifests or store_id in warming:
+            return
+        warming.add(store_id)
+
+    def run():
+        set_call_priority(BACKGROUND)
+        try:
+            get_store_manifest(store_id)
+        except Exception as e:
+            print(f"Warning loading manifest for {store_id}: {e}")
+        finally:
+            with manifest_lock:
+                warming.discard(store_id)
+
+    threading.Thread(target=run, daemon=True).start()
+
+def manifest_lookup(store_id, display_name):
+    entry = get_store_manifest(store_id).get(display_name)
+    return dict(entry) if entry else None
+
+def manifest_find_hash(store_id, sha256):
+    """Display name of a document in the store with this content hash, if any."""
+    get_store_manifest(store_id)
+    with manifest_lock:
+        manifest = store_manifests.get(store_id)
+        return manifest['by_hash'].get(sha256) if manifest else None
+
+def manifest_put(store_id, display_name, entry):
+    save_store_hash_local(store_id, display_name, entry['document'], entry.get('sha256'))
+    with manifest_lock:
+        manifest = store_manifests.get(store_id)
+        if manifest is None:
+            return # Not loaded yet; the first read will pick it up from the remote listing
+        manifest_remove(store_id, display_name, persist=False)
+        entry['updated_at'] = time.time()
+        manifest['entries'][display_name] = entry
+        manifest['removed'].pop(display_name, None)
+        manifest['generation'] += 1
+        if entry.get('sha256'):
+            manifest['by_hash'][entry['sha256']] = display_name
+
+def manifest_remove(store_id, display_name, persist=True):
+    if persist:
+        save_store_hash_local(store_id, display_name, None, None)
+    with manifest_lock:
+        manifest = store_manifests.get(store_id)
+        if manifest is None:
+            return
+        entry = manifest['entries'].pop(display_name, None)
+        if entry and manifest['by_hash'].get(entry['sha256']) == display_name:
+            del manifest['by_hash'][entry['sha256']]
+        manifest['removed'][display_name] = time.time()
+        manifest['generation'] += 1
+
+FILE_SORT_KEYS = {
+    "name": lambda f: (f['name'].casefold(), f['id']),
+    "size": lambda f: (f['size_bytes'] or 0, f['id']),
+}
+
+def get_sorted_files(store_id, sort, refresh=False):
+    """(keys, files) of the store manifest ordered by FILE_SORT_KEYS[sort], cached per manifest generation."""
+    get_store_manifest(store_id, refresh=refresh)
+    with manifest_lock:
+        manifest = store_manifests[store_id]
+        view = sorted_views.get((store_id, sort))
+        if view and view[0] == manifest['generation']:
+            return view[1], view[2]
+
+        files = [{
+            "name": name,
+            "id": entry['document'],
+            "uri": entry['uri'],
+            "size_bytes": entry['size_bytes'],
+        } for name, entry in manifest['entries'].items()]
+        files.sort(key=FILE_SORT_KEYS[sort])
+        keys = [FILE_SORT_KEYS[sort](f) for f in files]
+        sorted_views[(store_id, sort)] = (manifest['generation'], keys, files)
+        return keys, files
+
+def invalidate_manifest(store_id=None):
+    with manifest_lock:
+        if store_id is None:
+            store_manifests.clear()
+            sorted_views.clear()
+        else:
+            store_manifests.pop(store_id, None)
+            for key in [k for k in sorted_views if k[0] == store_id]:
+                del sorted_views[key]
+
+# --- Catalog Cache ---
+# Store and model listings are served stale-while-revalidate: a read gets the last listing
+# straight away, and once it is older than its TTL a background refresh replaces it. Each
+# listing is also kept in store_meta.db (per API key), so the first page load after a
+# restart is served warm. Creating or deleting a store invalidates the store listing.
+class CatalogCache:
+    def __init__(self, name, ttl, load, on_change=None):
+        self.name = name
+        self.ttl = ttl
+        self.load = load
+        self.on_change = on_change # Called when a refresh finds a different listing
+        self.value = None
+        self.loaded_at = 0
+        self.fingerprint = None # API key the value belongs to
+        self.generation = 0 # Bumped by invalidate(), so listings started before it aren't kept
+        self.refreshing = False
+        self.lock = threading.Lock()
+        self.load_lock = threading.Lock() # One listing at a time
+
+    def get(self, refresh=False, runner=None):
+        """The cached listing, loading it synchronously (through runner, e.g. run_sdk)
+        only when there is none yet or on refresh."""
+        fingerprint = api_key_fingerprint()
+        with self.lock:
+            if self.fingerprint != fingerprint:
+                self.value, self.loaded_at, self.fingerprint = None, 0, fingerprint
+                self._restore()
+            if self.value is not None and not refresh:
+                stale = time.time() - self.loaded_at > self.ttl
+                if stale and not self.refreshing:
+                    self.refreshing = True
+                    threading.Thread(target=self._refresh_in_background, daemon=True).start()
+                metrics.inc('catalog_cache_total', catalog=self.name, result='stale' if stale else 'hit')
+                return list(self.value)
+
+        metrics.inc('catalog_cache_total', catalog=self.name, result='miss')
+        with self.load_lock:
+            if not refresh:
+                with self.lock:
+                    if self.value is not None and self.fingerprint == fingerprint:
+                        return list(self.value) # Loaded by another request while we waited
+            return runner(self.reload) if runner else self.reload()
+
+    def reload(self):
+        with self.lock:
+            generation, fingerprint = self.generation, self.fingerprint
+        value = self.load()
+        now = time.time()
+        with self.lock:
+            if generation != self.generation or fingerprint != self.fingerprint:
+                return list(value) # Invalidated during the listing; let the next read list again
+            changed = self.value is not None and self.value != value
+            self.value, self.loaded_at = value, now
+        if changed and self.on_change:
+            self.on_change()
+        try:
+            meta_db().execute("INSERT OR REPLACE INTO catalog_cache VALUES (?, ?, ?)",
+                              (self.db_key(fingerprint), json.dumps(value), now))
+        except sqlite3.Error as e:
+            print(f"Warning saving {self.name} listing: {e}")
+        return list(value)
+
+    def _refresh_in_background(self):
+        set_call_priority(BACKGROUND)
+        try:
+            with self.load_lock:
+                self.reload()
+        except Exception as e:
+            print(f"Warning refreshing {self.name} listing: {e}")
+        finally:
+            with self.lock:
+                self.refreshing = False
+
+    def _restore(self):
+        """With self.lock held: the listing persisted for this API key, if any (served stale)."""
+        row = meta_db().execute("SELECT value, loaded_at FROM catalog_cache WHERE key = ?",
+                                (self.db_key(self.fingerprint),)).fetchone()
+        if row:
+            self.value, self.loaded_at = json.loads(row[0]), row[1]
+
+    def db_key(self, fingerprint):
+        return f"{self.name}:{fingerprint}"
+
+    def invalidate(self):
+        with self.lock:
+            self.value = None
+            self.loaded_at = 0
+            self.generation += 1
+        meta_db().execute("DELETE FROM catalog_cache WHERE key = ?", (self.db_key(api_key_fingerprint()),))
+
+def api_key_fingerprint():
+    api_key = os.getenv("GEMINI_API_KEY") or load_api_key() or ''
+    return hashlib.sha256(api_key.encode('utf-8')).hexdigest()[:16]
+
+def load_models():
+    models = []
+    # List models that support generateContent
+    # SDK might not have direct filter in list(), so we filter in loop
+    for m in get_client().models.list():
+        if 'generateContent' in m.supported_generation_methods and 'gemini' in m.name:
+            models.append({
+                "id": m.name.split("/")[-1], # Remove 'models/' prefix
+                "name": m.display_name or m.name
+            })
+    return models
+
+def load_remote_stores():
+    stores = []
+    for store in get_client().file_search_stores.list():
+        # Handle SDK object variations safely
+        display_name = store.name
+        try:
+            if hasattr(store, 'config') and store.config and hasattr(store.config, 'display_name'):
+                display_name = store.config.display_name
+            elif hasattr(store, 'display_name'):
+                display_name = store.display_name
+        except:
+            pass
+        stores.append({"id": store.name, "name": display_name})
+
+        # Newer API versions report the document count on the store itself
+        remote_count = getattr(store, 'active_documents_count', None)
+        if isinstance(remote_count, int):
+            save_store_remote_count_local(store.name, remote_count)
+    return stores
+
+models_catalog = CatalogCache('models', MODELS_TTL, load_models, on_change=lambda: publish_event('models'))
+stores_catalog = CatalogCache('stores', STORES_TTL, load_remote_stores, on_change=lambda: publish_event('stores'))
+
+def get_models(refresh=False):
+    """Cached [{id, name}] of the Gemini models that support generateContent."""
+    return models_catalog.get(refresh)
+
+def get_remote_stores(refresh=False):
+    """Cached [{id, name}] for client.file_search_stores.list()."""
+    return stores_catalog.get(refresh)
+
+def invalidate_stores_cache():
+    stores_catalog.invalidate()
+
+def invalidate_models_cache():
+    models_catalog.invalidate()
+
+def conditional_json(payload):
+    """jsonify with an ETag of the body; 304 Not Modified when If-None-Match already has it."""
+    response = jsonify(payload)
+    response.headers['Cache-Control'] = 'no-cache' # Browsers revalidate every time, which is cheap
+    response.add_etag()
+    return response.make_conditional(request)
 
 @app.route('/')
 def index():
@@ -135,7 +1140,9 @@ def set_key():
         os.environ["GEMINI_API_KEY"] = key
         save_api_key(key) # Persist it
         global client
-        client = genai.Client(api_key=key)
+        client = load_sdk().Client(api_key=key)
+        invalidate_stores_cache() # Listings belong to the previous key
+        invalidate_models_cache()
         # Reset store ID on key change as stores are scoped to project/user often? 
         return jsonify({"status": "success"})
     return jsonify({"status": "error", "message": "No key provided"}), 400
@@ -143,52 +1150,84 @@ def set_key():
 @app.route('/api/models', methods=['GET'])
 def list_models():
     try:
-        client = get_client()
-        models = []
-        # List models that support generateContent
-        # SDK might not have direct filter in list(), so we filter in loop
-        for m in client.models.list():
-            if 'generateContent' in m.supported_generation_methods and 'gemini' in m.name:
-                 # Extract version for cleaner display if needed, or just use display_name/name
-                 # Ensure we prioritize flash/pro
-                 models.append({
-                     "id": m.name.split("/")[-1], # Remove 'models/' prefix
-                     "name": m.display_name or m.name
-                 })
-        
+        # Cached (and warmed at startup); ?refresh=1 forces a new listing
+        models = models_catalog.get(refresh=request.args.get('refresh') in ('1', 'true'), runner=run_sdk)
         # Sort to put newest or pro first? Let's just sort by name for now, or put specific ones on top in frontend
-        return jsonify({"models": models})
+        return conditional_json({"models": models})
+    except ServerBusyError as e:
+        return jsonify({"models": [], "error": str(e)}), 503
     except Exception as e:
         print(f"Error fetching models: {e}")
         return jsonify({"models": [], "error": str(e)})
 
+# --- Store Document Counts ---
+# Displayed counts come from the last verified remote count plus local uploads/deletes since.
+# Verification runs in the background (a full manifest reconcile per store), at most once
+# per RECONCILE_INTERVAL per store and RECONCILE_WORKERS stores at a time.
+RECONCILE_INTERVAL = float(os.getenv("RECONCILE_INTERVAL", "600"))
+RECONCILE_WORKERS = int(os.getenv("RECONCILE_WORKERS", "2"))
+
+reconcile_executor = ThreadPoolExecutor(max_workers=RECONCILE_WORKERS, thread_name_prefix="reconcile",
+                                        initializer=background_thread)
+counts_in_flight = set()
+counts_lock = threading.Lock()
+
+def store_count_info(meta):
+    """Display count for a store row from get_all_store_meta_local()."""
+    meta = meta or {}
+    local = meta.get('file_count', 0)
+    if meta.get('remote_count') is None:
+        return {"count": local, "source": "local", "verified_at": None}
+    since = local - (meta.get('verified_local_count') or 0)
+    return {"count": max(0, meta['remote_count'] + since), "source": "remote", "verified_at": meta['verified_at']}
+
+def verify_store_count(store_id):
+    try:
+        manifest = reconcile_manifest(store_id)
+        save_store_remote_count_local(store_id, len(manifest))
+        publish_event('store', store_id=store_id, count=len(manifest), version=get_store_version_local(store_id))
+    except Exception as e:
+        print(f"Warning verifying count for {store_id}: {e}")
+    finally:
+        with counts_lock:
+            counts_in_flight.discard(store_id)
+
+def schedule_count_verification(store_ids, local_meta=None, force=False):
+    """Queues stores whose count hasn't been verified within RECONCILE_INTERVAL."""
+    local_meta = local_meta if local_meta is not None else get_all_store_meta_local()
+    now = time.time()
+    for store_id in store_ids:
+        verified_at = (local_meta.get(store_id) or {}).get('verified_at')
+        if not force and verified_at and now - verified_at < RECONCILE_INTERVAL:
+            continue
+        with counts_lock:
+            if store_id in counts_in_flight:
+                continue
+            counts_in_flight.add(store_id)
+        reconcile_executor.submit(verify_store_count, store_id)
+
 @app.route('/api/stores', methods=['GET'])
 def list_stores():
     try:
-        client = get_client()
         stores = []
-        # List stores from Gemini API
-        for store in client.file_search_stores.list():
-            # Handle SDK object variations safely
-            display_name = store.name
-            try:
-                if hasattr(store, 'config') and store.config and hasattr(store.config, 'display_name'):
-                    display_name = store.config.display_name
-                elif hasattr(store, 'display_name'):
-                    display_name = store.display_name
-            except:
-                pass
-            
-            # Get local file count
-            count = get_store_file_count_local(store.name)
-            
+        # List stores from Gemini API (cached, ?refresh=1 forces a new listing)
+        remote_stores = stores_catalog.get(refresh=request.args.get('refresh') in ('1', 'true'), runner=run_sdk)
+        local_meta = get_all_store_meta_local() # Listing may have recorded fresh remote counts
+        for store in remote_stores:
+            info = store_count_info(local_meta.get(store['id']))
+
             stores.append({
-                "id": store.name,
-                "name": display_name,
-                "active": (store.name == CURRENT_STORE_ID),
-                "file_count": count
+                "id": store['id'],
+                "name": store['name'],
+                "active": (store['id'] == CURRENT_STORE_ID),
+                "file_count": info['count'],
+                "count_source": info['source'],
+                "verified_at": info['verified_at']
             })
-        return jsonify({"stores": stores, "active_store_id": CURRENT_STORE_ID})
+        schedule_count_verification([s['id'] for s in remote_stores], local_meta)
+        return conditional_json({"stores": stores, "active_store_id": CURRENT_STORE_ID})
+    except ServerBusyError as e:
+        return jsonify({"stores": [], "error": str(e)}), 503
     except Exception as e:
         print(f"Error listing stores: {e}")
         return jsonify({"stores": [], "error": str(e)})
@@ -196,46 +1235,168 @@ def list_stores():
 @app.route('/api/store/<path:store_id>/count', methods=['GET'])
 def get_store_file_count(store_id):
     try:
-        client = get_client()
-        # Attempt to list files associated with this store.
-        # Direct method might not exist, so we use a general query if possible, or iterate.
-        # However, listing all files in a store via SDK is not always straightforward without 'tools'.
-        # We will try a known pattern: listing documents/files within the corpus/store.
-        
-        # NOTE: In strict Google GenAI SDK terms, iterating might be the only way if no specific 'count' field.
-        # We'll try to find a way to filter. 
-        # If we can't filter, we might just return safely "?"
-        
-        # Experimental: Try to get the store and see if it has stats
-        # store = client.file_search_stores.get(name=store_id)
-        # return jsonify({"count": getattr(store, "file_count", "?")})
-        
-        # Fallback: Just return "?" to avoid crashing or hanging on large datasets
-        # until we are sure of the efficient counting method.
-        # Users prefer a fast UI over a slow exact count.
-        
-        return jsonify({"count": "?"}) 
+        meta = get_store_meta_local(store_id)
+        if request.args.get('verify') in ('1', 'true'):
+            # Synchronous verification on demand
+            manifest = run_sdk(reconcile_manifest, store_id)
+            save_store_remote_count_local(store_id, len(manifest))
+            meta = get_store_meta_local(store_id)
+        else:
+            schedule_count_verification([store_id], {store_id: meta} if meta else {})
+        return jsonify(store_count_info(meta))
+    except ServerBusyError as e:
+        return jsonify({"count": "?", "error": str(e)}), 503
     except Exception as e:
         return jsonify({"count": "?", "error": str(e)})
 
+@app.route('/api/stores/drift', methods=['GET'])
+def store_count_drift():
+    """Compares the local upload/delete counter with the last verified remote count."""
+    try:
+        report = []
+        for store_id, meta in get_all_store_meta_local().items():
+            if meta['remote_count'] is None:
+                continue
+            local = meta['verified_local_count'] or 0
+            report.append({
+                "id": store_id,
+                "local_count": local,
+                "remote_count": meta['remote_count'],
+                "drift": local - meta['remote_count'],
+                "verified_at": meta['verified_at']
+            })
+        return jsonify({"stores": report, "mismatched": [r['id'] for r in report if r['drift']]})
+    except Exception as e:
+        return jsonify({"stores": [], "error": str(e)})
+
+FILES_PAGE_SIZE = 100
+FILES_MAX_PAGE_SIZE = 1000
+
+def encode_page_token(sort, key):
+    raw = json.dumps({"sort": sort, "after": list(key)})
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii')
+
+def decode_page_token(token, sort):
+    data = json.loads(base64.urlsafe_b64decode(token.encode('ascii')))
+    if data['sort'] != sort:
+        raise ValueError("page_token belongs to a different sort")
+    return tuple(data['after'])
+
+def encode_remote_token(page_token):
+    raw = json.dumps({"remote": page_token})
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii')
+
+def decode_remote_token(token):
+    """The API page token inside one of our page tokens, or None for a manifest cursor."""
+    data = json.loads(base64.urlsafe_b64decode(token.encode('ascii')))
+    return data.get('remote')
+
+REMOTE_FILES_PAGE_MAX = 20 # documents.list caps page_size at 20
+
+def list_remote_files_page(store_id, page_size, page_token=None):
+    """One page of the store straight from the API, in the API's order, for when the
+    manifest isn't loaded yet. Returns (files, next API page token)."""
+    raw = get_client().raw.file_search_stores
+    files = []
+    while len(files) < page_size:
+        config = {'page_size': min(page_size - len(files), REMOTE_FILES_PAGE_MAX)}
+        if page_token:
+            config['page_token'] = page_token
+
+        def fetch():
+            with stage('file_search_stores.list_files'):
+                return raw.list_files(file_search_store_name=store_id, config=config)
+
+        pager = scheduler.call('file_search_stores', fetch)
+        files.extend({
+            "name": doc_display_name(f),
+            "id": f.name,
+            "uri": getattr(f, 'uri', None),
+            "size_bytes": getattr(f, 'size_bytes', None),
+        } for f in pager.page)
+        page_token = pager.config.get('page_token')
+        if not page_token:
+            break
+    return files, page_token
+
+def iter_store_files(keys, files, descending=False, after=None, query=None, min_size=None, max_size=None):
+    """Yields (key, file) in order, starting after the cursor key, applying the filters."""
+    if descending:
+        start = bisect.bisect_left(keys, after) if after is not None else len(files)
+        indexes = range(start - 1, -1, -1)
+    else:
+        start = bisect.bisect_right(keys, after) if after is not None else 0
+        indexes = range(start, len(files))
+
+    for i in indexes:
+        f = files[i]
+        size = f['size_bytes'] or 0
+        if query and query not in f['name'].casefold():
+            continue
+        if min_size is not None and size < min_size:
+            continue
+        if max_size is not None and size > max_size:
+            continue
+        yield keys[i], f
 
 @app.route('/api/store/<path:store_id>/files', methods=['GET'])
 def list_store_files(store_id):
+    """Cursor-paginated file listing served from the manifest cache.
+
+    Query args: page_size, page_token, q (name contains), min_size / max_size,
+    sort=name|size, order=asc|desc, format=ndjson (stream every match instead of a page),
+    refresh=1 (re-list the store first).
+
+    Without sort, filters or format, a store whose manifest isn't loaded yet is paged
+    straight from the API (in its order, "total" is null) while the manifest loads in
+    the background, so the first page of a big store doesn't wait for the whole listing.
+    """
     try:
-        client = get_client()
-        files = []
-        # Iterate over files in the store
-        # Note: Pagination might be needed for very large stores, this fetches default page size
-        for f in client.file_search_stores.list_files(file_search_store_name=store_id):
-             files.append({
-                 "name": f.config.display_name if (f.config and f.config.display_name) else f.name,
-                 "id": f.name,
-                 "uri": f.uri,
-                 "size_bytes": f.size_bytes,
-                 # "create_time": f.create_time # might be useful
-             })
-        
-        return jsonify({"files": files})
+        sort = request.args.get('sort', 'name')
+        if sort not in FILE_SORT_KEYS:
+            return jsonify({"files": [], "error": f"Unknown sort '{sort}'"}), 400
+        descending = request.args.get('order') == 'desc'
+        query = (request.args.get('q') or '').casefold() or None
+        min_size = request.args.get('min_size', type=int)
+        max_size = request.args.get('max_size', type=int)
+        page_size = min(max(request.args.get('page_size', FILES_PAGE_SIZE, type=int), 1), FILES_MAX_PAGE_SIZE)
+        token = request.args.get('page_token')
+        plain = not any(request.args.get(arg) for arg in ('sort', 'order', 'q', 'min_size', 'max_size', 'format', 'refresh'))
+        try:
+            remote_token = decode_remote_token(token) if token else None
+            after = decode_page_token(token, sort) if token and not remote_token else None
+        except Exception:
+            return jsonify({"files": [], "error": "Invalid page_token"}), 400
+
+        if plain and (remote_token or (not token and not manifest_loaded(store_id))):
+            # Once a listing started in API order it stays there, even if the manifest loads meanwhile
+            warm_manifest_async(store_id)
+            page, next_remote = run_sdk(list_remote_files_page, store_id, page_size, remote_token)
+            next_token = encode_remote_token(next_remote) if next_remote else None
+            return jsonify({"files": page, "next_page_token": next_token, "total": None})
+
+        keys, files = run_sdk(get_sorted_files, store_id, sort, refresh=request.args.get('refresh') in ('1', 'true'))
+        matches = iter_store_files(keys, files, descending, after, query, min_size, max_size)
+
+        if request.args.get('format') == 'ndjson':
+            def generate():
+                for _, f in matches:
+                    yield json.dumps(f) + "\n"
+            return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+        page = []
+        next_token = None
+        last_key = None
+        for key, f in matches:
+            if len(page) == page_size:
+                next_token = encode_page_token(sort, last_key)
+                break
+            page.append(f)
+            last_key = key
+
+        return jsonify({"files": page, "next_page_token": next_token, "total": len(files)})
+    except ServerBusyError as e:
+        return jsonify({"files": [], "error": str(e)}), 503
     except Exception as e:
         print(f"Error listing files: {e}")
         return jsonify({"files": [], "error": str(e)})
@@ -252,7 +1413,7 @@ def create_store():
     
     try:
         client = get_client()
-        store = client.file_search_stores.create(
+        store = run_sdk(client.file_search_stores.create,
             config={'display_name': name}
         )
         # Note: The 'name' arg in create might be resource ID or display name depending on version.
@@ -264,11 +1425,15 @@ def create_store():
         CURRENT_STORE_ID = store.name
         save_active_store_id(store.name)
         init_store_meta_local(store.name)
+        invalidate_stores_cache()
+        publish_event('stores')
         
         display_name = store.name
         if hasattr(store, 'display_name'): display_name = store.display_name
         
         return jsonify({"status": "success", "id": store.name, "name": display_name})
+    except ServerBusyError as e:
+        return jsonify({"error": str(e)}), 503
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
@@ -294,14 +1459,21 @@ def delete_store(store_id):
         # Typically the store.name is like "fileSearchStores/xxxx".
         # We should pass exactly what we have.
         
-        client.file_search_stores.delete(name=store_id, config={'force': True})
+        run_sdk(client.file_search_stores.delete, name=store_id, config={'force': True})
         
         if CURRENT_STORE_ID == store_id:
             CURRENT_STORE_ID = None
             save_active_store_id(None)
             
         delete_store_meta_local(store_id)
+        invalidate_manifest(store_id)
+        invalidate_stores_cache()
+        chat_cache.invalidate_store(store_id)
+        cancel_suggestions_refresh(store_id)
+        publish_event('stores')
         return jsonify({"status": "success"})
+    except ServerBusyError as e:
+        return jsonify({"error": str(e)}), 503
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
@@ -311,215 +1483,2073 @@ def shutdown():
     Timer(1.0, shutdown_server).start()
     return jsonify({"status": "success", "message": "Server shutting down..."})
 
-@app.route('/api/upload', methods=['POST'])
-def upload_file():
-    global CURRENT_STORE_ID
-    if 'file' not in request.files:
-        return jsonify({"error": "No file part"}), 400
-    file = request.files['file']
-    if file.filename == '':
-        return jsonify({"error": "No selected file"}), 400
-    
-    try:
-        client = get_client()
-        filename = secure_filename(file.filename)
-        filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        file.save(filepath)
+# --- Local Full-Text Index ---
+# Text extracted from every upload is kept in an FTS5 table in store_meta.db, so keyword
+# and "phrase" lookups ("which manual covers E42") are answered locally in milliseconds,
+# BM25-ranked with snippets, without a Gemini call. Updated on upload/replace, dropped with
+# the store, and pruned when a manifest reconcile finds documents deleted elsewhere.
+SEARCH_MAX_CHARS = int(os.getenv("SEARCH_MAX_CHARS", "2000000")) # Indexed text per document
+SEARCH_RESULTS = 20
+SEARCH_MAX_RESULTS = 100
+TEXT_EXTENSIONS = {'.txt', '.md', '.markdown', '.rst', '.csv', '.tsv', '.json', '.jsonl', '.xml', '.html', '.htm',
+                   '.yaml', '.yml', '.ini', '.cfg', '.toml', '.log', '.sql', '.py', '.js', '.ts', '.java', '.c',
+                   '.h', '.cpp', '.cs', '.go', '.rs', '.rb', '.php', '.sh', '.bat', '.ps1', '.css'}
+SNIPPET_START, SNIPPET_END = '\x02', '\x03' # Swapped for <mark> after HTML-escaping
+DOCX_NS = '{http://schemas.openxmlformats.org/wordprocessingml/2006/main}'
 
-        print(f"Uploading {filename}...")
-        # config name needs to be just the name, not valid resource name characters sometimes
-        # Let's keep it simple.
-        uploaded_file = client.files.upload(
-            file=filepath,
-            config={'display_name': filename} 
-        )
-        print(f"File uploaded: {uploaded_file.name}")
+def decode_text(data):
+    for encoding in ('utf-8-sig', 'cp949'):
+        try:
+            return data.decode(encoding)
+        except UnicodeDecodeError:
+            pass
+    return data.decode('latin-1')
 
-        if not CURRENT_STORE_ID:
-            # Try to auto-create if no stores exist at all? 
-            # Or just fail and tell user to create one?
-            # Let's fail gracefully to let UI handle "Please create a store"
-             return jsonify({"error": "No active store selected. Create or select a store first."}), 400
-            
-            # Legacy auto-create logic removed to enforce explicit store management
-        
-        print(f"Importing to {CURRENT_STORE_ID}...")
+def extract_pdf_pages(data, max_chars=None):
+    """Text of each page. Raises ImportError without pypdf."""
+    from pypdf import PdfReader
+    pages = []
+    total = 0
+    for page in PdfReader(io.BytesIO(data)).pages:
+        text = page.extract_text() or ''
+        pages.append(text)
+        total += len(text)
+        if max_chars and total >= max_chars:
+            break
+    return pages
 
-        # Check for existing file with same name in the store and delete it
-        try:
-            # Note: The SDK method names below are inferred from common patterns. 
-            # If list_files is not available directly, we might need a different approach.
-            # However, for a user-facing tool, handling this robustly is key.
-            # Let's try to list files.
-            existing_files = client.file_search_stores.list_files(file_search_store_name=CURRENT_STORE_ID)
-            for f in existing_files:
-                if f.config.display_name == filename: # Check display_name match
-                    print(f"Found existing file {filename} in store. Deleting...")
-                    client.file_search_stores.delete_file(
-                        file_search_store_name=CURRENT_STORE_ID,
-                        file_name=f.name
-                    )
-                    update_store_file_count_local(CURRENT_STORE_ID, -1)
-                    print("Deleted old version.")
-                    break
-        except Exception as e:
-            print(f"Warning during duplicate check: {e}")
-        
-        print(f"Importing to {CURRENT_STORE_ID}...")
-        operation = client.file_search_stores.import_file(
-            file_search_store_name=CURRENT_STORE_ID,
-            file_name=uploaded_file.name
-        )
+def extract_pdf_text(data):
+    try:
+        return "\n".join(extract_pdf_pages(data, SEARCH_MAX_CHARS))
+    except ImportError:
+        return None # pypdf is optional; PDFs are then searchable by name only
 
-        while not operation.done:
-            print("Waiting for indexing...")
-            time.sleep(1)
-            operation = client.operations.get(operation)
-        
-        print("Indexing done.")
-        update_store_file_count_local(CURRENT_STORE_ID, 1)
-        os.remove(filepath)
+def extract_docx_text(data):
+    with zipfile.ZipFile(io.BytesIO(data)) as docx:
+        root = ElementTree.fromstring(docx.read('word/document.xml'))
+    return "\n".join("".join(t.text or '' for t in p.iter(DOCX_NS + 't')) for p in root.iter(DOCX_NS + 'p'))
 
-        return jsonify({
-            "status": "success", 
-            "store_id": CURRENT_STORE_ID,
-            "filename": filename
-        })
+def can_extract_text(filename, mime_type=None):
+    ext = os.path.splitext(filename)[1].lower()
+    return ext in ('.pdf', '.docx') or ext in TEXT_EXTENSIONS or (mime_type or '').startswith('text/')
 
+def extract_text(data, filename, mime_type=None):
+    """Best-effort plain text of an upload, or None for formats we can't read."""
+    ext = os.path.splitext(filename)[1].lower()
+    try:
+        if ext == '.pdf':
+            text = extract_pdf_text(data)
+        elif ext == '.docx':
+            text = extract_docx_text(data)
+        elif ext in TEXT_EXTENSIONS or (mime_type or '').startswith('text/'):
+            text = decode_text(data)
+        else:
+            return None
     except Exception as e:
-        print(f"Error: {e}")
-        return jsonify({"error": str(e)}), 500
+        print(f"Could not extract text from {filename}: {e}")
+        return None
+    return text[:SEARCH_MAX_CHARS] if text else text
 
-@app.route('/api/chat', methods=['POST'])
-def chat():
-    global CURRENT_STORE_ID
-    data = request.json
-    message = data.get('message')
-    from_model = data.get('model', 'gemini-1.5-flash') # Default fallback
-    
-    system_instruction = data.get('system_instruction')
+def search_index_document(store_id, display_name, text, sha256=None, size_bytes=None):
+    """Adds or replaces a document. Documents without text are still findable by name."""
+    if not search_available:
+        return
+    with meta_transaction() as db:
+        row = db.execute("SELECT id FROM search_docs WHERE store_id = ? AND display_name = ?",
+                         (store_id, display_name)).fetchone()
+        if row:
+            doc_id = row[0]
+            db.execute("DELETE FROM search_text WHERE rowid = ?", (doc_id,))
+            db.execute("UPDATE search_docs SET sha256 = ?, size_bytes = ?, indexed_at = ? WHERE id = ?",
+                       (sha256, size_bytes, time.time(), doc_id))
+        else:
+            doc_id = db.execute("INSERT INTO search_docs (store_id, display_name, sha256, size_bytes, indexed_at) VALUES (?, ?, ?, ?, ?)",
+                                (store_id, display_name, sha256, size_bytes, time.time())).lastrowid
+        db.execute("INSERT INTO search_text (rowid, display_name, body) VALUES (?, ?, ?)",
+                   (doc_id, display_name, text or ''))
 
-    if not CURRENT_STORE_ID:
-        return jsonify({"error": "Please select a Knowledge Base first."}), 400
+def search_remove_document(store_id, display_name):
+    if not search_available:
+        return
+    with meta_transaction() as db:
+        row = db.execute("SELECT id FROM search_docs WHERE store_id = ? AND display_name = ?",
+                         (store_id, display_name)).fetchone()
+        if row:
+            db.execute("DELETE FROM search_text WHERE rowid = ?", (row[0],))
+            db.execute("DELETE FROM search_docs WHERE id = ?", (row[0],))
 
-    try:
-        client = get_client()
-        
-        tool = types.Tool(
-            file_search=types.FileSearch(
-                file_search_store_names=[CURRENT_STORE_ID]
-            )
-        )
-        
-        # Configure generation
-        config = types.GenerateContentConfig(
-            tools=[tool],
-            system_instruction=system_instruction if system_instruction else None
-        )
+def search_prune_store(store_id, keep_names, before):
+    """Drops documents indexed before `before` that are no longer in the store."""
+    if not search_available:
+        return
+    rows = meta_db().execute("SELECT display_name FROM search_docs WHERE store_id = ? AND indexed_at < ?",
+                             (store_id, before)).fetchall()
+    for (name,) in rows:
+        if name not in keep_names:
+            search_remove_document(store_id, name)
 
-        response = client.models.generate_content(
-            model=from_model,
-            contents=message,
-            config=config
+def build_match_query(text, match_all=True):
+    """User input -> FTS5 MATCH expression. "Quoted phrases" stay phrases, every other word
+    is quoted (so FTS syntax characters are harmless) and a trailing * keeps prefix search."""
+    terms = []
+    for phrase, word in re.findall(r'"([^"]*)"|(\S+)', text):
+        prefix = word.endswith('*')
+        term = (phrase or word).replace('"', '').rstrip('*')
+        if any(c.isalnum() for c in term):
+            terms.append(f'"{term}"' + ('*' if prefix else ''))
+    return (' AND ' if match_all else ' OR ').join(terms)
+
+def search_store(store_id, text, limit=SEARCH_RESULTS, match_all=True):
+    query = build_match_query(text, match_all)
+    if not query:
+        return []
+    rows = meta_db().execute("""
+        SELECT d.display_name, d.size_bytes, bm25(search_text, 5.0, 1.0) AS rank,
+               snippet(search_text, 1, ?, ?, '…', 16)
+        FROM search_text JOIN search_docs d ON d.id = search_text.rowid
+        WHERE search_text MATCH ? AND d.store_id = ?
+        ORDER BY rank LIMIT ?
+    """, (SNIPPET_START, SNIPPET_END, query, store_id, limit)).fetchall()
+    return [{
+        "name": name,
+        "size_bytes": size,
+        "score": round(-rank, 4), # bm25() is lower-is-better
+        "snippet": html.escape(snippet or '').replace(SNIPPET_START, '<mark>').replace(SNIPPET_END, '</mark>'),
+    } for name, size, rank, snippet in rows]
+
+@app.route('/api/store/<path:store_id>/search', methods=['GET'])
+def search_store_files(store_id):
+    """Local keyword search: ?q=words or "a phrase", limit, match=all|any (default all)."""
+    text = (request.args.get('q') or '').strip()
+    if not text:
+        return jsonify({"results": [], "error": "q required"}), 400
+    if not search_available:
+        return jsonify({"results": [], "error": "Local search is not available (SQLite without FTS5)"}), 501
+    limit = min(max(request.args.get('limit', SEARCH_RESULTS, type=int), 1), SEARCH_MAX_RESULTS)
+    started = time.perf_counter()
+    try:
+        with stage('local_search'):
+            results = search_store(store_id, text, limit, request.args.get('match') != 'any')
+    except sqlite3.OperationalError as e:
+        return jsonify({"results": [], "error": f"Invalid query: {e}"}), 400
+    return jsonify({"query": text, "results": results,
+                    "took_ms": round((time.perf_counter() - started) * 1000, 2)})
+
+# --- Pre-processing ---
+# Optional stage (PREPROCESS=1) in front of the Files API upload: PDFs and Office files are
+# turned into plain text locally, with images and page furniture (running headers/footers,
+# page numbers) dropped, and that much smaller text is uploaded in their place. Extraction
+# is CPU-bound, so it runs in a process pool. Scanned (image-only) documents, extraction
+# failures and files that wouldn't shrink enough are uploaded as they are.
+PREPROCESS = os.getenv("PREPROCESS", "0").lower() in ('1', 'true', 'yes')
+PREPROCESS_WORKERS = int(os.getenv("PREPROCESS_WORKERS", "0")) or os.cpu_count() or 2
+PREPROCESS_MIN_BYTES = int(os.getenv("PREPROCESS_MIN_BYTES", str(256 * 1024))) # Smaller files go as they are
+PREPROCESS_MAX_RATIO = float(os.getenv("PREPROCESS_MAX_RATIO", "0.8")) # Text must be at most this share of the original
+PREPROCESS_MIN_CHARS_PER_PAGE = 100 # Less text than this per page looks like a scan
+PREPROCESS_TIMEOUT = 300
+PREPROCESS_EXTENSIONS = ('.pdf', '.docx', '.pptx')
+INDEX_RATE_MIN_SAMPLES = 8 # Originals indexed before index_seconds_saved_est is reported
+INDEX_RATE_MIN_SPREAD = 0.25 # ...whose sizes vary by at least this share of their mean
+INDEX_SAVED_METHOD = ("bytes saved x the per-byte indexing time of a linear fit (fixed per-file cost + "
+                      "per-byte cost) over recent originals; null until enough originals of varied size")
+BOILERPLATE_MIN_PAGES = 3
+BOILERPLATE_PAGE_SHARE = 0.6 # A line on at least this share of pages is a header/footer
+BOILERPLATE_EDGE_LINES = 2 # Headers/footers are looked for in the first and last lines of a page
+PAGE_NUMBER_LINE = re.compile(r'^\s*(page\s*)?\d{1,4}(\s*(/|of)\s*\d{1,4})?\s*$', re.IGNORECASE)
+PPTX_NS = '{http://schemas.openxmlformats.org/drawingml/2006/main}'
+
+def extract_pptx_pages(data):
+    with zipfile.ZipFile(io.BytesIO(data)) as pptx:
+        slides = [n for n in pptx.namelist() if re.fullmatch(r'ppt/slides/slide\d+\.xml', n)]
+        slides.sort(key=lambda n: int(re.search(r'\d+', n.rsplit('/', 1)[1]).group()))
+        pages = []
+        for name in slides:
+            root = ElementTree.fromstring(pptx.read(name))
+            pages.append("\n".join("".join(t.text or '' for t in p.iter(PPTX_NS + 't'))
+                                   for p in root.iter(PPTX_NS + 'p')))
+    return pages
+
+def boilerplate_key(line):
+    return re.sub(r'\d+', '#', line.strip().casefold())
+
+def page_edges(lines):
+    """Indexes of the lines that can be a running header or footer."""
+    if len(lines) <= BOILERPLATE_EDGE_LINES * 2:
+        return set()
+    return set(range(BOILERPLATE_EDGE_LINES)) | set(range(len(lines) - BOILERPLATE_EDGE_LINES, len(lines)))
+
+def strip_boilerplate(pages):
+    """Drops page-number lines and header/footer lines repeated on most pages.
+    Returns (pages, removed line count)."""
+    pages = [[line for line in page.splitlines() if line.strip()] for page in pages]
+    repeated = set()
+    if len(pages) >= BOILERPLATE_MIN_PAGES:
+        seen = {}
+        for lines in pages:
+            for key in {boilerplate_key(lines[i]) for i in page_edges(lines)}:
+                seen[key] = seen.get(key, 0) + 1
+        repeated = {key for key, count in seen.items() if count >= len(pages) * BOILERPLATE_PAGE_SHARE}
+
+    removed = 0
+    cleaned = []
+    for lines in pages:
+        edges = page_edges(lines)
+        kept = []
+        for i, line in enumerate(lines):
+            if PAGE_NUMBER_LINE.match(line) or (i in edges and boilerplate_key(line) in repeated):
+                removed += 1
+                continue
+            kept.append(line)
+        cleaned.append("\n".join(kept))
+    return cleaned, removed
+
+def normalize_text(text):
+    text = re.sub(r'[ \t ]+', ' ', text)
+    text = re.sub(r' *\n *', '\n', text)
+    return re.sub(r'\n{3,}', '\n\n', text).strip()
+
+def preprocess_document(data, filename):
+    """Runs in a worker process: the document as normalized plain text, with page markers."""
+    started = time.perf_counter()
+    ext = os.path.splitext(filename)[1].lower()
+    try:
+        if ext == '.pdf':
+            pages = extract_pdf_pages(data)
+        elif ext == '.pptx':
+            pages = extract_pptx_pages(data)
+        else:
+            pages = [extract_docx_text(data)]
+    except ImportError as e:
+        return {"error": f"missing optional dependency: {e.name}"}
+    except Exception as e:
+        return {"error": f"extraction failed: {e}"}
+
+    pages, removed = strip_boilerplate(pages)
+    label = "Slide" if ext == '.pptx' else "Page"
+    parts = []
+    for number, page in enumerate(pages, 1):
+        page = normalize_text(page)
+        if page:
+            parts.append(f"[{label} {number}]\n{page}" if len(pages) > 1 else page)
+    text = "\n\n".join(parts)
+    return {"text": text, "pages": len(pages), "removed_lines": removed,
+            "chars": len(text), "seconds": round(time.perf_counter() - started, 3)}
+
+preprocess_pool = None
+preprocess_pool_lock = threading.Lock()
+
+def get_preprocess_pool():
+    global preprocess_pool
+    with preprocess_pool_lock:
+        if preprocess_pool is None:
+            preprocess_pool = ProcessPoolExecutor(max_workers=PREPROCESS_WORKERS)
+        return preprocess_pool
+
+def reset_preprocess_pool(pool):
+    """Drops a pool whose worker died so the next file starts a fresh one."""
+    global preprocess_pool
+    with preprocess_pool_lock:
+        if preprocess_pool is pool:
+            preprocess_pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+def stop_preprocess_pool():
+    """Ends the worker processes. os._exit skips the pool's own cleanup, which would leave them running."""
+    global preprocess_pool
+    with preprocess_pool_lock:
+        pool, preprocess_pool = preprocess_pool, None
+    if pool is None:
+        return
+    workers = list((pool._processes or {}).values())
+    pool.shutdown(wait=False, cancel_futures=True)
+    for worker in workers:
+        worker.terminate()
+    for worker in workers:
+        worker.join(1)
+
+def preprocess_upload(spool, filename):
+    """Returns (text bytes to upload instead of the original or None, extracted text or None, report for the job)."""
+    ext = os.path.splitext(filename)[1].lower()
+    report = {"applied": False, "original_bytes": spool.size, "uploaded_bytes": spool.size, "bytes_saved": 0}
+    if ext not in PREPROCESS_EXTENSIONS or spool.size < PREPROCESS_MIN_BYTES:
+        report['reason'] = "not eligible"
+        return None, None, report
+
+    pool = get_preprocess_pool()
+    try:
+        with stage('preprocess'):
+            result = pool.submit(preprocess_document, spool.rewind().read(), filename).result(timeout=PREPROCESS_TIMEOUT)
+    except BrokenProcessPool as e:
+        reset_preprocess_pool(pool)
+        result = {"error": f"worker process died: {e}"}
+    except Exception as e:
+        result = {"error": f"{type(e).__name__}: {e}"}
+
+    report.update({k: result[k] for k in ('pages', 'removed_lines', 'seconds') if k in result})
+    if result.get('error'):
+        report['reason'] = result['error']
+        metrics.inc('preprocess_total', result='failed')
+        return None, None, report
+
+    payload = result['text'].encode('utf-8')
+    if result['chars'] < PREPROCESS_MIN_CHARS_PER_PAGE * max(1, result['pages']):
+        report['reason'] = "little text found (scanned?); uploading the original"
+    elif len(payload) > spool.size * PREPROCESS_MAX_RATIO:
+        report['reason'] = "text is not much smaller than the original"
+    else:
+        report.update(applied=True, uploaded_bytes=len(payload), bytes_saved=spool.size - len(payload))
+        metrics.inc('preprocess_total', result='applied')
+        metrics.inc('preprocess_bytes_saved_total', report['bytes_saved'])
+        return payload, result['text'], report
+    metrics.inc('preprocess_total', result='kept_original')
+    return None, None, report
+
+class IndexRate:
+    """Fit of remote indexing time against uploaded size over recent originals:
+    seconds = fixed + per_byte * size, with older samples decaying. Indexing is mostly a
+    fixed per-file cost, which a smaller upload still pays, so only the size-dependent
+    part (per_byte * bytes saved) counts as saved. No estimate until INDEX_RATE_MIN_SAMPLES
+    originals of sufficiently different sizes have been indexed."""
+
+    def __init__(self, decay=0.95, min_samples=INDEX_RATE_MIN_SAMPLES):
+        self.decay = decay
+        self.min_samples = min_samples
+        self.samples = 0
+        self.n = self.sx = self.sy = self.sxx = self.sxy = 0.0 # Decayed regression sums
+        self.lock = threading.Lock()
+
+    def observe(self, seconds, size):
+        if size <= 0:
+            return
+        with self.lock:
+            d = self.decay
+            self.n = self.n * d + 1
+            self.sx = self.sx * d + size
+            self.sy = self.sy * d + seconds
+            self.sxx = self.sxx * d + size * size
+            self.sxy = self.sxy * d + size * seconds
+            self.samples += 1
+
+    def fit(self):
+        """(fixed seconds, seconds per byte), or None while the samples can't separate the two."""
+        with self.lock:
+            if self.samples < self.min_samples:
+                return None
+            mean_x, mean_y = self.sx / self.n, self.sy / self.n
+            var_x = self.sxx / self.n - mean_x * mean_x
+            if var_x <= (INDEX_RATE_MIN_SPREAD * mean_x) ** 2:
+                return None # All originals about the same size
+            per_byte = max(0.0, (self.sxy / self.n - mean_x * mean_y) / var_x)
+            return mean_y - per_byte * mean_x, per_byte
+
+    def estimate(self, bytes_saved):
+        fit = self.fit()
+        return round(fit[1] * bytes_saved, 2) if fit else None
+
+index_rate = IndexRate()
+
+# --- Background Ingestion ---
+# Uploads are spooled by the request (see UploadSpool), then handed to a bounded worker pool.
+# Each file gets a job id the UI can poll: staged -> uploading -> indexing -> done / failed.
+# Workers only upload + import; a single poller thread then tracks all pending import operations.
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", "4")) # Max parallel Files API uploads
+INDEX_POLL_MIN = float(os.getenv("INDEX_POLL_MIN", "0.5"))
+INDEX_POLL_MAX = float(os.getenv("INDEX_POLL_MAX", "10"))
+INDEX_POLL_BACKOFF = 1.5
+INDEX_POLL_MAX_ERRORS = 5 # Consecutive operations.get failures before a job is failed
+JOB_RETENTION = 3600 # Seconds to keep finished jobs around for polling
+
+ingest_executor = ThreadPoolExecutor(max_workers=INGEST_WORKERS, thread_name_prefix="ingest",
+                                     initializer=background_thread)
+JOBS = {}
+BATCHES = {}
+jobs_lock = threading.Lock()
+jobs_changed = threading.Condition(jobs_lock)
+
+JOB_FINAL_STATES = ('done', 'skipped', 'failed')
+
+def prune_jobs():
+    """Drops finished jobs older than JOB_RETENTION. Caller must hold jobs_lock."""
+    cutoff = time.time() - JOB_RETENTION
+    for job_id in [j for j, job in JOBS.items() if job['status'] in JOB_FINAL_STATES and job['updated_at'] < cutoff]:
+        job = JOBS.pop(job_id)
+        batch = BATCHES.get(job['batch_id'])
+        if batch is not None:
+            batch.discard(job_id)
+            if not batch:
+                del BATCHES[job['batch_id']]
+
+def create_job(filename, store_id, batch_id=None):
+    now = time.time()
+    job = {
+        "id": uuid.uuid4().hex,
+        "batch_id": batch_id or uuid.uuid4().hex,
+        "filename": filename,
+        "store_id": store_id,
+        "status": "staged",
+        "request_id": current_request_id(),
+        "action": None, # new / replaced / skipped, decided from the content hash
+        "duplicate_of": None, # Same content already stored under another name
+        "preprocess": None, # Pre-processing report (PREPROCESS=1): bytes saved or why the original was kept
+        "index_seconds": None,
+        "index_seconds_saved_est": None,
+        "error": None,
+        "created_at": now,
+        "updated_at": now,
+    }
+    with jobs_lock:
+        prune_jobs()
+        JOBS[job['id']] = job
+        BATCHES.setdefault(job['batch_id'], set()).add(job['id'])
+    return dict(job)
+
+def update_job(job_id, **fields):
+    with jobs_lock:
+        job = JOBS.get(job_id)
+        if job is None:
+            return
+        if fields.get('status') in JOB_FINAL_STATES and job['status'] not in JOB_FINAL_STATES:
+            metrics.inc('ingest_jobs_total', status=fields['status'])
+            metrics.observe('ingest_job_seconds', time.time() - job['created_at'], status=fields['status'])
+        status_changed = 'status' in fields and fields['status'] != job['status']
+        job.update(fields)
+        job['updated_at'] = time.time()
+        jobs_changed.notify_all()
+        if not status_changed:
+            return
+        event = {k: job[k] for k in ('id', 'batch_id', 'status', 'filename', 'store_id', 'error', 'action')}
+        batch_done = all(JOBS[j]['status'] in JOB_FINAL_STATES for j in BATCHES.get(job['batch_id'], ()) if j in JOBS)
+
+    if event['status'] in JOB_FINAL_STATES:
+        release_name(event['store_id'], event['filename'], event['id'])
+    publish_event('job', **event)
+    if batch_done:
+        batch = get_batch(event['batch_id'])
+        if batch:
+            publish_event('batch', **{k: batch[k] for k in ('batch_id', 'finished', 'counts', 'summary')})
+
+# Jobs for the same document name in a store run one after another: a later upload of
+# a.txt is parked until the earlier one has finished indexing (and is in the manifest), so
+# it replaces that document instead of adding a second one next to it.
+names_in_flight = {} # (store_id, display_name) -> id of the job that holds the name
+parked_jobs = {} # (store_id, display_name) -> deque of (executor, args, kwargs) waiting for it
+names_lock = threading.Lock()
+
+def name_in_flight(store_id, display_name):
+    with names_lock:
+        return (store_id, display_name) in names_in_flight
+
+def submit_ingest(job_id, spool, filename, store_id, mime_type, request_id=None, deferred_check=False, executor=None):
+    """Hands the job to ingest_file on executor (default ingest_executor), or parks it behind
+    the job already in flight for the same name. A parked job re-checks the manifest
+    when it runs, since the earlier upload may have made it a no-op."""
+    executor = executor or ingest_executor
+    key = (store_id, filename)
+    with names_lock:
+        if key in names_in_flight:
+            parked_jobs.setdefault(key, deque()).append(
+                (executor, (job_id, spool, filename, store_id, mime_type, request_id), {"deferred_check": True}))
+            print(f"Queued {filename} behind an earlier upload of the same name.")
+            return
+        names_in_flight[key] = job_id
+    executor.submit(ingest_file, job_id, spool, filename, store_id, mime_type, request_id, deferred_check=deferred_check)
+
+def release_name(store_id, filename, job_id):
+    """Called when a job reaches a final state: starts the next parked job for the name."""
+    key = (store_id, filename)
+    with names_lock:
+        if names_in_flight.get(key) != job_id:
+            return # Not submitted through submit_ingest (e.g. skipped in the request)
+        waiting = parked_jobs.get(key)
+        if not waiting:
+            parked_jobs.pop(key, None)
+            del names_in_flight[key]
+            return
+        executor, args, kwargs = waiting.popleft()
+        names_in_flight[key] = args[0]
+    executor.submit(ingest_file, *args, **kwargs)
+
+def get_job(job_id):
+    with jobs_lock:
+        job = JOBS.get(job_id)
+        return dict(job) if job else None
+
+def get_batch(batch_id):
+    with jobs_lock:
+        job_ids = BATCHES.get(batch_id)
+        if job_ids is None:
+            return None
+        jobs = sorted((dict(JOBS[j]) for j in job_ids if j in JOBS), key=lambda j: j['created_at'])
+
+    counts = {}
+    summary = {"new": 0, "replaced": 0, "skipped": 0, "duplicates": 0,
+               "preprocessed": 0, "bytes_saved": 0, "index_seconds_saved_est": None,
+               "index_seconds_saved_method": INDEX_SAVED_METHOD}
+    for job in jobs:
+        counts[job['status']] = counts.get(job['status'], 0) + 1
+        if job['action'] in summary:
+            summary[job['action']] += 1
+        if job['duplicate_of']:
+            summary['duplicates'] += 1
+        if job['preprocess'] and job['preprocess']['applied']:
+            summary['preprocessed'] += 1
+            summary['bytes_saved'] += job['preprocess']['bytes_saved']
+            if job['index_seconds_saved_est'] is not None:
+                summary['index_seconds_saved_est'] = round((summary['index_seconds_saved_est'] or 0) + job['index_seconds_saved_est'], 2)
+    return {
+        "batch_id": batch_id,
+        "jobs": jobs,
+        "counts": counts,
+        "summary": summary,
+        "finished": all(j['status'] in JOB_FINAL_STATES for j in jobs),
+    }
+
+def wait_for_batch(batch_id, timeout=None):
+    """Blocks until every job in the batch reached a final state (or timeout)."""
+    deadline = time.time() + timeout if timeout else None
+    with jobs_lock:
+        while True:
+            job_ids = BATCHES.get(batch_id, ())
+            if all(JOBS[j]['status'] in JOB_FINAL_STATES for j in job_ids if j in JOBS):
+                break
+            remaining = deadline - time.time() if deadline else None
+            if remaining is not None and remaining <= 0:
+                break
+            jobs_changed.wait(remaining)
+    return get_batch(batch_id)
+
+class OperationPoller:
+    """Single background thread polling every pending import operation.
+
+    Each operation starts at INDEX_POLL_MIN and backs off towards INDEX_POLL_MAX
+    while it is not done, so a large batch costs one thread and few requests
+    instead of one sleeping worker per file.
+    """
+
+    def __init__(self):
+        self.pending = [] # [next_check, seq, entry]
+        self.seq = 0
+        self.cond = threading.Condition()
+        self.thread = None
+
+    def track(self, operation, on_done, on_error):
+        with self.cond:
+            self.seq += 1
+            entry = {"operation": operation, "on_done": on_done, "on_error": on_error,
+                     "interval": INDEX_POLL_MIN, "errors": 0,
+                     "request_id": current_request_id(), "started": time.perf_counter()}
+            self.pending.append([time.time() + INDEX_POLL_MIN, self.seq, entry])
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run, name="operation-poller", daemon=True)
+                self.thread.start()
+            self.cond.notify()
+
+    def size(self):
+        with self.cond:
+            return len(self.pending)
+
+    def run(self):
+        set_call_priority(BACKGROUND)
+        while True:
+            with self.cond:
+                while not self.pending:
+                    self.cond.wait()
+                self.pending.sort()
+                delay = self.pending[0][0] - time.time()
+                if delay > 0:
+                    self.cond.wait(delay)
+                    continue
+                now = time.time()
+                due = [p for p in self.pending if p[0] <= now]
+                self.pending = [p for p in self.pending if p[0] > now]
+
+            for _, seq, entry in due:
+                if self.poll(entry):
+                    entry['interval'] = min(entry['interval'] * INDEX_POLL_BACKOFF, INDEX_POLL_MAX)
+                    with self.cond:
+                        self.pending.append([time.time() + entry['interval'], seq, entry])
+
+    def poll(self, entry):
+        """Returns True if the operation should be polled again."""
+        set_request_id(entry['request_id'])
+        try:
+            operation = get_client().operations.get(entry['operation'])
+            entry['errors'] = 0
+        except Exception as e:
+            entry['errors'] += 1
+            print(f"Warning polling operation: {e}")
+            if entry['errors'] < INDEX_POLL_MAX_ERRORS:
+                return True
+            entry['on_error'](e)
+            return False
+
+        entry['operation'] = operation
+        if not operation.done:
+            return True
+        elapsed = time.perf_counter() - entry['started']
+        metrics.observe('stage_seconds', elapsed, stage='index_wait')
+        metrics.trace('index_wait', elapsed)
+        try:
+            if getattr(operation, 'error', None):
+                entry['on_error'](Exception(str(operation.error)))
+            else:
+                entry['on_done'](operation)
+        except Exception as e:
+            print(f"Error in operation callback: {e}")
+        return False
+
+operation_poller = OperationPoller()
+
+def delete_store_document(store_id, display_name, document):
+    """Deletes one document from the store and from every local view of it."""
+    get_client().file_search_stores.delete_file(
+        file_search_store_name=store_id,
+        file_name=document
+    )
+    manifest_remove(store_id, display_name)
+    search_remove_document(store_id, display_name)
+    update_store_file_count_local(store_id, -1)
+    on_store_changed(store_id)
+
+def ingest_file(job_id, spool, filename, store_id, mime_type, request_id=None, deferred_check=False):
+    """Worker body: upload a spooled file, replace any same-named document and start the import.
+    With deferred_check the request left the unchanged/duplicate check to us (see stage_upload)."""
+    set_request_id(request_id)
+    try:
+        if deferred_check and skip_if_unchanged(job_id, spool, filename, store_id):
+            return
+        client = get_client()
+
+        payload, text, report = None, None, None
+        if PREPROCESS:
+            update_job(job_id, status='preprocessing')
+            payload, text, report = preprocess_upload(spool, filename)
+            update_job(job_id, preprocess=report)
+            if payload is not None:
+                print(f"Pre-processed {filename}: {report['original_bytes']} -> {report['uploaded_bytes']} bytes")
+
+        update_job(job_id, status='uploading')
+        print(f"Uploading {filename}...")
+        # config name needs to be just the name, not valid resource name characters sometimes
+        # Let's keep it simple.
+        uploaded_file = client.files.upload(
+            file=io.BytesIO(payload) if payload is not None else spool.rewind(),
+            config={'display_name': filename, 'mime_type': 'text/plain' if payload is not None else mime_type}
+        )
+        uploaded_size = len(payload) if payload is not None else spool.size
+        print(f"File uploaded: {uploaded_file.name}")
+
+        # Extract text for the local search index while the bytes are still at hand
+        if text is None and can_extract_text(filename, mime_type):
+            with stage('extract_text'):
+                text = extract_text(spool.rewind().read(), filename, mime_type)
+        elif text is not None:
+            text = text[:SEARCH_MAX_CHARS]
+
+        # Check for existing file with same name in the store and delete it
+        try:
+            with stage('duplicate_check'):
+                existing = manifest_lookup(store_id, filename)
+            if existing:
+                print(f"Found existing file {filename} in store. Deleting...")
+                delete_store_document(store_id, filename, existing['document'])
+                print("Deleted old version.")
+        except Exception as e:
+            print(f"Warning during duplicate check: {e}")
+
+        update_job(job_id, status='indexing')
+        print(f"Importing to {store_id}...")
+        import_started = time.time()
+        operation = client.file_search_stores.import_file(
+            file_search_store_name=store_id,
+            file_name=uploaded_file.name
         )
-        
-        # Extract citations if available
-        citations = []
-        if response.candidates and response.candidates[0].citation_metadata:
-             for citation in response.candidates[0].citation_metadata.citation_sources:
-                 start = citation.start_index if citation.start_index is not None else 0
-                 end = citation.end_index if citation.end_index is not None else 0
-                 uri = citation.uri
-                 # Try to get display name from uri if possible, or just send uri
-                 # The UI can map URIs to names if we have the file list, 
-                 # but for now let's just send what we have.
-                 citations.append({
-                     "uri": uri,
-                     "startIndex": start,
-                     "endIndex": end
-                 })
+
+        def on_done(operation):
+            print(f"Indexing done: {filename}")
+            index_seconds = round(time.time() - import_started, 2)
+            if payload is None:
+                index_rate.observe(index_seconds, uploaded_size)
+                update_job(job_id, index_seconds=index_seconds)
+            else:
+                update_job(job_id, index_seconds=index_seconds,
+                           index_seconds_saved_est=index_rate.estimate(report['bytes_saved']))
+            document = getattr(operation.response, 'document_name', None) if operation.response else None
+            if document:
+                manifest_put(store_id, filename, {"document": document, "uri": None,
+                                                  "size_bytes": uploaded_size, "sha256": spool.sha256})
+            else:
+                invalidate_manifest(store_id) # Can't tell which document it became; re-list on next read
+            try:
+                search_index_document(store_id, filename, text, spool.sha256, spool.size)
+            except Exception as e:
+                print(f"Warning indexing {filename} for local search: {e}")
+            update_store_file_count_local(store_id, 1)
+            on_store_changed(store_id)
+            update_job(job_id, status='done')
+
+        def on_error(e):
+            print(f"Error indexing {filename}: {e}")
+            update_job(job_id, status='failed', error=str(e))
+
+        # The upload is done with the bytes; free them before the (long) index wait
+        spool.discard()
+        operation_poller.track(operation, on_done, on_error)
+
+    except Exception as e:
+        print(f"Error ingesting {filename}: {e}")
+        spool.discard()
+        update_job(job_id, status='failed', error=str(e))
+
+# --- Upload Spooling ---
+# Werkzeug writes each multipart file straight into an UploadSpool: memory up to
+# UPLOAD_SPOOL_MEMORY, an anonymous temp file in UPLOAD_FOLDER beyond that (the OS removes
+# it once closed, even after a crash). The SHA-256 is computed as the bytes arrive and the
+# worker uploads from the spool itself, so nothing is re-written or re-read from uploads/.
+# Requests reserve their Content-Length against UPLOAD_MAX_INFLIGHT_BYTES before the body
+# is read; each job keeps its file's share until the Files API upload is done.
+UPLOAD_SPOOL_MEMORY = int(os.getenv("UPLOAD_SPOOL_MEMORY", str(8 * 1024 * 1024)))
+UPLOAD_MAX_INFLIGHT_BYTES = int(os.getenv("UPLOAD_MAX_INFLIGHT_BYTES", str(1024 * 1024 * 1024)))
+UPLOAD_BUDGET_WAIT = float(os.getenv("UPLOAD_BUDGET_WAIT", "30")) # Seconds a request may wait for room
+
+class ByteBudget:
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.used = 0
+        self.cond = threading.Condition()
+
+    def acquire(self, amount, timeout=None):
+        with self.cond:
+            return self.cond.wait_for(lambda: self.used + amount <= self.capacity, timeout) and self._take(amount)
+
+    def _take(self, amount):
+        self.used += amount
+        return True
+
+    def release(self, amount):
+        if amount <= 0:
+            return
+        with self.cond:
+            self.used = max(0, self.used - amount)
+            self.cond.notify_all()
+
+upload_budget = ByteBudget(UPLOAD_MAX_INFLIGHT_BYTES)
+
+class UploadSpool(io.IOBase):
+    def __init__(self):
+        self.buffer = tempfile.SpooledTemporaryFile(max_size=UPLOAD_SPOOL_MEMORY, dir=app.config['UPLOAD_FOLDER'])
+        self.digest = hashlib.sha256()
+        self.size = 0
+        self.owned = False # Set once a job takes over; the request then no longer closes it
+        self.reserved = 0 # Bytes of upload_budget released on discard
+        self.discarded = False
+        self.mode = 'w+b'
+
+    def readable(self):
+        return True
+
+    def writable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def write(self, data):
+        self.digest.update(data)
+        self.size += len(data)
+        return self.buffer.write(data)
+
+    def read(self, size=-1):
+        return self.buffer.read(size)
+
+    def readline(self, size=-1):
+        return self.buffer.readline(size)
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        return self.buffer.seek(offset, whence)
+
+    def tell(self):
+        return self.buffer.tell()
+
+    def rewind(self):
+        self.buffer.seek(0)
+        return self
+
+    @property
+    def sha256(self):
+        return self.digest.hexdigest()
+
+    def close(self):
+        # Werkzeug closes request files when the request ends
+        if not self.owned:
+            self.discard()
+
+    def discard(self):
+        """Drops the bytes (and their share of the in-flight budget). Safe to call twice."""
+        if self.discarded:
+            return
+        self.discarded = True
+        self.buffer.close()
+        upload_budget.release(self.reserved)
+        super().close()
+
+class UploadRequest(Request):
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return UploadSpool()
+
+app.request_class = UploadRequest
+
+class UploadTooLarge(Exception):
+    pass
+
+class UploadLengthRequired(Exception):
+    pass
+
+class upload_reservation:
+    """Reserves the request's Content-Length against the in-flight budget; stage_upload moves
+    each file's share onto its spool and whatever is left is released on exit. A chunked
+    body without a Content-Length can't be reserved up front, so it is refused (browsers
+    always send the length for form uploads)."""
+
+    def __enter__(self):
+        if request.content_length is None:
+            raise UploadLengthRequired("Uploads need a Content-Length header.")
+        self.held = request.content_length
+        if self.held > UPLOAD_MAX_INFLIGHT_BYTES:
+            raise UploadTooLarge(f"Upload of {self.held} bytes exceeds the {UPLOAD_MAX_INFLIGHT_BYTES} byte limit.")
+        if not upload_budget.acquire(self.held, UPLOAD_BUDGET_WAIT):
+            raise ServerBusyError("Too many uploads in flight, try again shortly.")
+        return self
+
+    def hand_over(self, spool):
+        spool.reserved = min(spool.size, self.held)
+        self.held -= spool.reserved
+
+    def __exit__(self, *exc):
+        upload_budget.release(self.held)
+        self.held = 0
+def clean_upload_folder():
+    """Startup janitor: removes files staged in uploads/ by older versions or killed runs."""
+    folder = app.config['UPLOAD_FOLDER']
+    removed = 0
+    for name in os.listdir(folder):
+        path = os.path.join(folder, name)
+        try:
+            if os.path.isfile(path):
+                os.remove(path)
+                removed += 1
+        except OSError as e:
+            print(f"Could not remove stale upload {name}: {e}")
+    if removed:
+        print(f"Removed {removed} stale staged upload(s) from {folder}")
+
+def stage_upload(file, store_id, reservation, batch_id=None):
+    """Queues a spooled upload for ingestion, unless the store already holds
+    identical content under the same name."""
+    filename = secure_filename(file.filename)
+    job = create_job(filename, store_id, batch_id)
+    spool = file.stream
+    reservation.hand_over(spool)
+    metrics.inc('upload_bytes_total', spool.size)
+
+    # The first upload to a store since start would have to list the whole store here;
+    # instead the listing starts in the background and the worker makes the check. Same
+    # when an earlier upload of this name is still indexing: its outcome decides ours.
+    deferred_check = not manifest_loaded(store_id) or name_in_flight(store_id, filename)
+    if not manifest_loaded(store_id):
+        warm_manifest_async(store_id)
+    elif not deferred_check and skip_if_unchanged(job['id'], spool, filename, store_id):
+        return get_job(job['id'])
+
+    mime_type = mimetypes.guess_type(filename)[0] or file.mimetype or 'application/octet-stream'
+    spool.owned = True # From here on the job discards it
+    submit_ingest(job['id'], spool, filename, store_id, mime_type, current_request_id(), deferred_check=deferred_check)
+    return get_job(job['id'])
+
+def skip_if_unchanged(job_id, spool, filename, store_id):
+    """Marks the job skipped (and returns True) when the store already holds identical
+    content under the same name; otherwise records whether it is new or a replacement."""
+    with stage('duplicate_check'):
+        existing = manifest_lookup(store_id, filename)
+    if existing and existing['sha256'] == spool.sha256:
+        print(f"Skipping {filename}: unchanged.")
+        spool.discard()
+        update_job(job_id, status='skipped', action='skipped')
+        metrics.inc('uploads_total', action='skipped')
+        return True
+
+    duplicate_of = manifest_find_hash(store_id, spool.sha256)
+    if duplicate_of:
+        print(f"Note: {filename} has the same content as {duplicate_of}.")
+    update_job(job_id, action='replaced' if existing else 'new', duplicate_of=duplicate_of)
+    metrics.inc('uploads_total', action='replaced' if existing else 'new')
+    return False
+
+@app.route('/api/upload', methods=['POST'])
+def upload_file():
+    if not CURRENT_STORE_ID:
+        # Let's fail gracefully to let UI handle "Please create a store"
+        return jsonify({"error": "No active store selected. Create or select a store first."}), 400
+
+    try:
+        # Reserve before touching request.files, which is what reads the body
+        with upload_reservation() as reservation:
+            with stage('receive'):
+                files = request.files
+            if 'file' not in files:
+                return jsonify({"error": "No file part"}), 400
+            file = files['file']
+            if file.filename == '':
+                return jsonify({"error": "No selected file"}), 400
+            job = stage_upload(file, CURRENT_STORE_ID, reservation, request.form.get('batch_id'))
 
         return jsonify({
-            "response": response.text,
-            "citations": citations
-        })
+            "status": "skipped" if job['status'] == 'skipped' else "queued",
+            "action": job['action'],
+            "duplicate_of": job['duplicate_of'],
+            "job_id": job['id'],
+            "batch_id": job['batch_id'],
+            "store_id": CURRENT_STORE_ID,
+            "filename": job['filename']
+        }), 202
 
+    except UploadTooLarge as e:
+        return jsonify({"error": str(e)}), 413
+    except UploadLengthRequired as e:
+        return jsonify({"error": str(e)}), 411
+    except ServerBusyError as e:
+        return jsonify({"error": str(e)}), 503
     except Exception as e:
         print(f"Error: {e}")
         return jsonify({"error": str(e)}), 500
 
-@app.route('/api/store/<path:store_id>/suggestions', methods=['POST'])
-def generate_suggestions(store_id):
+@app.route('/api/upload/batch', methods=['POST'])
+def upload_batch():
+    if not CURRENT_STORE_ID:
+        return jsonify({"error": "No active store selected. Create or select a store first."}), 400
+
     try:
+        store_id = CURRENT_STORE_ID
+        with upload_reservation() as reservation:
+            with stage('receive'):
+                files = [f for f in request.files.getlist('files') if f.filename]
+            if not files:
+                return jsonify({"error": "No files"}), 400
+            batch_id = request.form.get('batch_id') or uuid.uuid4().hex
+            for file in files:
+                stage_upload(file, store_id, reservation, batch_id)
+
+        # ?wait=1 blocks until every file is indexed and returns the final per-file results
+        if request.args.get('wait') in ('1', 'true'):
+            return jsonify(wait_for_batch(batch_id))
+        return jsonify(get_batch(batch_id)), 202
+
+    except UploadTooLarge as e:
+        return jsonify({"error": str(e)}), 413
+    except UploadLengthRequired as e:
+        return jsonify({"error": str(e)}), 411
+    except ServerBusyError as e:
+        return jsonify({"error": str(e)}), 503
+    except Exception as e:
+        print(f"Error: {e}")
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    job = get_job(job_id)
+    if job is None:
+        return jsonify({"error": "Unknown job"}), 404
+    return jsonify(job)
+
+@app.route('/api/batches/<batch_id>', methods=['GET'])
+def batch_status(batch_id):
+    batch = get_batch(batch_id)
+    if batch is None:
+        return jsonify({"error": "Unknown batch"}), 404
+    return jsonify(batch)
+
+# --- Request Coalescing ---
+# Identical requests that arrive while one is already running (several people opening the
+# same store, the same question asked twice) share that one upstream call instead of each
+# making their own. Nothing is kept once the call finishes; that's the chat cache's job.
+class Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+class SingleFlight:
+    """do(key, fn): the first caller runs fn, concurrent callers with the same key wait for
+    and share its result or exception."""
+
+    def __init__(self, name):
+        self.name = name
+        self.lock = threading.Lock()
+        self.flights = {}
+        self.leaders = 0
+        self.followers = 0
+
+    def do(self, key, fn, timeout=None):
+        with self.lock:
+            flight = self.flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.flights[key] = Flight()
+                self.leaders += 1
+            else:
+                self.followers += 1
+        metrics.inc('coalesced_calls_total', flight=self.name, role='leader' if leader else 'follower')
+
+        if not leader:
+            # A follower giving up only stops its own wait; the shared call carries on
+            if not flight.done.wait(timeout):
+                raise TimeoutError(f"Timed out waiting for an identical {self.name} request")
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+
+        try:
+            flight.result = fn()
+            return flight.result
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.flights[key] # Later callers start a fresh call
+            flight.done.set()
+
+    def stats(self):
+        with self.lock:
+            total = self.leaders + self.followers
+            return {"upstream_calls": self.leaders, "coalesced": self.followers, "in_flight": len(self.flights),
+                    "coalescing_ratio": round(self.followers / total, 4) if total else 0.0}
+
+class SharedStream:
+    """One upstream chunk stream fanned out to every subscriber. Whichever subscriber needs
+    the next chunk pulls it; late subscribers replay what was already received. When the
+    last subscriber goes away (client disconnected) the upstream stream is closed."""
+
+    def __init__(self, group, key, upstream):
+        self.group = group
+        self.key = key
+        self.upstream = upstream
+        self.chunks = []
+        self.finished = False
+        self.error = None
+        self.pulling = False
+        self.subscribers = 0
+        self.cond = threading.Condition()
+
+    def subscribe(self):
+        with self.cond:
+            self.subscribers += 1
+        return Subscription(self)
+
+    def unsubscribe(self):
+        with self.cond:
+            self.subscribers -= 1
+            abandoned = self.subscribers == 0 and not self.finished
+        if abandoned:
+            self._finish(None)
+            self.upstream.close()
+
+    def read(self):
+        index = 0
+        while True:
+            with self.cond:
+                while index >= len(self.chunks) and not self.finished and self.pulling:
+                    self.cond.wait()
+                if index < len(self.chunks):
+                    chunk = self.chunks[index]
+                elif self.finished:
+                    if self.error is not None:
+                        raise self.error
+                    return
+                else:
+                    self.pulling = True
+                    chunk = None
+            if chunk is None:
+                self._pull()
+                continue
+            index += 1
+            yield chunk
+
+    def _pull(self):
+        chunk, finished, error = None, False, None
+        try:
+            chunk = next(self.upstream)
+        except StopIteration:
+            finished = True
+        except Exception as e:
+            finished, error = True, e
+        with self.cond:
+            if finished:
+                self.finished, self.error = True, error
+            else:
+                self.chunks.append(chunk)
+            self.pulling = False
+            self.cond.notify_all()
+        if finished:
+            self.group.discard(self)
+
+    def _finish(self, error):
+        with self.cond:
+            self.finished = True
+            self.error = error
+            self.cond.notify_all()
+        self.group.discard(self)
+
+class Subscription:
+    """Iterator over a SharedStream. close() (also on garbage collection) unsubscribes,
+    even if iteration never started."""
+
+    def __init__(self, shared):
+        self.shared = shared
+        self.reader = shared.read()
+        self.closed = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self.reader)
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.reader.close()
+            self.shared.unsubscribe()
+
+    __del__ = close
+
+class StreamFlights:
+    """SingleFlight for streaming calls: join(key, open_stream) returns a chunk iterator."""
+
+    def __init__(self, name):
+        self.name = name
+        self.lock = threading.Lock()
+        self.streams = {}
+        self.leaders = 0
+        self.followers = 0
+
+    def join(self, key, open_stream):
+        with self.lock:
+            shared = self.streams.get(key)
+            leader = shared is None
+            if leader:
+                # Opening only admits the call (non-blocking), so it's fine under the lock
+                shared = self.streams[key] = SharedStream(self, key, open_stream())
+                self.leaders += 1
+            else:
+                self.followers += 1
+            stream = shared.subscribe()
+        metrics.inc('coalesced_calls_total', flight=self.name, role='leader' if leader else 'follower')
+        return stream
+
+    def discard(self, shared):
+        with self.lock:
+            if self.streams.get(shared.key) is shared:
+                del self.streams[shared.key]
+
+    def stats(self):
+        with self.lock:
+            total = self.leaders + self.followers
+            return {"upstream_calls": self.leaders, "coalesced": self.followers, "in_flight": len(self.streams),
+                    "coalescing_ratio": round(self.followers / total, 4) if total else 0.0}
+
+chat_flights = SingleFlight('chat')
+chat_stream_flights = StreamFlights('chat_stream')
+suggestion_flights = SingleFlight('suggestions')
+
+# --- Chat Response Cache ---
+# Identical questions against the same store/model/instruction are answered from here.
+# In-memory LRU with TTL, optionally backed by SQLite (CHAT_CACHE_DB) to survive restarts.
+# Entries of a store are dropped whenever its documents change.
+CHAT_CACHE_SIZE = int(os.getenv("CHAT_CACHE_SIZE", "256"))
+CHAT_CACHE_TTL = float(os.getenv("CHAT_CACHE_TTL", "3600"))
+CHAT_CACHE_DB = os.getenv("CHAT_CACHE_DB") # e.g. chat_cache.db, unset = memory only
+
+def normalize_question(message):
+    text = unicodedata.normalize('NFKC', message or '').casefold()
+    text = " ".join(text.split())
+    return text.rstrip("?!. ")
+
+class ResponseCache:
+    def __init__(self, max_entries, ttl, db_path=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict() # key -> (store_id, value, created_at)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.db = None
+        if db_path:
+            self.db = sqlite3.connect(db_path, check_same_thread=False)
+            self.db.execute("CREATE TABLE IF NOT EXISTS chat_cache (key TEXT PRIMARY KEY, store_id TEXT, value TEXT, created_at REAL)")
+            self.db.execute("CREATE INDEX IF NOT EXISTS chat_cache_store ON chat_cache (store_id)")
+            self.db.commit()
+
+    @staticmethod
+    def make_key(store_id, model, system_instruction, message):
+        raw = json.dumps([store_id, model, system_instruction or '', normalize_question(message)])
+        return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        now = time.time()
+        with self.lock:
+            item = self.entries.get(key)
+            if item and now - item[2] < self.ttl:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                metrics.inc('chat_cache_total', result='hit')
+                return item[1]
+            if item:
+                del self.entries[key]
+
+            if self.db is not None:
+                row = self.db.execute("SELECT store_id, value, created_at FROM chat_cache WHERE key = ?", (key,)).fetchone()
+                if row and now - row[2] < self.ttl:
+                    value = json.loads(row[1])
+                    self._remember(key, row[0], value, row[2])
+                    self.hits += 1
+                    metrics.inc('chat_cache_total', result='hit')
+                    return value
+
+            self.misses += 1
+            metrics.inc('chat_cache_total', result='miss')
+            return None
+
+    def put(self, key, store_id, value):
+        now = time.time()
+        with self.lock:
+            self._remember(key, store_id, value, now)
+            if self.db is not None:
+                self.db.execute("INSERT OR REPLACE INTO chat_cache VALUES (?, ?, ?, ?)",
+                                (key, store_id, json.dumps(value), now))
+                self.db.execute("DELETE FROM chat_cache WHERE created_at < ?", (now - self.ttl,))
+                self.db.commit()
+
+    def _remember(self, key, store_id, value, created_at):
+        self.entries[key] = (store_id, value, created_at)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def invalidate_store(self, store_id):
+        with self.lock:
+            for key in [k for k, item in self.entries.items() if item[0] == store_id]:
+                del self.entries[key]
+            if self.db is not None:
+                self.db.execute("DELETE FROM chat_cache WHERE store_id = ?", (store_id,))
+                self.db.commit()
+
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / total, 3) if total else 0.0,
+                "size": len(self.entries),
+                "persistent": self.db is not None
+            }
+
+chat_cache = ResponseCache(CHAT_CACHE_SIZE, CHAT_CACHE_TTL, CHAT_CACHE_DB)
+
+def on_store_changed(store_id):
+    """Called whenever documents are added to or removed from a store."""
+    chat_cache.invalidate_store(store_id)
+    bump_store_version_local(store_id)
+    schedule_suggestions_refresh(store_id)
+    publish_event('store', store_id=store_id, count=store_count_info(get_store_meta_local(store_id))['count'],
+                  version=get_store_version_local(store_id))
+    publish_event('cache', cache='chat', store_id=store_id)
+
+@app.route('/api/metrics', methods=['GET'])
+def metrics_endpoint():
+    with jobs_lock:
+        active_jobs = sum(1 for job in JOBS.values() if job['status'] not in JOB_FINAL_STATES)
+    extra = [
+        ('ingest_jobs_active', {}, active_jobs),
+        ('index_operations_pending', {}, operation_poller.size()),
+        ('upload_inflight_bytes', {}, upload_budget.used),
+        ('events_connected', {}, event_hub.connected()),
+    ]
+    for family, stats in scheduler.stats().items():
+        extra.append(('scheduler_queue_depth', {"family": family}, stats['queue_depth']))
+    return Response(metrics.render(extra), mimetype='text/plain; version=0.0.4')
+
+@app.route('/api/scheduler', methods=['GET'])
+def scheduler_stats():
+    """Per API family: calls, throttle events, retries, failures and current queue depth."""
+    return jsonify(scheduler.stats())
+
+@app.route('/api/cache/stats', methods=['GET'])
+def cache_stats():
+    return jsonify({
+        "chat": chat_cache.stats(),
+        "sessions": chat_sessions.stats(),
+        "coalescing": {flights.name: flights.stats() for flights in (chat_flights, chat_stream_flights, suggestion_flights)},
+    })
+
+# --- Chat Sessions ---
+# With a session_id, /api/chat and /api/chat/stream keep the conversation server-side and
+# send it as multi-turn contents. The history sent is capped at CHAT_HISTORY_TOKENS
+# (estimated): once a session outgrows it, its older turns are folded into a running
+# summary in the background, and until that lands the oldest turns are left out of the
+# prompt. Sessions idle for CHAT_SESSION_IDLE seconds, or beyond the CHAT_SESSIONS_MAX
+# most recently used, are dropped.
+CHAT_SESSIONS_MAX = int(os.getenv("CHAT_SESSIONS_MAX", "200"))
+CHAT_SESSION_IDLE = float(os.getenv("CHAT_SESSION_IDLE", "3600"))
+CHAT_HISTORY_TOKENS = int(os.getenv("CHAT_HISTORY_TOKENS", "4000"))
+CHAT_KEEP_TURNS = 2 # Most recent turns, never folded into the summary
+CHAT_MAX_TURNS = 50 # Hard cap on stored turns, should summarizing keep failing
+CHAT_SUMMARY_WORDS = 250
+CHAT_CONFIGS_MAX = 64
+
+SUMMARY_PROMPT = """Summarize the conversation below between a user and an assistant that answers
+from the user's documents, in at most {words} words. Keep the facts, names, numbers, file
+names and decisions the user may refer back to, and any open questions. Write plain prose.
+
+Summary of earlier parts of the conversation:
+{summary}
+
+Conversation:
+{transcript}"""
+
+summary_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="summarize")
+
+def estimate_tokens(text):
+    """Rough token count (about 4 characters per token), good enough for budgeting."""
+    return (len(text or '') + 3) // 4
+
+def text_content(role, text):
+    return {"role": role, "parts": [{"text": text}]}
+
+class ChatSession:
+    def __init__(self, session_id, store_id):
+        self.id = session_id
+        self.store_id = store_id
+        self.turns = [] # [(question, answer)], oldest first, not yet in the summary
+        self.summary = ""
+        self.summarizing = False
+        self.last_used = time.time()
+        self.lock = threading.Lock()
+
+    def has_history(self):
+        with self.lock:
+            return bool(self.turns or self.summary)
+
+    def contents(self, message):
+        """(contents, history tokens) for the next call: the summary, the latest turns
+        that fit CHAT_HISTORY_TOKENS (the last one always) and the new message."""
+        with self.lock:
+            summary = self.summary
+            used = estimate_tokens(summary)
+            recent = []
+            for question, answer in reversed(self.turns):
+                cost = estimate_tokens(question) + estimate_tokens(answer)
+                if recent and used + cost > CHAT_HISTORY_TOKENS:
+                    break
+                recent.append((question, answer))
+                used += cost
+
+        contents = []
+        if summary:
+            contents.append(text_content("user", f"Summary of our conversation so far:\n{summary}"))
+            contents.append(text_content("model", "Understood."))
+        for question, answer in reversed(recent):
+            contents.append(text_content("user", question))
+            contents.append(text_content("model", answer))
+        contents.append(text_content("user", message))
+        return contents, used
+
+    def add_turn(self, question, answer, model):
+        with self.lock:
+            self.turns.append((question, answer))
+            del self.turns[:-CHAT_MAX_TURNS]
+            tokens = estimate_tokens(self.summary) + sum(estimate_tokens(q) + estimate_tokens(a) for q, a in self.turns)
+            start = tokens > CHAT_HISTORY_TOKENS and len(self.turns) > CHAT_KEEP_TURNS and not self.summarizing
+            if start:
+                self.summarizing = True
+        if start:
+            summary_executor.submit(summarize_session, self, model)
+
+    def info(self):
+        with self.lock:
+            return {
+                "id": self.id,
+                "store_id": self.store_id,
+                "turns": len(self.turns),
+                "summary": self.summary,
+                "summarizing": self.summarizing,
+                "history_tokens": estimate_tokens(self.summary) + sum(estimate_tokens(q) + estimate_tokens(a) for q, a in self.turns),
+                "last_used": self.last_used,
+            }
+
+def summarize_session(session, model):
+    """Background: folds all but the last CHAT_KEEP_TURNS turns into the session summary."""
+    set_call_priority(BACKGROUND)
+    try:
+        with session.lock:
+            folded = session.turns[:-CHAT_KEEP_TURNS]
+            previous = session.summary
+        transcript = "\n\n".join(f"User: {q}\nAssistant: {a}" for q, a in folded)
+        prompt = SUMMARY_PROMPT.format(words=CHAT_SUMMARY_WORDS, summary=previous or "(none)", transcript=transcript)
+        with stage('chat_summarize'):
+            response = get_client().models.generate_content(model=model, contents=prompt)
+        summary = (response.text or "").strip()
+        if not summary:
+            raise ValueError("empty summary")
+        with session.lock:
+            # Turns only ever get appended (or capped) meanwhile; apply if ours are still first
+            if session.turns[:len(folded)] == folded and session.summary == previous:
+                del session.turns[:len(folded)]
+                session.summary = summary
+        metrics.inc('chat_summaries_total', result='ok')
+    except Exception as e:
+        print(f"Warning summarizing chat session {session.id}: {e}")
+        metrics.inc('chat_summaries_total', result='failed')
+    finally:
+        with session.lock:
+            session.summarizing = False
+
+class ChatSessions:
+    """LRU of ChatSession by id, bounded in count and idle time."""
+
+    def __init__(self, max_sessions, idle):
+        self.max_sessions = max_sessions
+        self.idle = idle
+        self.sessions = OrderedDict() # id -> ChatSession, least recently used first
+        self.lock = threading.Lock()
+        self.evicted = 0
+
+    def get(self, session_id, store_id):
+        now = time.time()
+        with self.lock:
+            self._prune(now)
+            session = self.sessions.get(session_id)
+            if session is None or session.store_id != store_id:
+                # New conversation, or the tab switched knowledge base: start over
+                session = self.sessions[session_id] = ChatSession(session_id, store_id)
+            self.sessions.move_to_end(session_id)
+            session.last_used = now
+            while len(self.sessions) > self.max_sessions:
+                self.sessions.popitem(last=False)
+                self.evicted += 1
+            return session
+
+    def peek(self, session_id):
+        with self.lock:
+            return self.sessions.get(session_id)
+
+    def drop(self, session_id):
+        with self.lock:
+            return self.sessions.pop(session_id, None) is not None
+
+    def _prune(self, now):
+        while self.sessions:
+            oldest = next(iter(self.sessions.values()))
+            if now - oldest.last_used < self.idle:
+                break
+            self.sessions.popitem(last=False)
+            self.evicted += 1
+
+    def stats(self):
+        with self.lock:
+            return {"sessions": len(self.sessions), "evicted": self.evicted, "max_sessions": self.max_sessions,
+                    "history_token_budget": CHAT_HISTORY_TOKENS}
+
+chat_sessions = ChatSessions(CHAT_SESSIONS_MAX, CHAT_SESSION_IDLE)
+
+def session_for_request(data, store_id):
+    """The request's ChatSession, or None for a stateless (session-less) chat."""
+    session_id = str(data.get('session_id') or '')[:64]
+    return chat_sessions.get(session_id, store_id) if session_id else None
+
+@app.route('/api/chat/sessions/<session_id>', methods=['GET'])
+def chat_session_info(session_id):
+    session = chat_sessions.peek(session_id)
+    if session is None:
+        return jsonify({"error": "Unknown session"}), 404
+    return jsonify(session.info())
+
+@app.route('/api/chat/sessions/<session_id>', methods=['DELETE'])
+def reset_chat_session(session_id):
+    return jsonify({"status": "success", "existed": chat_sessions.drop(session_id)})
+
+# Built once per (store, system instruction) instead of on every call
+chat_configs = OrderedDict()
+chat_configs_lock = threading.Lock()
+
+def build_chat_config(store_id, system_instruction):
+    key = (store_id, system_instruction or None)
+    with chat_configs_lock:
+        config = chat_configs.get(key)
+        if config is not None:
+            chat_configs.move_to_end(key)
+            return config
+
+    types = load_sdk().types
+    tool = types.Tool(
+        file_search=types.FileSearch(
+            file_search_store_names=[store_id]
+        )
+    )
+
+    # Configure generation
+    config = types.GenerateContentConfig(
+        tools=[tool],
+        system_instruction=system_instruction if system_instruction else None
+    )
+    with chat_configs_lock:
+        chat_configs[key] = config
+        while len(chat_configs) > CHAT_CONFIGS_MAX:
+            chat_configs.popitem(last=False)
+    return config
+
+def extract_citations(candidate):
+    citations = []
+    if candidate is not None and candidate.citation_metadata:
+         for citation in candidate.citation_metadata.citation_sources or []:
+             start = citation.start_index if citation.start_index is not None else 0
+             end = citation.end_index if citation.end_index is not None else 0
+             uri = citation.uri
+             # Try to get display name from uri if possible, or just send uri
+             # The UI can map URIs to names if we have the file list, 
+             # but for now let's just send what we have.
+             citations.append({
+                 "uri": uri,
+                 "startIndex": start,
+                 "endIndex": end
+             })
+    return citations
+
+def extract_grounding(candidate):
+    """File search chunks the answer was grounded on (title/uri/text)."""
+    grounding = []
+    metadata = getattr(candidate, 'grounding_metadata', None) if candidate is not None else None
+    if metadata and getattr(metadata, 'grounding_chunks', None):
+        for chunk in metadata.grounding_chunks:
+            context = getattr(chunk, 'retrieved_context', None)
+            if context:
+                grounding.append({
+                    "title": context.title,
+                    "uri": context.uri,
+                    "text": context.text
+                })
+    return grounding
+
+def first_candidate(response):
+    return response.candidates[0] if getattr(response, 'candidates', None) else None
+
+@app.route('/api/chat', methods=['POST'])
+def chat():
+    data = request.json
+    message = data.get('message')
+    from_model = data.get('model', 'gemini-1.5-flash') # Default fallback
+    
+    system_instruction = data.get('system_instruction')
+
+    if not CURRENT_STORE_ID:
+        return jsonify({"error": "Please select a Knowledge Base first."}), 400
+
+    try:
+        store_id = CURRENT_STORE_ID
+        session = session_for_request(data, store_id)
+        # Follow-ups depend on the conversation, so only opening questions are cached/shared
+        stateless = session is None or not session.has_history()
+        cache_key = chat_cache.make_key(store_id, from_model, system_instruction, message)
+        if stateless:
+            cached = chat_cache.get(cache_key)
+            if cached is not None:
+                if session is not None:
+                    session.add_turn(message, cached['response'], from_model)
+                return jsonify(dict(cached, cached=True))
+
         client = get_client()
-        
-        # Borrowed prompt logic from 'ask-the-manual'
-        prompt = """
-        You are provided some documents. 
-        Generate 4 short, practical, and interesting questions a user might ask about these documents.
-        Return the questions as a JSON array of strings, e.g. ["Question 1?", "Question 2?", ...].
-        Do not include markdown formatting or backticks, just the raw JSON.
-        """
-        
-        tool = types.Tool(
-            file_search=types.FileSearch(
-                file_search_store_names=[store_id]
+        contents, history_tokens = (message, 0) if stateless else session.contents(message)
+
+        def ask():
+            response = run_sdk(client.models.generate_content,
+                model=from_model,
+                contents=contents,
+                config=build_chat_config(store_id, system_instruction)
             )
-        )
-        
-        response = client.models.generate_content(
-            model='gemini-1.5-flash', # Use stable model for suggestions
-            contents=prompt,
-            config=types.GenerateContentConfig(
-                tools=[tool],
-                response_mime_type="application/json"
+
+            # Extract citations if available
+            candidate = first_candidate(response)
+            result = {
+                "response": response.text,
+                "citations": extract_citations(candidate),
+                "grounding": extract_grounding(candidate)
+            }
+            if result['response'] and stateless:
+                chat_cache.put(cache_key, store_id, result)
+            return result
+
+        # Identical questions already in flight share that call
+        result = chat_flights.do(cache_key, ask, timeout=SDK_CALL_TIMEOUT) if stateless else ask()
+        if session is not None and result['response']:
+            session.add_turn(message, result['response'], from_model)
+            metrics.inc('chat_history_tokens_total', history_tokens)
+        return jsonify(result)
+
+    except ServerBusyError as e:
+        return jsonify({"error": str(e)}), 503
+    except Exception as e:
+        print(f"Error: {e}")
+        return jsonify({"error": str(e)}), 500
+
+def sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+@app.route('/api/chat/stream', methods=['POST'])
+def chat_stream():
+    """Same as /api/chat, but sends text deltas as Server-Sent Events while the answer is
+    generated, followed by a final 'done' event carrying citations and grounding."""
+    data = request.json
+    message = data.get('message')
+    from_model = data.get('model', 'gemini-1.5-flash') # Default fallback
+
+    system_instruction = data.get('system_instruction')
+
+    if not CURRENT_STORE_ID:
+        return jsonify({"error": "Please select a Knowledge Base first."}), 400
+
+    store_id = CURRENT_STORE_ID
+    session = session_for_request(data, store_id)
+    stateless = session is None or not session.has_history()
+    cache_key = chat_cache.make_key(store_id, from_model, system_instruction, message)
+    cached = chat_cache.get(cache_key) if stateless else None
+    stream = None
+    if cached is None:
+        try:
+            client = get_client()
+            contents, history_tokens = (message, 0) if stateless else session.contents(message)
+            open_stream = lambda: run_sdk_stream(
+                client.models.generate_content_stream,
+                model=from_model,
+                contents=contents,
+                config=build_chat_config(store_id, system_instruction)
             )
+            # Admitted (or rejected with 503) before the event stream starts. The same
+            # question already streaming for someone else is joined instead of re-asked.
+            stream = chat_stream_flights.join(cache_key, open_stream) if stateless else open_stream()
+        except ServerBusyError as e:
+            return jsonify({"error": str(e)}), 503
+        except Exception as e:
+            print(f"Error: {e}")
+            return jsonify({"error": str(e)}), 500
+
+    def generate():
+        if cached is not None:
+            if session is not None:
+                session.add_turn(message, cached['response'], from_model)
+            yield sse_event('delta', {"text": cached['response']})
+            yield sse_event('done', dict(cached, cached=True))
+            return
+
+        started = time.perf_counter()
+        try:
+            parts = []
+            citations = []
+            grounding = []
+            for chunk in stream:
+                text = chunk.text
+                if text:
+                    parts.append(text)
+                    yield sse_event('delta', {"text": text})
+                # Citation / grounding metadata usually arrives with the last chunks
+                candidate = first_candidate(chunk)
+                citations = extract_citations(candidate) or citations
+                grounding = extract_grounding(candidate) or grounding
+
+            result = {
+                "response": "".join(parts),
+                "citations": citations,
+                "grounding": grounding
+            }
+            if result['response'] and stateless:
+                chat_cache.put(cache_key, store_id, result)
+            if session is not None and result['response']:
+                session.add_turn(message, result['response'], from_model)
+                metrics.inc('chat_history_tokens_total', history_tokens)
+            yield sse_event('done', result)
+
+        except Exception as e:
+            print(f"Error: {e}")
+            yield sse_event('error', {"error": str(e)})
+        finally:
+            stream.close()
+            # Whole stream, first chunk to last (time to first chunk is its own stage)
+            elapsed = time.perf_counter() - started
+            metrics.observe('stage_seconds', elapsed, stage='chat_stream')
+            metrics.trace('chat_stream', elapsed)
+
+    return Response(stream_with_context(generate()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+# --- Suggested Questions ---
+# Suggestions only change when a store's documents change, so they are computed once per
+# store version (in the background, shortly after an ingest settles) and persisted.
+SUGGESTIONS_DELAY = float(os.getenv("SUGGESTIONS_DELAY", "3")) # Debounce after the last change
+
+suggestion_timers = {}
+suggestions_lock = threading.Lock()
+
+def compute_suggestions(store_id):
+    client = get_client()
+    types = load_sdk().types
+
+    # Borrowed prompt logic from 'ask-the-manual'
+    prompt = """
+    You are provided some documents. 
+    Generate 4 short, practical, and interesting questions a user might ask about these documents.
+    Return the questions as a JSON array of strings, e.g. ["Question 1?", "Question 2?", ...].
+    Do not include markdown formatting or backticks, just the raw JSON.
+    """
+
+    tool = types.Tool(
+        file_search=types.FileSearch(
+            file_search_store_names=[store_id]
         )
-        
-        text = response.text.strip()
-        # Cleanup if model adds markdown
-        if text.startswith("```json"): text = text[7:]
-        if text.endswith("```"): text = text[:-3]
-        
-        questions = json.loads(text)
-        
-        # Ensure it's a list of strings
-        if isinstance(questions, list):
-           return jsonify({"questions": questions[:4]}) # Limit to 4
-        else:
-           return jsonify({"questions": []})
+    )
+
+    response = client.models.generate_content(
+        model='gemini-1.5-flash', # Use stable model for suggestions
+        contents=prompt,
+        config=types.GenerateContentConfig(
+            tools=[tool],
+            response_mime_type="application/json"
+        )
+    )
+
+    text = response.text.strip()
+    # Cleanup if model adds markdown
+    if text.startswith("```json"): text = text[7:]
+    if text.endswith("```"): text = text[:-3]
+
+    questions = json.loads(text)
+
+    # Ensure it's a list of strings
+    if isinstance(questions, list):
+        return questions[:4] # Limit to 4
+    return []
+
+def get_suggestions(store_id, refresh=False):
+    """Returns (questions, cached). Recomputes only if the stored copy is missing,
+    belongs to an older store version, or a refresh is requested."""
+    version = get_store_version_local(store_id)
+    stored = load_store_suggestions_local(store_id)
+    if stored and stored['version'] == version and not refresh:
+        return stored['questions'], True
 
+    def compute():
+        cancel_suggestions_refresh(store_id)
+        questions = compute_suggestions(store_id)
+        if questions:
+            save_store_suggestions_local(store_id, version, questions)
+            publish_event('suggestions', store_id=store_id)
+        return questions
+
+    # Everyone asking for this store version while it's being computed shares one call
+    return suggestion_flights.do((store_id, version), compute, timeout=SDK_CALL_TIMEOUT), False
+
+def cancel_suggestions_refresh(store_id):
+    with suggestions_lock:
+        timer = suggestion_timers.pop(store_id, None)
+    if timer:
+        timer.cancel()
+
+def schedule_suggestions_refresh(store_id):
+    """(Re)starts the debounce timer so a whole ingest batch triggers one recompute."""
+    def run():
+        set_call_priority(BACKGROUND)
+        with suggestions_lock:
+            if suggestion_timers.get(store_id) is timer:
+                del suggestion_timers[store_id]
+        try:
+            get_suggestions(store_id)
+        except Exception as e:
+            print(f"Error precomputing suggestions: {e}")
+
+    cancel_suggestions_refresh(store_id)
+    with suggestions_lock:
+        timer = Timer(SUGGESTIONS_DELAY, run)
+        timer.daemon = True
+        suggestion_timers[store_id] = timer
+        timer.start()
+
+@app.route('/api/store/<path:store_id>/suggestions', methods=['POST'])
+def generate_suggestions(store_id):
+    try:
+        data = request.get_json(silent=True) or {}
+        refresh = bool(data.get('refresh')) or request.args.get('refresh') in ('1', 'true')
+        questions, cached = run_sdk(get_suggestions, store_id, refresh=refresh)
+        return jsonify({"questions": questions, "cached": cached})
+
+    except ServerBusyError as e:
+        return jsonify({"questions": [], "error": str(e)}), 503
     except Exception as e:
         print(f"Error generating suggestions: {e}")
         # Build strict JSON fallback if model fails
         return jsonify({"questions": []})
 
-# --- Heartbeat / Auto Shutdown ---
-LAST_HEARTBEAT = time.time() + 10  # Initial grace period (10s)
-HEARTBEAT_TIMEOUT = 5 # Seconds
+# --- Live Events / Auto Shutdown ---
+# Each browser tab holds one Server-Sent Events connection to /api/events. It carries job
+# progress, store changes and cache invalidations, so the page polls nothing, and it is the
+# presence signal for auto-shutdown: once the last tab's connection is gone the server exits
+# SHUTDOWN_GRACE seconds later, unless a tab (re)connects in the meantime. A tab that closes
+# normally says so with a beacon; one that vanishes is noticed at the next keep-alive write
+# (at most EVENTS_KEEPALIVE seconds). Each connection holds one server thread while open.
+EVENTS_KEEPALIVE = float(os.getenv("EVENTS_KEEPALIVE", "15"))
+SHUTDOWN_GRACE = float(os.getenv("SHUTDOWN_GRACE", "5"))
+STARTUP_GRACE = 15 # Seconds for the first tab to connect
+HEARTBEAT_TIMEOUT = 5 # Seconds, for clients still POSTing /api/heartbeat
+EVENTS_QUEUE_SIZE = 1000 # Per tab; events for a tab that stopped reading are dropped
 
-def heartbeat_monitor():
-    """Checks if client is still connected. Shuts down if no heartbeat received."""
-    global LAST_HEARTBEAT
-    print("Heartbeat monitor started...")
-    while True:
-        time.sleep(2)
-        if time.time() - LAST_HEARTBEAT > HEARTBEAT_TIMEOUT:
-            print(f"No heartbeat for {HEARTBEAT_TIMEOUT}s. Shutting down...")
-            os._exit(0)
+class EventHub:
+    def __init__(self):
+        self.tabs = {} # tab id -> Queue of encoded events (None ends the stream)
+        self.lock = threading.Lock()
+        self.auto_shutdown = False # Only when serving the UI (see serve)
+        self.shutdown_timer = None
+
+    def subscribe(self, tab_id):
+        events = queue.Queue(EVENTS_QUEUE_SIZE)
+        with self.lock:
+            previous = self.tabs.get(tab_id)
+            self.tabs[tab_id] = events
+            self._cancel_shutdown()
+        if previous is not None:
+            self._end(previous) # Same tab reconnected; free the old stream's thread
+        return events
+
+    def unsubscribe(self, tab_id, events):
+        with self.lock:
+            if self.tabs.get(tab_id) is events:
+                del self.tabs[tab_id]
+            if not self.tabs:
+                self._schedule_shutdown(SHUTDOWN_GRACE)
+
+    def close_tab(self, tab_id):
+        """The tab told us it is going away (page unload beacon)."""
+        with self.lock:
+            events = self.tabs.pop(tab_id, None)
+            if not self.tabs:
+                self._schedule_shutdown(SHUTDOWN_GRACE)
+        if events is not None:
+            self._end(events)
+
+    def touch(self):
+        """Legacy /api/heartbeat: keeps the server up for HEARTBEAT_TIMEOUT more seconds."""
+        with self.lock:
+            if not self.tabs:
+                self._schedule_shutdown(HEARTBEAT_TIMEOUT)
+
+    def publish(self, event, data):
+        message = sse_event(event, data)
+        with self.lock:
+            tabs = list(self.tabs.values())
+        for events in tabs:
+            try:
+                events.put_nowait(message)
+            except queue.Full:
+                metrics.inc('events_dropped_total')
+        metrics.inc('events_published_total', event=event)
+
+    def start_auto_shutdown(self):
+        with self.lock:
+            self.auto_shutdown = True
+            if not self.tabs:
+                self._schedule_shutdown(STARTUP_GRACE)
+
+    def connected(self):
+        with self.lock:
+            return len(self.tabs)
+
+    def _end(self, events):
+        while True:
+            try:
+                events.put_nowait(None)
+                return
+            except queue.Full:
+                try:
+                    events.get_nowait()
+                except queue.Empty:
+                    pass
+
+    def _cancel_shutdown(self):
+        if self.shutdown_timer is not None:
+            self.shutdown_timer.cancel()
+            self.shutdown_timer = None
+
+    def _schedule_shutdown(self, delay):
+        """With self.lock held: (re)arms the shutdown timer."""
+        if not self.auto_shutdown:
+            return
+        self._cancel_shutdown()
+        self.shutdown_timer = Timer(delay, self._shutdown_if_alone, args=(delay,))
+        self.shutdown_timer.daemon = True
+        self.shutdown_timer.start()
+
+    def _shutdown_if_alone(self, delay):
+        with self.lock:
+            if self.tabs or self.shutdown_timer is not threading.current_thread():
+                return # A tab connected, or the timer was re-armed, meanwhile
+        print(f"No browser tab connected for {delay:g}s.")
+        shutdown_server()
 
-# Start monitor in background
-threading.Thread(target=heartbeat_monitor, daemon=True).start()
+event_hub = EventHub()
+
+def publish_event(event, **data):
+    event_hub.publish(event, data)
+
+@app.route('/api/events', methods=['GET'])
+def events_stream():
+    """This tab's live event stream (EventSource)."""
+    tab_id = (request.args.get('tab') or uuid.uuid4().hex)[:64]
+    events = event_hub.subscribe(tab_id)
+
+    def generate():
+        try:
+            yield "retry: 2000\n: connected\n\n"
+            while True:
+                try:
+                    message = events.get(timeout=EVENTS_KEEPALIVE)
+                except queue.Empty:
+                    yield ": keepalive\n\n" # Writing is how a vanished tab gets noticed
+                    continue
+                if message is None:
+                    return
+                yield message
+        finally:
+            event_hub.unsubscribe(tab_id, events)
+
+    return Response(stream_with_context(generate()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/api/events/close', methods=['POST'])
+def events_close():
+    event_hub.close_tab((request.args.get('tab') or '')[:64])
+    return ('', 204)
 
 @app.route('/api/heartbeat', methods=['POST'])
 def heartbeat():
-    global LAST_HEARTBEAT
-    LAST_HEARTBEAT = time.time()
+    event_hub.touch()
     return jsonify({"status": "alive"})
 
 def open_browser():
+    import webbrowser # Only needed once the server is up
     webbrowser.open_new('http://127.0.0.1:5000/')
 
+# --- Startup ---
+# Nothing slow runs before the server is listening: the google-genai import, client
+# construction and the first store/model listings happen in warm_caches once the port is
+# bound, so the page itself is served straight away. `python app.py --profile-startup`
+# prints where the startup time goes and exits 1 when the first byte of / takes longer
+# than STARTUP_TTFB_BUDGET seconds (measured from the top of app.py).
+STARTUP_TTFB_BUDGET = float(os.getenv("STARTUP_TTFB_BUDGET", "1.0"))
+
+def warm_caches():
+    """Imports the SDK and, with a key configured, loads the store and model listings
+    the page asks for first."""
+    set_call_priority(BACKGROUND)
+    try:
+        with stage('warm_caches'):
+            load_sdk()
+            if os.getenv("GEMINI_API_KEY") or load_api_key():
+                get_remote_stores()
+                get_models()
+    except Exception as e:
+        print(f"Warning warming caches: {e}")
+
+def on_listening():
+    threading.Thread(target=warm_caches, name="warm-caches", daemon=True).start()
+    open_browser()
+
+def profile_startup(as_json=False):
+    """Binds a free port, times the first GET / and then the work deferred past it.
+    Returns the exit code: 1 if the first byte took longer than STARTUP_TTFB_BUDGET."""
+    import http.client
+    try:
+        from waitress.server import create_server
+        server = create_server(app, host='127.0.0.1', port=0, threads=SERVER_THREADS)
+        port, run, close = server.effective_port, server.run, server.close
+    except ImportError:
+        from werkzeug.serving import make_server
+        server = make_server('127.0.0.1', 0, app, threaded=True)
+        port, run, close = server.server_port, server.serve_forever, server.shutdown
+    mark_startup("bind")
+    threading.Thread(target=run, daemon=True).start()
+
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+    conn.request('GET', '/')
+    response = conn.getresponse()
+    response.read(1)
+    mark_startup("first byte of /")
+    response.read()
+    ttfb = startup_marks[-1][1] - STARTUP_STARTED
+
+    deferred = {}
+    started = time.perf_counter()
+    load_sdk()
+    deferred["sdk import"] = time.perf_counter() - started
+    if os.getenv("GEMINI_API_KEY") or load_api_key():
+        started = time.perf_counter()
+        get_client()
+        deferred["client"] = time.perf_counter() - started
+    close()
+
+    steps, previous = {}, STARTUP_STARTED
+    for step, at in startup_marks:
+        steps[step] = at - previous
+        previous = at
+    passed = ttfb <= STARTUP_TTFB_BUDGET
+    if as_json:
+        print(json.dumps({"steps": {k: round(v, 4) for k, v in steps.items()}, "ttfb_s": round(ttfb, 4),
+                          "deferred": {k: round(v, 4) for k, v in deferred.items()},
+                          "budget_s": STARTUP_TTFB_BUDGET, "passed": passed}))
+    else:
+        print("Startup profile (seconds, from the top of app.py):")
+        for step, seconds in steps.items():
+            print(f"  {step:24} {seconds:8.3f}")
+        print("Deferred until after the first request:")
+        for step, seconds in deferred.items():
+            print(f"  {step:24} {seconds:8.3f}")
+        print(f"Time to first byte of /: {ttfb:.3f}s (budget {STARTUP_TTFB_BUDGET:.2f}s): {'OK' if passed else 'OVER BUDGET'}")
+    return 0 if passed else 1
+
+def serve(port=5000, dev=False, on_listening=None):
+    """Serves with waitress (SERVER_THREADS worker threads) when it is installed,
+    otherwise, or with --dev-server, with Flask's threaded development server.
+    on_listening runs once the port is bound."""
+    # Started here rather than at import: sync_folder.py and the pre-processing workers
+    # import this module but have no browser tab to watch and must not clean uploads/.
+    threading.Thread(target=clean_upload_folder, daemon=True).start()
+    event_hub.start_auto_shutdown()
+    if not dev:
+        try:
+            from waitress.server import create_server
+        except ImportError:
+            print("waitress not installed, using the Flask development server.")
+        else:
+            server = create_server(app, host='127.0.0.1', port=port, threads=SERVER_THREADS)
+            print(f"Serving on http://127.0.0.1:{port} with {SERVER_THREADS} threads")
+            if on_listening:
+                on_listening()
+            server.run()
+            return
+    if on_listening:
+        Timer(1, on_listening).start() # app.run() has no hook for when it is bound
+    app.run(debug=False, port=port, threaded=True)
+
+mark_startup("routes and config")
+
 if __name__ == '__main__':
-    Timer(1, open_browser).start()
-    app.run(debug=False, port=5000)
+    multiprocessing.freeze_support() # Pre-processing workers in the frozen exe
+    if '--profile-startup' in sys.argv:
+        sys.exit(profile_startup(as_json='--json' in sys.argv))
+    serve(dev='--dev-server' in sys.argv, on_listening=on_listening)
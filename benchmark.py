@@ -0,0 +1,544 @@
+"""
+Benchmark harness: runs the app under waitress against the in-process fake Gemini
+(fake_genai.py) and drives the HTTP API at scale. No API key is needed.
+
+    python benchmark.py                         # all scenarios, default sizes
+    python benchmark.py --scenarios chat,files --docs 20000
+    python benchmark.py --compare benchmark_results/<older run>.json
+    python benchmark.py --scenarios coalesce    # identical concurrent chats share one call
+    python benchmark.py --scenarios startup     # cold starts against STARTUP_TTFB_BUDGET
+    python benchmark.py --scenarios heartbeat   # /api/heartbeat latency during 50 concurrent chats
+    python benchmark.py --scenarios counts      # parallel batches keep the local file count exact
+
+Every run is saved to benchmark_results/<timestamp>-<commit>.json. With --compare the
+run is diffed against an earlier one and p95 / throughput regressions beyond --threshold
+are flagged, as are scenarios that report passed=false (exit code 1 with --fail-on-regression).
+"""
+import argparse
+import http.client
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import redirect_stdout
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+RESULTS_DIR = os.path.join(ROOT, 'benchmark_results')
+SCENARIOS = ('stores', 'files', 'upload', 'batch', 'counts', 'chat', 'chat_stream', 'coalesce', 'heartbeat', 'startup')
+
+# --- HTTP helpers ---
+class Api:
+    def __init__(self, port):
+        self.port = port
+        self.local = threading.local()
+
+    def conn(self):
+        if getattr(self.local, 'conn', None) is None:
+            self.local.conn = http.client.HTTPConnection('127.0.0.1', self.port, timeout=600)
+        return self.local.conn
+
+    def request(self, method, path, body=None, headers=None):
+        """Returns (status, body bytes, seconds). Reconnects once on a dropped keep-alive."""
+        for attempt in (0, 1):
+            started = time.perf_counter()
+            try:
+                conn = self.conn()
+                conn.request(method, path, body=body, headers=headers or {})
+                response = conn.getresponse()
+                data = response.read()
+                return response.status, data, time.perf_counter() - started
+            except (http.client.HTTPException, ConnectionError):
+                self.local.conn = None
+                if attempt:
+                    raise
+
+    def json(self, method, path, payload=None):
+        body = json.dumps(payload).encode() if payload is not None else None
+        status, data, _ = self.request(method, path, body, {'Content-Type': 'application/json'})
+        return status, json.loads(data or b'null')
+
+    def first_byte(self, path, payload):
+        """POST and time the first body byte (streaming endpoints). Returns (status, ttfb, total)."""
+        started = time.perf_counter()
+        conn = http.client.HTTPConnection('127.0.0.1', self.port, timeout=600)
+        try:
+            conn.request('POST', path, body=json.dumps(payload).encode(), headers={'Content-Type': 'application/json'})
+            response = conn.getresponse()
+            response.read(1)
+            ttfb = time.perf_counter() - started
+            response.read()
+            return response.status, ttfb, time.perf_counter() - started
+        finally:
+            conn.close()
+
+def multipart(field, files):
+    """files: [(filename, bytes)] -> (body, content type)."""
+    boundary = uuid.uuid4().hex
+    out = io.BytesIO()
+    for filename, data in files:
+        out.write(f'--{boundary}\r\nContent-Disposition: form-data; name="{field}"; filename="{filename}"\r\n'
+                  f'Content-Type: application/octet-stream\r\n\r\n'.encode())
+        out.write(data)
+        out.write(b'\r\n')
+    out.write(f'--{boundary}--\r\n'.encode())
+    return out.getvalue(), f'multipart/form-data; boundary={boundary}'
+
+# --- Stats ---
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, round(pct / 100 * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+def summarize(latencies, errors, duration, items=None, **extra):
+    values = sorted(latencies)
+    result = {
+        "requests": len(values) + errors,
+        "errors": errors,
+        "duration_s": round(duration, 3),
+        "throughput_per_s": round((items if items is not None else len(values)) / duration, 2) if duration else None,
+    }
+    for name, pct in (("p50_ms", 50), ("p95_ms", 95), ("p99_ms", 99), ("max_ms", 100)):
+        value = percentile(values, pct)
+        result[name] = round(value * 1000, 2) if value is not None else None
+    result.update(extra)
+    return result
+
+def run_load(count, concurrency, fn):
+    """Calls fn(i) count times on `concurrency` threads. fn returns (ok, seconds)."""
+    latencies, errors = [], 0
+    lock = threading.Lock()
+
+    def one(i):
+        nonlocal errors
+        ok, seconds = fn(i)
+        with lock:
+            if ok:
+                latencies.append(seconds)
+            else:
+                errors += 1
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(one, range(count)))
+    return latencies, errors, time.perf_counter() - started
+
+# --- Scenarios ---
+def bench_stores(api, args, fake):
+    for i in range(args.stores):
+        fake.seed_store(f"bench-store-{i}", 10)
+    api.request('GET', '/api/stores?refresh=1') # cold listing, not measured
+
+    def one(i):
+        status, _, seconds = api.request('GET', '/api/stores')
+        return status == 200, seconds
+    return summarize(*run_load(args.requests, args.concurrency, one), stores=args.stores)
+
+def bench_files(api, args, fake):
+    store_id = fake.seed_store("bench-files", args.docs)
+    path = f'/api/store/{store_id}/files'
+
+    # Errors come back as 200 with an "error" field, so check the body too
+    status, data, cold = api.request('GET', path)
+    if status != 200 or 'error' in json.loads(data):
+        raise RuntimeError(f"listing failed with {status}: {data[:200]!r}")
+    # The first page above comes straight from the API; a sorted view waits for the whole
+    # manifest, so load it here rather than inside the timed searches
+    status, data, manifest = api.request('GET', path + '?sort=name&page_size=1')
+    if status != 200 or 'error' in json.loads(data):
+        raise RuntimeError(f"manifest load failed with {status}: {data[:200]!r}")
+
+    def walk(i):
+        # Full keyset walk through the store, one page request at a time
+        seconds, token, pages = 0.0, None, 0
+        while True:
+            query = f'?page_size={args.page_size}' + (f'&page_token={token}' if token else '')
+            status, data, elapsed = api.request('GET', path + query)
+            body = json.loads(data) if status == 200 else {}
+            if status != 200 or 'error' in body:
+                return False, seconds
+            seconds += elapsed
+            pages += 1
+            token = body.get('next_page_token')
+            if not token or pages >= args.max_pages:
+                return True, seconds / pages
+
+    def search(i):
+        status, data, seconds = api.request('GET', f'{path}?q=doc_00{i % 100:02d}&page_size={args.page_size}')
+        return status == 200 and 'error' not in json.loads(data), seconds
+
+    result = summarize(*run_load(args.requests, args.concurrency, search), docs=args.docs)
+    result['cold_listing_ms'] = round(cold * 1000, 2)
+    result['cold_manifest_ms'] = round(manifest * 1000, 2)
+    result['page_walk'] = summarize(*run_load(args.concurrency, args.concurrency, walk), page_size=args.page_size)
+    return result
+
+def make_store(api, name):
+    status, body = api.json('POST', '/api/stores', {"name": name})
+    if status != 200:
+        raise RuntimeError(f"store create failed: {body}")
+    return body['id']
+
+def wait_jobs(api, path, ids, key, timeout):
+    deadline = time.time() + timeout
+    pending = set(ids)
+    while pending and time.time() < deadline:
+        for item in list(pending):
+            status, body = api.json('GET', f'{path}/{item}')
+            if status == 200 and (body.get(key) if key else body.get('status') in ('done', 'skipped', 'failed')):
+                pending.discard(item)
+        if pending:
+            time.sleep(0.1)
+    return len(pending)
+
+def bench_upload(api, args, fake):
+    make_store(api, "bench-upload")
+    payload = os.urandom(args.file_size)
+    job_ids = []
+    lock = threading.Lock()
+
+    def one(i):
+        body, content_type = multipart('file', [(f'upload_{i:05d}.txt', payload + str(i).encode())])
+        status, data, seconds = api.request('POST', '/api/upload', body, {'Content-Type': content_type})
+        if status == 202:
+            with lock:
+                job_ids.append(json.loads(data)['job_id'])
+        return status == 202, seconds
+
+    started = time.perf_counter()
+    latencies, errors, accept_duration = run_load(args.uploads, args.concurrency, one)
+    unfinished = wait_jobs(api, '/api/jobs', job_ids, None, args.timeout)
+    total = time.perf_counter() - started
+    return summarize(latencies, errors, accept_duration, files=args.uploads,
+                     indexed_per_s=round((len(job_ids) - unfinished) / total, 2),
+                     end_to_end_s=round(total, 3), unfinished=unfinished)
+
+def bench_batch(api, args, fake):
+    make_store(api, "bench-batch")
+    payload = os.urandom(args.file_size)
+    files_per_batch = max(1, args.batch_size)
+    batch_ids = []
+
+    def one(i):
+        files = [(f'batch{i}_{n:05d}.txt', payload + f'{i}-{n}'.encode()) for n in range(files_per_batch)]
+        body, content_type = multipart('files', files)
+        status, data, seconds = api.request('POST', '/api/upload/batch', body, {'Content-Type': content_type})
+        if status == 202:
+            batch_ids.append(json.loads(data)['batch_id'])
+        return status == 202, seconds
+
+    started = time.perf_counter()
+    latencies, errors, accept_duration = run_load(args.batches, min(args.batches, args.concurrency), one)
+    unfinished = wait_jobs(api, '/api/batches', batch_ids, 'finished', args.timeout)
+    total = time.perf_counter() - started
+    files = files_per_batch * (len(batch_ids) - unfinished)
+    return summarize(latencies, errors, accept_duration, items=files_per_batch * args.batches,
+                     batch_size=files_per_batch, indexed_per_s=round(files / total, 2),
+                     end_to_end_s=round(total, 3), unfinished_batches=unfinished)
+
+def bench_counts(api, args, fake):
+    """Parallel batches against one store: new files, then replacements and unchanged
+    re-uploads of the same names. The local file counter must end equal to the number of
+    documents the (fake) store really holds."""
+    import app
+    store_id = make_store(api, "bench-counts")
+    files_per_batch = max(1, args.batch_size)
+    unfinished = errors = 0
+    started = time.perf_counter()
+    latencies = []
+
+    for round_ in range(2):
+        batch_ids = []
+        lock = threading.Lock()
+
+        def one(i):
+            files = []
+            for n in range(files_per_batch):
+                # Second round: even files change (replaced), odd ones don't (skipped)
+                version = round_ if n % 2 == 0 else 0
+                files.append((f'count{i}_{n:05d}.txt', f'{i}-{n}-v{version}'.encode() * 64))
+            body, content_type = multipart('files', files)
+            status, data, seconds = api.request('POST', '/api/upload/batch', body, {'Content-Type': content_type})
+            if status == 202:
+                with lock:
+                    batch_ids.append(json.loads(data)['batch_id'])
+            return status == 202, seconds
+
+        lat, err, _ = run_load(args.batches, args.batches, one)
+        latencies += lat
+        errors += err
+        unfinished += wait_jobs(api, '/api/batches', batch_ids, 'finished', args.timeout)
+
+    local = app.get_store_file_count_local(store_id)
+    remote = len(fake.stores[store_id]['docs'])
+    return summarize(latencies, errors, time.perf_counter() - started, items=2 * files_per_batch * args.batches,
+                     batch_size=files_per_batch, local_count=local, remote_count=remote,
+                     unfinished_batches=unfinished, passed=local == remote and not unfinished and not errors)
+
+def bench_chat(api, args, fake):
+    make_store(api, "bench-chat")
+
+    def one(i):
+        # Mostly distinct questions (cache misses) with a slice of repeats (hits)
+        question = f"question {i % max(1, int(args.chats * (1 - args.repeat_ratio)))}"
+        status, _, seconds = api.request('POST', '/api/chat', json.dumps({"message": question}).encode(),
+                                         {'Content-Type': 'application/json'})
+        return status == 200, seconds
+    return summarize(*run_load(args.chats, args.concurrency, one), repeat_ratio=args.repeat_ratio)
+
+def bench_chat_stream(api, args, fake):
+    make_store(api, "bench-chat-stream")
+    ttfbs = []
+    lock = threading.Lock()
+
+    def one(i):
+        status, ttfb, total = api.first_byte('/api/chat/stream', {"message": f"stream question {i}"})
+        with lock:
+            ttfbs.append(ttfb)
+        return status == 200, total
+    result = summarize(*run_load(args.chats, args.concurrency, one))
+    ttfbs.sort()
+    result['ttfb_p50_ms'] = round(percentile(ttfbs, 50) * 1000, 2) if ttfbs else None
+    result['ttfb_p95_ms'] = round(percentile(ttfbs, 95) * 1000, 2) if ttfbs else None
+    return result
+
+def bench_coalesce(api, args, fake):
+    """Bursts of identical questions against the slow fake: each burst should cost one
+    upstream generate_content call, shared by every request in it."""
+    make_store(api, "bench-coalesce")
+    calls_before = fake.stats()['calls'].get('models.generate_content', 0)
+    bursts = max(1, args.chats // args.concurrency)
+
+    def one(i):
+        # Same question for a whole burst; the chat cache is bypassed by varying it per burst
+        question = f"coalesced question {i // args.concurrency}"
+        status, _, seconds = api.request('POST', '/api/chat', json.dumps({"message": question}).encode(),
+                                         {'Content-Type': 'application/json'})
+        return status == 200, seconds
+
+    latencies, errors, duration = [], 0, 0.0
+    for burst in range(bursts):
+        offset = burst * args.concurrency
+        lat, err, dur = run_load(args.concurrency, args.concurrency, lambda i: one(offset + i))
+        latencies += lat
+        errors += err
+        duration += dur
+    upstream = fake.stats()['calls'].get('models.generate_content', 0) - calls_before
+    requests = bursts * args.concurrency
+    return summarize(latencies, errors, duration, bursts=bursts, upstream_calls=upstream,
+                     coalescing_ratio=round(1 - upstream / requests, 4), passed=upstream == bursts)
+
+def bench_heartbeat(api, args, fake):
+    """/api/heartbeat latency idle and while --heartbeat-chats chats run concurrently against
+    the slow fake model. Blocking Gemini calls must not hold up the cheap requests."""
+    make_store(api, "bench-heartbeat")
+
+    def heartbeats(stop, count=None):
+        latencies, errors = [], 0
+        while not stop.is_set() and (count is None or len(latencies) + errors < count):
+            status, _, seconds = api.request('POST', '/api/heartbeat')
+            if status == 200:
+                latencies.append(seconds)
+            else:
+                errors += 1
+            time.sleep(0.02)
+        return latencies, errors
+
+    idle, _ = heartbeats(threading.Event(), count=50)
+
+    def chat(i):
+        status, _, seconds = api.request('POST', '/api/chat', json.dumps({"message": f"heartbeat load {i}"}).encode(),
+                                         {'Content-Type': 'application/json'})
+        return status == 200, seconds
+
+    stop = threading.Event()
+    sampled = {}
+    sampler = threading.Thread(target=lambda: sampled.update(zip(('latencies', 'errors'), heartbeats(stop))))
+    sampler.start()
+    chat_latencies, chat_errors, duration = run_load(args.heartbeat_chats, args.heartbeat_chats, chat)
+    stop.set()
+    sampler.join()
+
+    idle.sort()
+    result = summarize(sampled['latencies'], sampled['errors'], duration, chats=args.heartbeat_chats,
+                       chat_errors=chat_errors, budget_ms=args.heartbeat_budget,
+                       idle_p50_ms=round(percentile(idle, 50) * 1000, 2),
+                       idle_p95_ms=round(percentile(idle, 95) * 1000, 2))
+    # Every chat must be served too: shedding them with 503 would make the heartbeat look good
+    result['passed'] = (not sampled['errors'] and not chat_errors and result['p95_ms'] is not None
+                        and result['p95_ms'] <= args.heartbeat_budget)
+    return result
+
+def bench_startup(api, args, fake):
+    """Cold starts of app.py in fresh interpreters (python app.py --profile-startup):
+    time to the first byte of / against the budget, plus the whole process lifetime."""
+    ttfbs, walls, sdk_imports, failures = [], [], [], 0
+    env = dict(os.environ, STARTUP_TTFB_BUDGET=str(args.startup_budget))
+    env.pop('GEMINI_API_KEY', None) # Measure startup only, no client warm-up
+    for _ in range(args.startup_runs):
+        started = time.perf_counter()
+        proc = subprocess.run([sys.executable, os.path.join(ROOT, 'app.py'), '--profile-startup', '--json'],
+                              capture_output=True, text=True, env=env, timeout=120)
+        walls.append(time.perf_counter() - started)
+        lines = [line for line in proc.stdout.splitlines() if line.startswith('{')]
+        if not lines:
+            failures += 1
+            continue
+        profile = json.loads(lines[-1])
+        ttfbs.append(profile['ttfb_s'])
+        sdk_imports.append(profile['deferred'].get('sdk import', 0))
+        failures += not profile['passed']
+
+    walls.sort()
+    sdk_imports.sort()
+    return summarize(ttfbs, 0, sum(walls), runs=args.startup_runs, budget_s=args.startup_budget,
+                     process_p50_ms=round(percentile(walls, 50) * 1000, 2),
+                     sdk_import_p50_ms=round(percentile(sdk_imports, 50) * 1000, 2) if sdk_imports else None,
+                     over_budget=failures, passed=failures == 0)
+
+# --- Results ---
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, text=True,
+                                       stderr=subprocess.DEVNULL).strip()
+    except Exception:
+        return 'unknown'
+
+def compare(current, baseline, threshold):
+    """Prints per-scenario deltas and returns the list of regressions."""
+    regressions = []
+    print(f"\nCompared with {baseline.get('commit')} ({baseline.get('started_at')}):")
+    for name, result in current['results'].items():
+        old = baseline.get('results', {}).get(name)
+        if not old or 'error' in result or 'error' in old:
+            continue
+        for metric, higher_is_better in (('p50_ms', False), ('p95_ms', False), ('p99_ms', False), ('throughput_per_s', True)):
+            new_value, old_value = result.get(metric), old.get(metric)
+            if not new_value or not old_value:
+                continue
+            change = (new_value - old_value) / old_value
+            worse = change < -threshold if higher_is_better else change > threshold
+            flag = "  REGRESSION" if worse else ""
+            print(f"  {name:12} {metric:17} {old_value:>10} -> {new_value:>10} ({change:+.1%}){flag}")
+            if worse and metric in ('p95_ms', 'throughput_per_s'):
+                regressions.append(f"{name}.{metric}")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS), help=f"comma separated, from {', '.join(SCENARIOS)}")
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--requests', type=int, default=500, help="requests for the stores / files scenarios")
+    parser.add_argument('--stores', type=int, default=50)
+    parser.add_argument('--docs', type=int, default=10000, help="documents in the files scenario store")
+    parser.add_argument('--page-size', type=int, default=100)
+    parser.add_argument('--max-pages', type=int, default=1000)
+    parser.add_argument('--uploads', type=int, default=200)
+    parser.add_argument('--batches', type=int, default=4)
+    parser.add_argument('--batch-size', type=int, default=100)
+    parser.add_argument('--file-size', type=int, default=64 * 1024)
+    parser.add_argument('--chats', type=int, default=200)
+    parser.add_argument('--repeat-ratio', type=float, default=0.2, help="share of repeated chat questions")
+    parser.add_argument('--latency-scale', type=float, default=1.0, help="multiplies every fake API latency")
+    parser.add_argument('--latency', default=os.getenv("FAKE_LATENCY", ""), help="overrides, e.g. models.generate_content=0.5,files.upload=0.1")
+    parser.add_argument('--index-delay', type=float, default=1.0, help="seconds until an import finishes indexing")
+    parser.add_argument('--failure-rate', type=float, default=0.0, help="share of API calls failing with 429/503")
+    parser.add_argument('--real-limits', action='store_true', help="keep the app's Gemini rate limits (default: lifted)")
+    parser.add_argument('--timeout', type=float, default=600, help="max seconds to wait for ingestion to finish")
+    parser.add_argument('--heartbeat-chats', type=int, default=50, help="concurrent chats in the heartbeat scenario")
+    parser.add_argument('--heartbeat-budget', type=float, default=100.0,
+                        help="p95 ms allowed for /api/heartbeat during those chats")
+    parser.add_argument('--startup-runs', type=int, default=5, help="cold starts in the startup scenario")
+    parser.add_argument('--startup-budget', type=float, default=float(os.getenv("STARTUP_TTFB_BUDGET", "1.0")),
+                        help="seconds to the first byte of / in the startup scenario")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help="results file (default benchmark_results/<timestamp>-<commit>.json)")
+    parser.add_argument('--compare', help="earlier results file to diff against")
+    parser.add_argument('--threshold', type=float, default=0.10, help="relative change counted as a regression")
+    parser.add_argument('--fail-on-regression', action='store_true')
+    parser.add_argument('--verbose', action='store_true', help="show the app's own log output")
+    args = parser.parse_args()
+
+    scenarios = [s.strip() for s in args.scenarios.split(',') if s.strip()]
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+
+    # The app keeps its database and uploads relative to the working directory
+    workdir = tempfile.mkdtemp(prefix='filesearch-bench-')
+    os.chdir(workdir)
+    sys.path.insert(0, ROOT)
+    if not args.real_limits:
+        for family in ('FILES', 'FILE_SEARCH_STORES', 'MODELS', 'OPERATIONS'):
+            os.environ.setdefault(f'RATE_LIMIT_{family}', '100000')
+
+    from fake_genai import FakeClient, parse_latency
+    log = sys.stdout if args.verbose else open(os.devnull, 'w')
+    with redirect_stdout(log):
+        import app
+    fake = FakeClient(latency=parse_latency(args.latency), latency_scale=args.latency_scale,
+                      failure_rate=args.failure_rate, index_delay=args.index_delay, seed=args.seed)
+    app.client = fake
+
+    from waitress.server import create_server
+    server = create_server(app.app, host='127.0.0.1', port=0, threads=app.SERVER_THREADS)
+    closing = threading.Event()
+
+    def serve():
+        try:
+            server.run()
+        except OSError:
+            if not closing.is_set():
+                raise # close() below can pull the socket out from under the poll loop; anything else is real
+
+    threading.Thread(target=serve, daemon=True).start()
+    api = Api(server.effective_port)
+
+    run = {
+        "commit": git_commit(),
+        "started_at": time.strftime('%Y-%m-%dT%H:%M:%S'),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "config": {k: v for k, v in vars(args).items() if k not in ('output', 'compare', 'fail_on_regression', 'verbose')},
+        "results": {},
+    }
+    bench = {'stores': bench_stores, 'files': bench_files, 'upload': bench_upload, 'batch': bench_batch,
+             'counts': bench_counts, 'chat': bench_chat, 'chat_stream': bench_chat_stream,
+             'coalesce': bench_coalesce, 'heartbeat': bench_heartbeat, 'startup': bench_startup}
+    for name in scenarios:
+        print(f"Running {name}...", flush=True)
+        try:
+            with redirect_stdout(log):
+                result = bench[name](api, args, fake)
+        except Exception as e:
+            result = {"error": str(e)}
+        run['results'][name] = result
+        print(f"  {json.dumps(result)}", flush=True)
+    run['fake_api'] = fake.stats()
+    closing.set()
+    server.close()
+
+    output = args.output or os.path.join(RESULTS_DIR, f"{time.strftime('%Y%m%d-%H%M%S')}-{run['commit']}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(run, f, indent=2)
+    print(f"Saved results to {output}")
+
+    regressions = [f"{name}.passed" for name, result in run['results'].items() if result.get('passed') is False]
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            regressions += compare(run, json.load(f), args.threshold)
+    if regressions:
+        print(f"Regressions: {', '.join(regressions)}")
+        if args.fail_on_regression:
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -1 +1 @@
-python -m PyInstaller --noconfirm --clean --onefile --windowed --name "GeminiFileSearch" --add-data "templates;templates" --add-data "static;static" --add-data ".env.example;." --hidden-import="google" --hidden-import="google.genai" --hidden-import=flask --hidden-import=werkzeug --hidden-import=jinja2 --noupx app.py
+python -m PyInstaller --noconfirm --clean --onefile --windowed --name "GeminiFileSearch" --add-data "templates;templates" --add-data "static;static" --add-data ".env.example;." --hidden-import="google" --hidden-import="google.genai" --hidden-import=flask --hidden-import=werkzeug --hidden-import=jinja2 --hidden-import=waitress --hidden-import=pypdf --noupx app.py
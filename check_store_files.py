@@ -6,12 +6,14 @@ load_dotenv()
 api_key = os.getenv("GEMINI_API_KEY")
 
 if not api_key:
-    # Try to load from store_config.json
+    # Try to load from the app's metadata db (store_meta.db)
     import json
+    import sqlite3
     try:
-        with open('store_config.json', 'r') as f:
-            data = json.load(f)
-            api_key = data.get('api_key')
+        db = sqlite3.connect('store_meta.db')
+        row = db.execute("SELECT value FROM settings WHERE key = 'api_key'").fetchone()
+        if row:
+            api_key = json.loads(row[0])
     except:
         pass
 
@@ -0,0 +1,276 @@
+"""
+In-process stand-in for the parts of google-genai this app uses (files, file_search_stores,
+operations, models), so the app can be benchmarked without an API key.
+
+    from fake_genai import FakeClient
+    import app
+    app.client = FakeClient(latency={"models.generate_content": 0.8}, failure_rate=0.01)
+
+Latency is per "family.method" (or per family) in seconds, with +/- LATENCY_JITTER applied.
+failure_rate injects retryable API errors (429/503 by default) on any call.
+"""
+import itertools
+import random
+import threading
+import time
+from types import SimpleNamespace as NS
+
+from google.genai import errors
+
+DEFAULT_LATENCY = {
+    "files.upload": 0.15,
+    "file_search_stores.list": 0.1,
+    "file_search_stores.get": 0.05,
+    "file_search_stores.create": 0.2,
+    "file_search_stores.delete": 0.2,
+    "file_search_stores.list_files": 0.05, # per page of LIST_PAGE_SIZE documents
+    "file_search_stores.delete_file": 0.1,
+    "file_search_stores.import_file": 0.1,
+    "operations.get": 0.05,
+    "models.list": 0.1,
+    "models.generate_content": 0.8,
+    "models.generate_content_stream": 0.8, # spread over the chunks
+}
+LATENCY_JITTER = 0.25
+LIST_PAGE_SIZE = 20
+STREAM_CHUNKS = 8
+
+def parse_latency(spec):
+    """'models.generate_content=0.5,files=0.1' -> dict."""
+    latency = {}
+    for part in (spec or "").split(","):
+        if "=" in part:
+            key, value = part.split("=", 1)
+            latency[key.strip()] = float(value)
+    return latency
+
+def api_error(code):
+    status = {429: "RESOURCE_EXHAUSTED", 500: "INTERNAL", 503: "UNAVAILABLE", 504: "DEADLINE_EXCEEDED"}.get(code, "UNKNOWN")
+    body = {"error": {"code": code, "message": "Injected by fake_genai", "status": status}}
+    return errors.ClientError(code, body) if code < 500 else errors.ServerError(code, body)
+
+class FakePager:
+    """Like google.genai.pagers.Pager: list() returns the first page, and each next_page()
+    is one more round trip that can be throttled or fail like any other call."""
+
+    def __init__(self, fake, family, method, items, config=None):
+        self.fake = fake
+        self.family = family
+        self.method = method
+        self.items = items
+        config = config or {}
+        self.page_size = min(config.get("page_size") or LIST_PAGE_SIZE, LIST_PAGE_SIZE)
+        self.start = int(config.get("page_token") or 0)
+        self._load()
+
+    def _load(self):
+        self.page = self.items[self.start:self.start + self.page_size]
+        more = self.start + self.page_size < len(self.items)
+        self.config = {"page_size": self.page_size, "page_token": str(self.start + self.page_size) if more else None}
+
+    def next_page(self):
+        if not self.config.get("page_token"):
+            raise IndexError("No more pages to fetch.")
+        delay = self.fake.delay(self.family, self.method)
+        self.fake.record_call(f"{self.family}.{self.method}.page", delay)
+        time.sleep(delay)
+        self.start += self.page_size
+        self._load()
+        return self.page
+
+    def __iter__(self):
+        while True:
+            yield from self.page
+            try:
+                self.next_page()
+            except IndexError:
+                return
+
+class FakeNamespace:
+    def __init__(self, fake, family, methods):
+        for method, fn in methods.items():
+            setattr(self, method, fake.wrap(family, method, fn))
+
+class FakeClient:
+    def __init__(self, latency=None, failure_rate=0.0, failure_codes=(429, 503),
+                 index_delay=1.0, latency_scale=1.0, seed=None):
+        self.latency = dict(DEFAULT_LATENCY, **(latency or {}))
+        self.latency_scale = latency_scale
+        self.failure_rate = failure_rate
+        self.failure_codes = tuple(failure_codes)
+        self.index_delay = index_delay
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.ids = itertools.count(1)
+        self.stores = {} # name -> {"display_name", "docs": {doc_name: doc}}
+        self.uploaded = {}
+        self.calls = {} # "family.method" -> count
+        self.failures = {}
+
+        self.files = FakeNamespace(self, "files", {"upload": self._upload})
+        self.file_search_stores = FakeNamespace(self, "file_search_stores", {
+            "list": self._list_stores, "get": self._get_store, "create": self._create_store, "delete": self._delete_store,
+            "list_files": self._list_files, "delete_file": self._delete_file, "import_file": self._import_file,
+        })
+        self.operations = FakeNamespace(self, "operations", {"get": self._get_operation})
+        self.models = FakeNamespace(self, "models", {
+            "list": self._list_models, "generate_content": self._generate,
+            "generate_content_stream": self._generate_stream,
+        })
+
+    # --- Plumbing ---
+    def delay(self, family, method):
+        base = self.latency.get(f"{family}.{method}", self.latency.get(family, 0.0))
+        with self.lock:
+            jitter = 1 + self.random.uniform(-LATENCY_JITTER, LATENCY_JITTER)
+        return max(0.0, base * jitter * self.latency_scale)
+
+    def wrap(self, family, method, fn):
+        key = f"{family}.{method}"
+
+        def call(*args, **kwargs):
+            delay = self.delay(family, method)
+            self.record_call(key, delay)
+            return fn(delay, *args, **kwargs)
+        return call
+
+    def record_call(self, key, delay):
+        """Counts the call and raises the injected error, if this one is picked to fail."""
+        with self.lock:
+            self.calls[key] = self.calls.get(key, 0) + 1
+            fail = self.failure_rate and self.random.random() < self.failure_rate
+            code = self.random.choice(self.failure_codes) if fail else None
+            if fail:
+                self.failures[key] = self.failures.get(key, 0) + 1
+        if code:
+            time.sleep(delay / 4)
+            raise api_error(code)
+
+    def stats(self):
+        with self.lock:
+            return {"calls": dict(self.calls), "failures": dict(self.failures)}
+
+    def seed_store(self, display_name, documents, size_bytes=2048):
+        """Creates a store that already holds `documents` indexed documents."""
+        name = f"fileSearchStores/bench-{next(self.ids)}"
+        docs = {}
+        for i in range(documents):
+            doc = self._document(name, f"doc_{i:06d}.txt", size_bytes)
+            docs[doc.name] = doc
+        with self.lock:
+            self.stores[name] = {"display_name": display_name, "docs": docs}
+        return name
+
+    def _document(self, store, display_name, size_bytes):
+        doc_name = f"{store}/documents/d{next(self.ids)}"
+        return NS(name=doc_name, uri=doc_name, size_bytes=size_bytes, display_name=display_name,
+                  config=NS(display_name=display_name))
+
+    def _store(self, name):
+        store = self.stores.get(name)
+        if store is None:
+            raise errors.ClientError(404, {"error": {"code": 404, "message": f"{name} not found", "status": "NOT_FOUND"}})
+        return store
+
+    # --- files ---
+    def _upload(self, delay, file, config=None):
+        time.sleep(delay)
+        if hasattr(file, 'read'):
+            size = len(file.read())
+        else:
+            with open(file, 'rb') as f:
+                size = len(f.read())
+        display_name = (config or {}).get('display_name') if isinstance(config, dict) else getattr(config, 'display_name', None)
+        name = f"files/f{next(self.ids)}"
+        with self.lock:
+            self.uploaded[name] = NS(name=name, display_name=display_name, size_bytes=size)
+        return NS(name=name, display_name=display_name, size_bytes=size)
+
+    # --- file_search_stores ---
+    def _store_info(self, name, s):
+        return NS(name=name, display_name=s['display_name'], config=NS(display_name=s['display_name']),
+                  active_documents_count=len(s['docs']))
+
+    def _list_stores(self, delay, config=None):
+        time.sleep(delay)
+        with self.lock:
+            stores = [self._store_info(name, s) for name, s in self.stores.items()]
+        return FakePager(self, "file_search_stores", "list", stores)
+
+    def _get_store(self, delay, name, config=None):
+        time.sleep(delay)
+        with self.lock:
+            return self._store_info(name, self._store(name))
+
+    def _create_store(self, delay, config=None):
+        time.sleep(delay)
+        display_name = (config or {}).get('display_name')
+        name = f"fileSearchStores/bench-{next(self.ids)}"
+        with self.lock:
+            self.stores[name] = {"display_name": display_name, "docs": {}}
+        return NS(name=name, display_name=display_name)
+
+    def _delete_store(self, delay, name, config=None):
+        time.sleep(delay)
+        with self.lock:
+            self._store(name)
+            del self.stores[name]
+
+    def _list_files(self, delay, file_search_store_name, config=None):
+        time.sleep(delay)
+        with self.lock:
+            docs = list(self._store(file_search_store_name)['docs'].values())
+        # Paged like the real listing: one round trip per page
+        return FakePager(self, "file_search_stores", "list_files", docs, config)
+
+    def _delete_file(self, delay, file_search_store_name, file_name):
+        time.sleep(delay)
+        with self.lock:
+            self._store(file_search_store_name)['docs'].pop(file_name, None)
+
+    def _import_file(self, delay, file_search_store_name, file_name, config=None):
+        time.sleep(delay)
+        with self.lock:
+            self._store(file_search_store_name)
+            uploaded = self.uploaded[file_name]
+        doc = self._document(file_search_store_name, uploaded.display_name, uploaded.size_bytes)
+        return NS(name=f"operations/o{next(self.ids)}", done=False, error=None, response=None,
+                  ready_at=time.time() + self.index_delay, store=file_search_store_name, doc=doc)
+
+    # --- operations ---
+    def _get_operation(self, delay, operation, config=None):
+        time.sleep(delay)
+        if not operation.done and time.time() >= operation.ready_at:
+            with self.lock:
+                store = self.stores.get(operation.store)
+                if store is not None:
+                    store['docs'][operation.doc.name] = operation.doc
+            operation.response = NS(document_name=operation.doc.name)
+            operation.done = True
+        return operation
+
+    # --- models ---
+    def _list_models(self, delay, config=None):
+        time.sleep(delay)
+        return [NS(name=f"models/{m}", display_name=m, supported_generation_methods=['generateContent', 'countTokens'])
+                for m in ('gemini-2.5-flash', 'gemini-2.5-pro', 'gemini-2.0-flash')]
+
+    def _answer(self, contents):
+        if 'JSON array' in str(contents):
+            return '["What is covered?", "How do I start?", "What are the limits?", "Who is it for?", "Where is the summary?"]'
+        return f"Fake answer about: {str(contents)[:80]}. " + "Lorem ipsum dolor sit amet. " * 8
+
+    def _response(self, text):
+        candidate = NS(citation_metadata=None, grounding_metadata=None, content=NS(parts=[NS(text=text)]))
+        return NS(text=text, candidates=[candidate])
+
+    def _generate(self, delay, model, contents, config=None):
+        time.sleep(delay)
+        return self._response(self._answer(contents))
+
+    def _generate_stream(self, delay, model, contents, config=None):
+        words = self._answer(contents).split(" ")
+        step = max(1, len(words) // STREAM_CHUNKS)
+        for start in range(0, len(words), step):
+            time.sleep(delay / STREAM_CHUNKS)
+            yield self._response(" ".join(words[start:start + step]) + " ")
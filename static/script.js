@@ -36,6 +36,13 @@ document.addEventListener('DOMContentLoaded', () => {
     const exitBtn = document.getElementById('exit-btn');
 
     let currentStoreId = null;
+    // The server keeps this tab's conversation (history + summary) under this id
+    let chatSessionId = newSessionId();
+
+    function newSessionId() {
+        if (window.crypto && crypto.randomUUID) return crypto.randomUUID();
+        return Date.now().toString(36) + Math.random().toString(36).slice(2);
+    }
 
     // --- Modal Logic ---
     if (settingsBtn && settingsModal && closeSettingsBtn) {
@@ -97,6 +104,7 @@ document.addEventListener('DOMContentLoaded', () => {
                     opt.value = s.id;
                     const count = s.file_count !== undefined ? `(${s.file_count} files)` : '';
                     opt.textContent = `${s.name} ${count}`;
+                    if (s.verified_at) opt.title = `Count verified ${new Date(s.verified_at * 1000).toLocaleString()}`;
                     storeSelect.appendChild(opt);
                 });
             }
@@ -124,6 +132,7 @@ document.addEventListener('DOMContentLoaded', () => {
             });
             currentStoreId = storeId;
             fetchStoreFiles(storeId);
+            generateAndRenderSuggestions(); // Stored copy if current for this store version, otherwise this generates it
         } catch (e) { console.error(e); }
     }
 
@@ -202,31 +211,40 @@ document.addEventListener('DOMContentLoaded', () => {
         setStepStatus('step-index', 'pending');
         setStepStatus('step-suggest', 'pending');
 
-        // Upload Files Loop
-        let uploadedCount = 0;
-
+        // Upload all files in one request; the server uploads them in parallel and
+        // indexes them in the background, so we only get job ids back here.
+        let batchId = null;
+        const formData = new FormData();
         for (let i = 0; i < files.length; i++) {
-            const file = files[i];
-            const formData = new FormData();
-            formData.append('file', file);
+            formData.append('files', files[i]);
+        }
 
-            // Upload
-            try {
-                await fetch('/api/upload', { method: 'POST', body: formData });
-                uploadedCount++;
-            } catch (e) {
-                console.error(e);
-            }
+        try {
+            const res = await fetch('/api/upload/batch', { method: 'POST', body: formData });
+            const data = await res.json();
+            if (data.batch_id) batchId = data.batch_id;
+            else if (data.error) console.error(data.error);
+        } catch (e) {
+            console.error(e);
         }
 
         setStepStatus('step-upload', 'completed');
         setStepStatus('step-index', 'active');
+        indexProgress = { batchId, total: files.length, finished: 0 };
+
+        // Wait for the background jobs to finish indexing
+        const batch = batchId ? await waitForBatch(batchId) : null;
+        indexProgress = null;
+        setIndexLabel('Processing & Indexing...');
+        const uploadedCount = batch ? (batch.counts.done || 0) + (batch.counts.skipped || 0) : 0;
+        if (batch && batch.summary) {
+            console.log(`Upload summary: ${batch.summary.new} new, ${batch.summary.replaced} replaced, ${batch.summary.skipped} unchanged`);
+        }
 
         // Refresh List
         await fetchStoreFiles(currentStoreId);
         await fetchStores(); // Update counts
 
-        // Simulate indexing wait (API handles it mostly synchronously per file, but visualization helps)
         setStepStatus('step-index', 'completed');
 
         // Generate Suggestions
@@ -245,6 +263,39 @@ document.addEventListener('DOMContentLoaded', () => {
         }, 800);
     }
 
+    // Resolved by the 'batch' live event; checked up front (and after a reconnect) in case
+    // the batch finished before we started listening, and polled slowly as a fallback for
+    // a dropped event. Without EventSource the poll is all there is, so it runs every second.
+    const batchWaiters = new Map();
+    const BATCH_POLL_MS = window.EventSource ? 5000 : 1000;
+
+    function waitForBatch(batchId) {
+        return new Promise(resolve => {
+            const timer = setInterval(() => checkBatch(batchId), BATCH_POLL_MS);
+            batchWaiters.set(batchId, { resolve, timer });
+            checkBatch(batchId);
+        });
+    }
+
+    async function checkBatch(batchId) {
+        try {
+            const res = await fetch(`/api/batches/${batchId}`);
+            const batch = res.ok ? await res.json() : null;
+            if (!batch || batch.finished) resolveBatch(batchId, batch);
+        } catch (e) {
+            console.error("Batch status error", e);
+            resolveBatch(batchId, null);
+        }
+    }
+
+    function resolveBatch(batchId, batch) {
+        const waiter = batchWaiters.get(batchId);
+        if (!waiter) return;
+        batchWaiters.delete(batchId);
+        clearInterval(waiter.timer);
+        waiter.resolve(batch);
+    }
+
     async function generateAndRenderSuggestions() {
         if (!currentStoreId) return;
         try {
@@ -305,30 +356,129 @@ document.addEventListener('DOMContentLoaded', () => {
         sendBtn.disabled = true;
 
         const loaderId = addMessage('ai', 'Thinking...', true);
+        showLocalHits(loaderId, text);
 
         try {
             const model = modelSelect.value || 'gemini-1.5-flash';
-            const res = await fetch('/api/chat', {
+            const res = await fetch('/api/chat/stream', {
                 method: 'POST',
                 headers: { 'Content-Type': 'application/json' },
                 body: JSON.stringify({
                     message: text,
                     model: model,
-                    system_instruction: systemIns
+                    system_instruction: systemIns,
+                    session_id: chatSessionId
                 })
             });
-            const data = await res.json();
-            document.getElementById(loaderId).remove();
 
-            if (data.error) addMessage('ai', "Error: " + data.error);
-            else addMessage('ai', data.response, false, data.citations);
+            if (!res.ok || !res.body) {
+                const data = await res.json();
+                document.getElementById(loaderId).remove();
+                addMessage('ai', "Error: " + (data.error || res.statusText));
+                return;
+            }
+
+            // Render deltas into the loader bubble as they arrive
+            const bubble = document.getElementById(loaderId).querySelector('.bubble');
+            let answer = '';
+            await readEventStream(res, (event, data) => {
+                if (event === 'delta') {
+                    answer += data.text;
+                    bubble.style.opacity = '1';
+                    bubble.innerHTML = formatMessageHtml(answer);
+                    chatHistory.scrollTop = chatHistory.scrollHeight;
+                } else if (event === 'done') {
+                    bubble.innerHTML = formatMessageHtml(data.response, data.citations);
+                    chatHistory.scrollTop = chatHistory.scrollHeight;
+                } else if (event === 'error') {
+                    bubble.style.opacity = '1';
+                    bubble.textContent = "Error: " + data.error;
+                }
+            });
 
         } catch (e) {
-            document.getElementById(loaderId).remove();
+            const loader = document.getElementById(loaderId);
+            if (loader) loader.remove();
             addMessage('ai', "Network Error");
+        } finally {
+            sendBtn.disabled = userInput.value.trim() === '';
+        }
+    }
+
+    // Instant keyword hits from the local index, shown above the answer while it generates
+    async function showLocalHits(messageId, text) {
+        if (!currentStoreId) return;
+        try {
+            const params = new URLSearchParams({ q: text, match: 'any', limit: 5 });
+            const res = await fetch(`/api/store/${currentStoreId}/search?${params}`);
+            const data = await res.json();
+            const msgDiv = document.getElementById(messageId);
+            if (!msgDiv || !data.results || data.results.length === 0) return;
+
+            const hits = document.createElement('div');
+            hits.className = 'local-hits';
+            hits.innerHTML = '<span class="local-hits-title">Matching files</span>';
+            data.results.forEach(r => {
+                const item = document.createElement('div');
+                item.className = 'local-hit';
+                const name = document.createElement('b');
+                name.textContent = r.name;
+                const snippet = document.createElement('span');
+                snippet.className = 'local-hit-snippet';
+                snippet.innerHTML = r.snippet; // escaped server-side, only <mark> added
+                item.append(name, snippet);
+                hits.appendChild(item);
+            });
+            msgDiv.prepend(hits);
+        } catch (e) { console.error("Local search failed", e); }
+    }
+
+    // Minimal Server-Sent Events reader over fetch (EventSource can't POST)
+    async function readEventStream(res, onEvent) {
+        const reader = res.body.getReader();
+        const decoder = new TextDecoder();
+        let buffer = '';
+
+        while (true) {
+            const { value, done } = await reader.read();
+            if (done) break;
+            buffer += decoder.decode(value, { stream: true });
+
+            let sep;
+            while ((sep = buffer.indexOf('\n\n')) !== -1) {
+                const frame = buffer.slice(0, sep);
+                buffer = buffer.slice(sep + 2);
+                let event = 'message';
+                let data = '';
+                frame.split('\n').forEach(line => {
+                    if (line.startsWith('event: ')) event = line.slice(7);
+                    else if (line.startsWith('data: ')) data += line.slice(6);
+                });
+                if (data) onEvent(event, JSON.parse(data));
+            }
         }
     }
 
+    function formatMessageHtml(text, citations = []) {
+        let html = text
+            .replace(/&/g, "&amp;")
+            .replace(/</g, "&lt;")
+            .replace(/>/g, "&gt;")
+            .replace(/\*\*(.*?)\*\*/g, '<b>$1</b>')
+            .replace(/\n/g, '<br>');
+
+        if (citations && citations.length > 0) {
+            html += `<div class="citation-block"><span class="citation-title">Sources:</span><br>`;
+            citations.forEach(c => {
+                // try to find name from file map if needed, but simplistic now
+                const range = c.startIndex !== undefined ? `[${c.startIndex}-${c.endIndex}]` : "";
+                html += `<span class="citation-item">${c.uri.split('/').pop()} ${range}</span>`;
+            });
+            html += `</div>`;
+        }
+        return html;
+    }
+
     function addMessage(role, text, isLoading = false, citations = []) {
         const msgDiv = document.createElement('div');
         msgDiv.className = `message ${role}`;
@@ -341,23 +491,7 @@ document.addEventListener('DOMContentLoaded', () => {
             bubble.textContent = text;
             bubble.style.opacity = '0.7';
         } else {
-            let html = text
-                .replace(/&/g, "&amp;")
-                .replace(/</g, "&lt;")
-                .replace(/>/g, "&gt;")
-                .replace(/\*\*(.*?)\*\*/g, '<b>$1</b>')
-                .replace(/\n/g, '<br>');
-
-            if (citations && citations.length > 0) {
-                html += `<div class="citation-block"><span class="citation-title">Sources:</span><br>`;
-                citations.forEach(c => {
-                    // try to find name from file map if needed, but simplistic now
-                    const range = c.startIndex !== undefined ? `[${c.startIndex}-${c.endIndex}]` : "";
-                    html += `<span class="citation-item">${c.uri.split('/').pop()} ${range}</span>`;
-                });
-                html += `</div>`;
-            }
-            bubble.innerHTML = html;
+            bubble.innerHTML = formatMessageHtml(text, citations);
         }
 
         msgDiv.appendChild(bubble);
@@ -380,6 +514,9 @@ document.addEventListener('DOMContentLoaded', () => {
     sendBtn.addEventListener('click', sendMessage);
 
     clearChatBtn.addEventListener('click', () => {
+        // Forget the conversation server-side too and start a fresh one
+        fetch(`/api/chat/sessions/${chatSessionId}`, { method: 'DELETE' }).catch(e => console.error(e));
+        chatSessionId = newSessionId();
         chatHistory.innerHTML = '';
         suggestionsDiv.style.display = 'none';
         // Add welcome message back
@@ -390,7 +527,14 @@ document.addEventListener('DOMContentLoaded', () => {
     });
 
     // --- Sidebar File List ---
+    // Files are fetched a page at a time; the next page loads when the list is scrolled near its end.
+    let filesStoreId = null;
+    let filesNextToken = null;
+    let filesLoading = false;
+
     async function fetchStoreFiles(storeId) {
+        filesStoreId = storeId;
+        filesNextToken = null;
         if (!storeId) {
             fileList.innerHTML = '<div style="text-align:center; color:grey; padding:10px;">No store selected.</div>';
             return;
@@ -398,22 +542,12 @@ document.addEventListener('DOMContentLoaded', () => {
         fileList.innerHTML = '<div class="spinner" style="margin:10px auto;"></div>';
 
         try {
-            const res = await fetch(`/api/store/${storeId}/files`);
-            const data = await res.json();
+            const data = await fetchFilesPage(storeId, null);
+            if (filesStoreId !== storeId) return; // Store switched meanwhile
             fileList.innerHTML = '';
 
             if (data.files && data.files.length > 0) {
-                data.files.forEach(f => {
-                    const item = document.createElement('div');
-                    item.className = 'file-item';
-                    item.innerHTML = `
-                        <div style="display:flex; justify-content:space-between; width:100%;">
-                            <span class="file-name" title="${f.name}">${f.name}</span>
-                            <span class="check">✓</span>
-                        </div>
-                    `;
-                    fileList.appendChild(item);
-                });
+                appendFileItems(data.files);
             } else {
                 fileList.innerHTML = '<div style="text-align:center; color:grey; padding:10px; font-size:12px;">No files yet.</div>';
             }
@@ -422,6 +556,44 @@ document.addEventListener('DOMContentLoaded', () => {
         }
     }
 
+    async function fetchFilesPage(storeId, pageToken) {
+        filesLoading = true;
+        try {
+            const params = new URLSearchParams({ page_size: 100 });
+            if (pageToken) params.set('page_token', pageToken);
+            const res = await fetch(`/api/store/${storeId}/files?${params}`);
+            const data = await res.json();
+            if (filesStoreId === storeId) filesNextToken = data.next_page_token || null;
+            return data;
+        } finally {
+            filesLoading = false;
+        }
+    }
+
+    function appendFileItems(files) {
+        files.forEach(f => {
+            const item = document.createElement('div');
+            item.className = 'file-item';
+            item.innerHTML = `
+                <div style="display:flex; justify-content:space-between; width:100%;">
+                    <span class="file-name" title="${f.name}">${f.name}</span>
+                    <span class="check">✓</span>
+                </div>
+            `;
+            fileList.appendChild(item);
+        });
+    }
+
+    fileList.addEventListener('scroll', async () => {
+        if (!filesNextToken || filesLoading) return;
+        if (fileList.scrollTop + fileList.clientHeight < fileList.scrollHeight - 200) return;
+        const storeId = filesStoreId;
+        try {
+            const data = await fetchFilesPage(storeId, filesNextToken);
+            if (filesStoreId === storeId && data.files) appendFileItems(data.files);
+        } catch (e) { console.error("Loading more files failed", e); }
+    });
+
     // --- Init ---
     fetchStores();
 
@@ -541,8 +713,54 @@ document.addEventListener('DOMContentLoaded', () => {
         });
     }
 
-    // Heartbeat
-    setInterval(async () => {
-        try { await fetch('/api/heartbeat', { method: 'POST' }); } catch (e) { }
-    }, 2000);
+    // --- Live Events ---
+    // One stream per tab for job progress and store changes. It also tells the server this
+    // tab is open (it shuts down a few seconds after the last tab's stream goes away).
+    const tabId = newSessionId();
+    const indexLabel = document.getElementById('step-index-label');
+    let indexProgress = null; // { batchId, total, finished } while an upload is indexing
+    let storesRefreshTimer = null;
+
+    function setIndexLabel(text) {
+        if (indexLabel) indexLabel.textContent = text;
+    }
+
+    function refreshStoresSoon() {
+        // A batch changes the store once per file; refresh once it settles
+        clearTimeout(storesRefreshTimer);
+        storesRefreshTimer = setTimeout(fetchStores, 500);
+    }
+
+    if (window.EventSource) {
+        const events = new EventSource(`/api/events?tab=${encodeURIComponent(tabId)}`);
+        const onEvent = (name, handler) => events.addEventListener(name, e => handler(JSON.parse(e.data || '{}')));
+
+        events.addEventListener('open', () => {
+            // Anything that finished while we were disconnected
+            batchWaiters.forEach((_, batchId) => checkBatch(batchId));
+        });
+        onEvent('job', job => {
+            if (!indexProgress || job.batch_id !== indexProgress.batchId) return;
+            if (['done', 'skipped', 'failed'].includes(job.status)) indexProgress.finished += 1;
+            setIndexLabel(`Processing & Indexing... (${indexProgress.finished}/${indexProgress.total})`);
+        });
+        onEvent('batch', batch => resolveBatch(batch.batch_id, batch));
+        onEvent('store', () => refreshStoresSoon());
+        onEvent('stores', () => fetchStores());
+        onEvent('suggestions', data => {
+            // Fresh questions for the open store; the upload flow asks for them itself
+            if (data.store_id === currentStoreId && !indexProgress && progressOverlay.classList.contains('hidden')) {
+                generateAndRenderSuggestions();
+            }
+        });
+
+        window.addEventListener('pagehide', () => {
+            navigator.sendBeacon(`/api/events/close?tab=${encodeURIComponent(tabId)}`);
+        });
+    } else {
+        // Heartbeat (browsers without EventSource)
+        setInterval(async () => {
+            try { await fetch('/api/heartbeat', { method: 'POST' }); } catch (e) { }
+        }, 2000);
+    }
 });
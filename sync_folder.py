@@ -0,0 +1,324 @@
+"""
+Mirrors a local folder into a File Search store from the command line, using the same
+store metadata (store_meta.db), API key and ingestion pipeline as app.py.
+
+    python sync_folder.py ./manuals "Product Manuals"           # one incremental sync
+    python sync_folder.py ./manuals "Product Manuals" --watch   # then keep pushing changes
+    python sync_folder.py ./manuals "Product Manuals" --dry-run
+
+Each synced file is recorded in store_meta.db (sync_files) with its size, mtime and
+SHA-256. A re-sync only hashes files whose size or mtime changed and only uploads files
+whose content changed; files removed from the folder are deleted from the store. The
+only API call for an unchanged tree is one store lookup, comparing its document count
+with the count store_meta.db expects; the store is listed (to find what went missing
+remotely) only when they differ or on the first verified sync. Skip it with --no-verify.
+
+Documents are named by their path relative to the folder ("guides/setup.pdf").
+--watch uses filesystem notifications when the watchdog package is installed and
+re-scans every --interval seconds otherwise.
+"""
+import argparse
+import fnmatch
+import hashlib
+import mimetypes
+import os
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import app
+
+HASH_CHUNK = 1024 * 1024
+WATCH_DEBOUNCE = 1.0 # Seconds of quiet after a change before syncing
+DEFAULT_EXCLUDES = ('.*', '~$*', '*.tmp', 'Thumbs.db', 'desktop.ini')
+
+class LocalFile:
+    """A file on disk in the shape ingest_file expects of an upload spool."""
+
+    def __init__(self, path, size, mtime_ns, sha256):
+        self.path = path
+        self.size = size
+        self.mtime_ns = mtime_ns
+        self.sha256 = sha256
+        self.handle = None
+
+    def rewind(self):
+        if self.handle is None:
+            self.handle = open(self.path, 'rb')
+        self.handle.seek(0)
+        return self.handle
+
+    def discard(self):
+        if self.handle is not None:
+            self.handle.close()
+            self.handle = None
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def is_excluded(name, excludes):
+    return any(fnmatch.fnmatch(name, pattern) for pattern in excludes)
+
+def scan_folder(root, excludes):
+    """{relative/path: (absolute path, size, mtime_ns)} for every regular file under root."""
+    found = {}
+    pending = [root]
+    while pending:
+        folder = pending.pop()
+        try:
+            entries = list(os.scandir(folder))
+        except OSError as e:
+            print(f"Skipping {folder}: {e}")
+            continue
+        for entry in entries:
+            if is_excluded(entry.name, excludes):
+                continue
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    pending.append(entry.path)
+                elif entry.is_file(follow_symlinks=False):
+                    st = entry.stat(follow_symlinks=False)
+                    rel = os.path.relpath(entry.path, root).replace(os.sep, '/')
+                    found[rel] = (entry.path, st.st_size, st.st_mtime_ns)
+            except OSError as e:
+                print(f"Skipping {entry.path}: {e}")
+    return found
+
+# --- Sync state (store_meta.db) ---
+def load_sync_state(store_id, root):
+    rows = app.meta_db().execute("""
+        SELECT display_name, size, mtime_ns, sha256 FROM sync_files WHERE store_id = ? AND root = ?
+    """, (store_id, root)).fetchall()
+    return {row[0]: {"size": row[1], "mtime_ns": row[2], "sha256": row[3]} for row in rows}
+
+def save_sync_state(store_id, root, changes, removed=()):
+    """changes: {display_name: (size, mtime_ns, sha256)}; one transaction for the whole pass."""
+    now = time.time()
+    with app.meta_transaction() as db:
+        db.executemany("INSERT OR REPLACE INTO sync_files VALUES (?, ?, ?, ?, ?, ?, ?)",
+                       [(store_id, name, root, size, mtime_ns, sha256, now)
+                        for name, (size, mtime_ns, sha256) in changes.items()])
+        db.executemany("DELETE FROM sync_files WHERE store_id = ? AND display_name = ?",
+                       [(store_id, name) for name in removed])
+
+def resolve_store(name, create=True):
+    """Store id for a display name (or id), cached in settings so a re-sync needs no store listing."""
+    if name.startswith('fileSearchStores/'):
+        return name
+    known = app.load_setting('sync_stores') or {}
+    if name in known:
+        return known[name]
+
+    matches = [s['id'] for s in app.get_remote_stores(refresh=True) if s['name'] == name]
+    if matches:
+        store_id = matches[0]
+    elif create:
+        store = app.get_client().file_search_stores.create(config={'display_name': name})
+        store_id = store.name
+        app.init_store_meta_local(store_id)
+        app.invalidate_stores_cache()
+        print(f"Created store '{name}' ({store_id})")
+    else:
+        raise SystemExit(f"No store named '{name}' (drop --no-create to create it)")
+
+    known[name] = store_id
+    app.save_setting('sync_stores', known)
+    return store_id
+
+def forget_store(name):
+    known = app.load_setting('sync_stores') or {}
+    if known.pop(name, None):
+        app.save_setting('sync_stores', known)
+
+# --- Sync ---
+class FolderSync:
+    def __init__(self, root, store_id, workers=app.INGEST_WORKERS, excludes=DEFAULT_EXCLUDES, dry_run=False):
+        self.root = os.path.abspath(root)
+        self.store_id = store_id
+        self.excludes = excludes
+        self.dry_run = dry_run
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="sync-upload")
+        self.lock = threading.Lock() # One pass at a time (watch mode)
+
+    def remote_count_matches(self):
+        """The one API call of an unchanged re-sync: True when the store's active document
+        count is what the local counters expect, so nothing needs listing. A document lost
+        remotely while another was added outside this app goes unnoticed until counts drift."""
+        meta = app.get_store_meta_local(self.store_id)
+        if not meta or meta['remote_count'] is None:
+            return False # Never listed; nothing to compare against
+        expected = app.store_count_info(meta)['count']
+        with app.stage('sync_verify'):
+            store = app.get_client().file_search_stores.get(name=self.store_id)
+        remote_count = getattr(store, 'active_documents_count', None)
+        if not isinstance(remote_count, int):
+            return False
+        app.save_store_remote_count_local(self.store_id, remote_count)
+        return remote_count == expected
+
+    def plan(self, verify):
+        """Compares the folder against the recorded state. Returns (uploads, touched, removed, unchanged)
+        where uploads is {name: LocalFile} and touched {name: (size, mtime_ns, sha256)}."""
+        with app.stage('sync_scan'):
+            found = scan_folder(self.root, self.excludes)
+        state = load_sync_state(self.store_id, self.root)
+        manifest = None
+        if verify and not self.remote_count_matches():
+            manifest = app.get_store_manifest(self.store_id, refresh=True)
+            app.save_store_remote_count_local(self.store_id, len(manifest))
+
+        uploads, touched, unchanged = {}, {}, 0
+        with app.stage('sync_hash'):
+            for name, (path, size, mtime_ns) in found.items():
+                known = state.get(name)
+                missing = manifest is not None and name not in manifest
+                if known and not missing and known['size'] == size and known['mtime_ns'] == mtime_ns:
+                    unchanged += 1
+                    continue
+                try:
+                    sha256 = file_sha256(path)
+                except OSError as e:
+                    print(f"Skipping {name}: {e}")
+                    continue
+                remote = manifest.get(name) if manifest is not None else app.manifest_lookup(self.store_id, name)
+                if remote and remote['sha256'] == sha256:
+                    touched[name] = (size, mtime_ns, sha256) # Only the mtime moved, or uploaded elsewhere
+                elif known and not missing and known['sha256'] == sha256:
+                    touched[name] = (size, mtime_ns, sha256)
+                else:
+                    uploads[name] = LocalFile(path, size, mtime_ns, sha256)
+
+        removed = [name for name in state if name not in found]
+        return uploads, touched, removed, unchanged
+
+    def run(self, verify=True):
+        with self.lock:
+            started = time.time()
+            uploads, touched, removed, unchanged = self.plan(verify)
+            if self.dry_run:
+                for name in sorted(uploads):
+                    print(f"  upload  {name}")
+                for name in sorted(removed):
+                    print(f"  delete  {name}")
+                print(f"Dry run: {len(uploads)} to upload, {len(removed)} to delete, "
+                      f"{unchanged + len(touched)} unchanged")
+                return {"uploaded": 0, "deleted": 0, "failed": 0, "unchanged": unchanged + len(touched)}
+
+            deleted, failed = [], 0
+            for name in removed:
+                entry = app.manifest_lookup(self.store_id, name)
+                try:
+                    if entry:
+                        app.delete_store_document(self.store_id, name, entry['document'])
+                    deleted.append(name)
+                    print(f"Deleted {name}")
+                except Exception as e:
+                    failed += 1
+                    print(f"Error deleting {name}: {e}")
+
+            done = {}
+            if uploads:
+                batch = self.upload(uploads)
+                for job in batch['jobs']:
+                    source = uploads[job['filename']]
+                    if job['status'] == 'done':
+                        done[job['filename']] = (source.size, source.mtime_ns, source.sha256)
+                    else:
+                        failed += 1
+                        print(f"Failed {job['filename']}: {job['error']}")
+
+            save_sync_state(self.store_id, self.root, dict(touched, **done), deleted)
+            result = {"uploaded": len(done), "deleted": len(deleted), "failed": failed,
+                      "unchanged": unchanged + len(touched)}
+            if verify or uploads or removed or failed: # Quiet when a watch pass finds nothing
+                print(f"Synced {self.root} in {time.time() - started:.2f}s: {result['uploaded']} uploaded, "
+                      f"{result['deleted']} deleted, {result['unchanged']} unchanged, {failed} failed")
+            return result
+
+    def upload(self, uploads):
+        """Runs the uploads through ingest_file on the bounded pool and waits for indexing."""
+        batch_id = uuid.uuid4().hex
+        for name, source in uploads.items():
+            job = app.create_job(name, self.store_id, batch_id)
+            app.update_job(job['id'], action='replaced' if app.manifest_lookup(self.store_id, name) else 'new')
+            mime_type = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+            app.submit_ingest(job['id'], source, name, self.store_id, mime_type, executor=self.executor)
+        return app.wait_for_batch(batch_id)
+
+# --- Watch mode ---
+def watch(sync, interval):
+    """Re-syncs shortly after the folder changes, until Ctrl+C."""
+    changed = threading.Event()
+    observer = None
+    try:
+        from watchdog.observers import Observer
+        from watchdog.events import FileSystemEventHandler
+    except ImportError:
+        print(f"watchdog not installed; re-scanning every {interval}s.")
+    else:
+        class Handler(FileSystemEventHandler):
+            def on_any_event(self, event):
+                if event.event_type != 'opened':
+                    changed.set()
+
+        observer = Observer()
+        observer.schedule(Handler(), sync.root, recursive=True)
+        observer.start()
+        print(f"Watching {sync.root} for changes...")
+
+    try:
+        while True:
+            if observer is None:
+                time.sleep(interval)
+            else:
+                changed.wait()
+                # Let a burst of events (copying a folder, an editor's save) settle
+                while changed.wait(WATCH_DEBOUNCE):
+                    changed.clear()
+            try:
+                sync.run(verify=False)
+            except Exception as e:
+                print(f"Sync failed: {e}")
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if observer is not None:
+            observer.stop()
+            observer.join()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('folder')
+    parser.add_argument('store', help="store display name (created if missing) or fileSearchStores/... id")
+    parser.add_argument('--watch', action='store_true', help="keep running and sync changes as they happen")
+    parser.add_argument('--interval', type=float, default=2.0, help="re-scan interval for --watch without watchdog")
+    parser.add_argument('--workers', type=int, default=app.INGEST_WORKERS, help="parallel uploads")
+    parser.add_argument('--exclude', action='append', default=[], help="file/folder name pattern to skip (repeatable)")
+    parser.add_argument('--no-verify', action='store_true', help="skip the remote check for missing documents")
+    parser.add_argument('--no-create', action='store_true', help="fail instead of creating a missing store")
+    parser.add_argument('--dry-run', action='store_true', help="only show what would change")
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.folder):
+        raise SystemExit(f"Not a folder: {args.folder}")
+    store_id = resolve_store(args.store, create=not args.no_create)
+    sync = FolderSync(args.folder, store_id, workers=args.workers,
+                      excludes=DEFAULT_EXCLUDES + tuple(args.exclude), dry_run=args.dry_run)
+    try:
+        result = sync.run(verify=not args.no_verify)
+    except Exception as e:
+        if getattr(e, 'code', None) == 404:
+            forget_store(args.store) # Deleted since it was cached; the next run looks it up again
+        raise SystemExit(f"Sync failed: {e}")
+    if args.watch and not args.dry_run:
+        watch(sync, args.interval)
+    return 1 if result['failed'] else 0
+
+if __name__ == '__main__':
+    sys.exit(main())